@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 from scipy.integrate import odeint
+from scipy.sparse import csr_matrix, diags
+from scipy.sparse.linalg import expm_multiply
 from lmfit import minimize, Parameters, report_fit
 from ..alkali_atom_data import *
 import matplotlib.pyplot as plt
@@ -15,7 +17,9 @@ import matplotlib.pyplot as plt
 
 def getPopulationLifetime(atom, n, l, j,
                           temperature=0, includeLevelsUpTo=0, period=1,
-                          plotting=1, thresholdState=False, detailedOutput=False):
+                          plotting=1, thresholdState=False, detailedOutput=False,
+                          times=None, maxL=3, rateMatrix=None,
+                          outputFile=None):
     r"""
     Calculates lifetime of atomic **population** taking into account
     redistribution of population to other states under spontaneous and
@@ -23,15 +27,18 @@ def getPopulationLifetime(atom, n, l, j,
 
     It simulates the time evolution of a system in which all the states,
     from the fundamental one to the highest state which you want to include,
-    are taken into account.
-    The orbital angular momenta taken into account are only S,P,D,F.
+    are taken into account. Rate equations are solved exactly, by applying
+    the exponential of the (sparse) rate matrix to the initial populations
+    (see `scipy.sparse.linalg.expm_multiply`), at the requested times.
+    The orbital angular momenta taken into account are, by default, only
+    S,P,D,F (see `maxL`).
 
     This function is based on getStateLifetime but it takes into account
     the re-population processess due to BBR-induced transitions.
     For this reason lifetimes of Rydberg states are slightly longer
     than those returned by getStateLifetime up to 5-10%.
 
-    This function creates a .txt file, plots the time evolution of the
+    This function returns and plots the time evolution of the
     population of the Rydberg states and yields the lifetime values by using
     the fitting method from Ref. [#fit]_ .
 
@@ -96,6 +103,16 @@ def getPopulationLifetime(atom, n, l, j,
             Minimal value of the parameter in that case is =`n+1
         period: Specifies the period that you want to consider for
             the time evolution, in microseconds.
+        times (array): optional. Times (in microseconds) at which the
+            populations are calculated. By default 1001 equally spaced
+            times from 0 to `period`.
+        maxL (int): optional. Maximum orbital angular momentum of the
+            states taken into account, by default 3 (S, P, D and F states).
+        rateMatrix: optional. States and rates returned by
+            :obj:`getRateMatrix`. If not specified, it is calculated for
+            given `temperature`, `includeLevelsUpTo` and `maxL`. Specifying
+            it allows the same rate matrix to be reused for calculations
+            with different initial states and threshold states.
         plotting (int): optional. It is set to 1 by default. The options are
             (see also image at the bottom of documentation):
             **plotting=0** no plot;
@@ -121,33 +138,40 @@ def getPopulationLifetime(atom, n, l, j,
             state if plotting = 2, 3 or 4 has been selected. It is not necessary
             to define a threshold state if plotting = 0 or 1 has been selected.
 
-        detailedOutput=True: optional. It writes a .txt file with the time
-            evolution of all the states. It is set to false by default.
-            (The first column is the time, the other are the population of all
-            the states. The order is time, nS, nP0.5, nP1.5, nD1.5, nD2.5,
-            nF2.5, nF3.5, and n is ordered from the lowest state to the highest one.
-            For example: time, 4S, 5S ,6S ,ecc... includeLevelsUpToS, 4P0.5,
-            5P0.5, 6P0.5, ecc... includeLevelsUpToP0.5, 4P1.5, 5P1.5, 6P1.5, ecc...)
+        detailedOutput (bool): optional. If True, returned results also
+            include the time evolution of all the states. It is set to false
+            by default. (The order of the states is nS, nP0.5, nP1.5, nD1.5,
+            nD2.5, nF2.5, nF3.5 (for higher `maxL`, followed by higher l
+            series), and n is ordered from the lowest state to the highest
+            one. For example: 4S, 5S ,6S ,ecc... includeLevelsUpToS, 4P0.5,
+            5P0.5, 6P0.5, ecc... includeLevelsUpToP0.5, 4P1.5, 5P1.5, 6P1.5,
+            ecc...)
+        outputFile (str or file): optional. If specified, results are also
+            saved to this file, in NumPy `.npz` format (see `numpy.savez`),
+            with the same keys as the returned dictionary.
 
     Returns:
-        Plots and a .txt file.
-        **plotting = 0,1** create a .txt file with two coloumns
-        (time \t target population);
-        **plotting = 2,3,4** create a .txt file with four coloumns
-        (time \t ensemble population \t support population \t target population)
+        dictionary of arrays: **"time"** times (in microseconds) and
+        **"target"** population of the target state;
+        if `thresholdState` is set (plotting = 2, 3, 4), also
+        **"ensemble"** and **"support"** populations;
+        if `detailedOutput` is True, also **"states"**, array with rows
+        (n, l, j) of all the states, and **"populations"**, populations of
+        all the states indexed [time, state].
 
 
     Example:
         >>> from arc import *
         >>> from arc.advanced.population_lifetime import getPopulationLifetime
         >>> atom = Rubidium()
-        >>> getPopulationLifetime(atom, 10, 1, 1.5, temperature =300,
+        >>> results = getPopulationLifetime(atom, 10, 1, 1.5, temperature =300,
                 includeLevelsUpTo=15, detailedOutput=True, plotting=1)
 
     """
 
-    if l > 3:
-        print("Error: this function takes into account only S, P, D, F states.")
+    if l > maxL:
+        print("Error: this function takes into account only states with "
+              "orbital angular momentum up to maxL = %d." % maxL)
         return
 
     if plotting > 4:
@@ -172,242 +196,70 @@ def getPopulationLifetime(atom, n, l, j,
 
     # Which states do you want to consider for the BBR width?
     if includeLevelsUpTo - STATE < 0:
-        raise valueError("Error: includeLevelsUpTo must be >= n")
-    WidthBBR = includeLevelsUpTo - STATE
+        raise ValueError("Error: includeLevelsUpTo must be >= n")
     # What is the temperature?
     if temperature == 0:
-        raise valueError("Error: if you don't want BBR-induced transition, use getStateLifetime")
-    TEMP_BBR = temperature
+        raise ValueError("Error: if you don't want BBR-induced transition, use getStateLifetime")
     # What is the critical state for the ionization?
     if thresholdState - STATE >= 0:
-        raise valueError("Error: thresholdState must be < n")
+        raise ValueError("Error: thresholdState must be < n")
     CState = thresholdState
-    # It creates the references for the ensemble population
-    cutoffs = int(atom.getQuantumDefect(STATE, 0, 0.5) -
-                  atom.getQuantumDefect(STATE,0,0.5))
-    cutoffp05 = int(atom.getQuantumDefect(STATE, 0, 0.5 ) -
-                    atom.getQuantumDefect(STATE,1,0.5))
-    cutoffp15 = int(atom.getQuantumDefect(STATE, 0, 0.5) -
-                    atom.getQuantumDefect(STATE,1,1.5))
-    cutoffd15 = int(atom.getQuantumDefect(STATE, 0, 0.5) -
-                    atom.getQuantumDefect(STATE,2,1.5))
-    cutoffd25 = int(atom.getQuantumDefect(STATE, 0, 0.5) -
-                    atom.getQuantumDefect(STATE,2,2.5))
-    cutofff25 = int(atom.getQuantumDefect(STATE, 0, 0.5) -
-                    atom.getQuantumDefect(STATE,3,2.5))
-    cutofff35 = int(atom.getQuantumDefect(STATE, 0, 0.5) -
-                    atom.getQuantumDefect(STATE,3,3.5))
-    # Total time of the dynamics
-    totaltime = period * 1e-6
-    # Parts of gammamax that you take for time step
-    partg = 2.0
 
     #########################################################
 
-    # It takes into account of the extra levels
-    extraL = atom.extraLevels[1][:]
-
-    # It creates the references for the matrix
-    riftot = (STATE + WidthBBR - extraL[0] + 1) * 7
-    rifs = ((STATE + WidthBBR - extraL[0] + 1) * 0) - extraL[0]
-    rifp05 = ((STATE + WidthBBR - extraL[0] + 1) * 1) - extraL[0]
-    rifp15 = ((STATE + WidthBBR - extraL[0] + 1) * 2) - extraL[0]
-    rifd15 = ((STATE + WidthBBR - extraL[0] + 1) * 3) - extraL[0]
-    rifd25 = ((STATE + WidthBBR - extraL[0] + 1) * 4) - extraL[0]
-    riff25 = ((STATE + WidthBBR - extraL[0] + 1) * 5) - extraL[0]
-    riff35 = ((STATE + WidthBBR - extraL[0] + 1) * 6) - extraL[0]
-
     # It creates the matrix of the rates
-    c = np.zeros(shape=(riftot, riftot))
-
-    print("Creating the rates matrix:")
-
-    for pqn in xrange(extraL[0], STATE + WidthBBR+1):
-        for fpqn in xrange(extraL[0], STATE + WidthBBR+1):
-            # rate from s
-            c[pqn + rifs, fpqn + rifp05] = atom.getTransitionRate(
-                pqn, 0, 0.5, fpqn, 1, 0.5, TEMP_BBR)  # rate s -> p0.5
-            c[pqn + rifs, fpqn + rifp15] = atom.getTransitionRate(
-                pqn, 0, 0.5, fpqn, 1, 1.5, TEMP_BBR)  # rate s -> p1.5
-        # rate from p0.5
-            c[pqn + rifp05, fpqn + rifs] = atom.getTransitionRate(
-                pqn, 1, 0.5, fpqn, 0, 0.5, TEMP_BBR)  # rate p0.5 -> s
-            c[pqn + rifp05, fpqn + rifd15] = atom.getTransitionRate(
-                pqn, 1, 0.5, fpqn, 2, 1.5, TEMP_BBR)  # rate p0.5 -> d1.5
-        # rate from p1.5
-            c[pqn + rifp15, fpqn + rifs] = atom.getTransitionRate(
-                pqn, 1, 1.5, fpqn, 0, 0.5, TEMP_BBR)  # rate p1.5 -> s
-            c[pqn + rifp15, fpqn + rifd15] = atom.getTransitionRate(
-                pqn, 1, 1.5, fpqn, 2, 1.5, TEMP_BBR)  # rate p1.5 -> d1.5
-            c[pqn + rifp15, fpqn + rifd25] = atom.getTransitionRate(
-                pqn, 1, 1.5, fpqn, 2, 2.5, TEMP_BBR)  # rate p1.5 -> d2.5
-        # rate from d1.5
-            c[pqn + rifd15, fpqn + rifp05] = atom.getTransitionRate(
-                pqn, 2, 1.5, fpqn, 1, 0.5, TEMP_BBR)  # rate d1.5 -> p0.5
-            c[pqn + rifd15, fpqn + rifp15] = atom.getTransitionRate(
-                pqn, 2, 1.5, fpqn, 1, 1.5, TEMP_BBR)  # rate d1.5 -> p1.5
-            c[pqn + rifd15, fpqn + riff25] = atom.getTransitionRate(
-                pqn, 2, 1.5, fpqn, 3, 2.5, TEMP_BBR)  # rate d1.5 -> f2.5
-        # rate from d2.5
-            c[pqn + rifd25, fpqn + rifp15] = atom.getTransitionRate(
-                pqn, 2, 2.5, fpqn, 1, 1.5, TEMP_BBR)  # rate d2.5 -> p1.5
-            c[pqn + rifd25, fpqn + riff25] = atom.getTransitionRate(
-                pqn, 2, 2.5, fpqn, 3, 2.5, TEMP_BBR)  # rate d2.5 -> f2.5
-            c[pqn + rifd25, fpqn + riff35] = atom.getTransitionRate(
-                pqn, 2, 2.5, fpqn, 3, 3.5, TEMP_BBR)  # rate d2.5 -> f3.5
-        # rate from f2.5
-            c[pqn + riff25, fpqn + rifd15] = atom.getTransitionRate(
-                pqn, 3, 2.5, fpqn, 2, 1.5, TEMP_BBR)  # rate f2.5 -> d1.5
-            c[pqn + riff25, fpqn + rifd25] = atom.getTransitionRate(
-                pqn, 3, 2.5, fpqn, 2, 2.5, TEMP_BBR)  # rate f2.5 -> d2.5
-        # rate from f3.5
-            c[pqn + riff35, fpqn + rifd25] = atom.getTransitionRate(
-                pqn, 3, 3.5, fpqn, 2, 2.5, TEMP_BBR)  # rate f3.5 -> d2.5
-        print(pqn, end=' ')
-
-    # It deletes all the gammas for states under the ground state which are not the extra levels
-
-    if extraL[1] > 2:
-        c[extraL[0] +rifd15, :] = 0
-        c[:, extraL[0] +rifd15] = 0
-        c[extraL[0] +rifd25, :] = 0
-        c[:, extraL[0] +rifd25] = 0
-        if extraL[1] > 3:
-            c[extraL[0] +riff25, :] = 0
-            c[:, extraL[0] +riff25] = 0
-            c[extraL[0] +riff35, :] = 0
-            c[:, extraL[0] +riff35] = 0
-
-    c[extraL[0] +rifs, :] = 0
-    c[:, extraL[0] +rifs] = 0
-    c[extraL[0] +rifp05, :] = 0
-    c[:, extraL[0] +rifp05] = 0
-    c[extraL[0] +rifp15, :] = 0
-    c[:, extraL[0] +rifp15] = 0
-
-    # It finds the maximum rate in the matrix
-    gammamax = c.max()  # is from the 5P1.5 towards the 5S0.5
-    # It defines Dtmin
-    Dtmin = round(1 /(partg *gammamax), 9)
-    print('\n', Dtmin)
+    if rateMatrix is None:
+        rateMatrix = getRateMatrix(atom, temperature, includeLevelsUpTo,
+                                   maxL=maxL)
+    states, c = rateMatrix
+    riftot = len(states)
 
-    #########################################################
+    # It inizializes the reference for the population vector
+    initial = np.nonzero((states[:, 0] == STATE) & (states[:, 1] == L)
+                         & (np.abs(states[:, 2] - J) < 0.1))[0]
+    if len(initial) == 0:
+        raise ValueError("Error: state (n = %d, l = %d, j = %.1f) is not "
+                         "included in the rate matrix." % (STATE, L, J))
+    rifinitial = initial[0]
 
-    # It inizialites the population and the auxiliry population vectors
-    pop = np.zeros(shape=(1, riftot))
-    popaus = np.zeros(shape=(1, riftot))
+    # It creates the generator of the rate equations dP/dt = G P
+    generator = (c.T - diags(np.asarray(c.sum(axis=1)).ravel())).tocsr()
 
-    # It inizializes the reference for the population vector
-    if L == 0:
-        rifinitial = rifs
-    if L == 1:
-        if J == 0.5:
-            rifinitial = rifp05
-        if J == 1.5:
-            rifinitial = rifp15
-    if L == 2:
-        if J == 1.5:
-            rifinitial = rifd15
-        if J == 2.5:
-            rifinitial = rifd25
-    if L == 3:
-        if J == 2.5:
-            rifinitial = riff25
-        if J == 3.5:
-            rifinitial = riff35
-
-    pop[0, (rifinitial +STATE)] = 1
+    pop = np.zeros(riftot)
+    pop[rifinitial] = 1
 
     #########################################################
 
-    # It inizializes the time and the time step
-    t = 0.0
-    Dt = 0.0
+    # It evolves the populations
+    if times is None:
+        times = np.linspace(0, period, 1001)
+    times = np.asarray(times, dtype=np.float64)
+    populations = _evolvePopulations(generator, pop, times * 1e-6)
 
     #########################################################
-    # References for the name of the .txt file
-    if L == 0:
-        StrL = 'S'
-    elif L == 1:
-        StrL = 'P'
-    elif L == 2:
-        StrL = 'D'
-    elif L == 3:
-        StrL = 'F'
-
-    if J == 0.5:
-        StrJ = '05'
-    elif J == 1.5:
-        StrJ = '15'
-    elif J == 2.5:
-        StrJ = '25'
-    elif J == 3.5:
-        StrJ = '35'
-
-    # It creates the file for the three curves
-    with open("Lifetime" + str(STATE) +StrL+StrJ+".txt", 'w') as fi:
-        fi.writelines("")
 
+    results = {"time": times, "target": populations[:, rifinitial]}
+    if thresholdState != False:
+        # states above the threshold state; it's referred to S state, and
+        # for other series shifted by the difference of quantum defects
+        cutoff = np.array([int(atom.getQuantumDefect(STATE, 0, 0.5)
+                               - atom.getQuantumDefect(STATE, int(sl), sj))
+                           for sn, sl, sj in states])
+        aboveThreshold = states[:, 0] >= CState - cutoff
+        results["ensemble"] = populations[:, aboveThreshold].sum(axis=1)
+        results["support"] = results["ensemble"] - results["target"]
     if detailedOutput == True:
-        # It creates the file for the all states
-        with open("Lifetime" + str(STATE) +StrL+StrJ+"All.txt", 'w') as fiall:
-            fiall.writelines("")
-    #########################################################
+        results["states"] = states
+        results["populations"] = populations
 
-    # It creates four lists to quickly write the results to the file
-    ListTime = []
+    if outputFile is not None:
+        np.savez(outputFile, **results)
+
+    ListTime = list(times)
     if thresholdState != False:
-        ListRed = []
-        ListBlue = []
-    ListGreen = []
-
-    # The core of the program starts
-    while t < (totaltime):
-        if detailedOutput == True:
-            ListStates = []
-            ListStates.append(t * 1e+6)
-        for a in range(0, riftot):
-            popaus[0, a] = 0.0
-            for b in range(0, riftot):
-                popaus[0, a] += -c[a, b]*pop[0, a] + c[b,a]*pop[0,b]
-            popaus[0, a] = popaus[0, a] *Dt
-        pop += popaus
-        if t == 0:
-            Dt = Dtmin
-        if detailedOutput == True:
-            ListStates.extend(pop[0, :])
-            with open("Lifetime" + str(STATE) +StrL+StrJ+"All.txt", 'a') as fall:
-                fall.writelines("%.5f \t" % (ListStates[ind]) for ind in range(0, len(ListStates)))
-                fall.writelines("\n")
-        ListTime.append(t * 1e+6)
-        if thresholdState != False:
-            popall = 0.0
-            for k in range(0, riftot):
-                if ((CState + rifs-cutoffs <= k < rifp05+extraL[0])
-                    or (CState+rifp05-cutoffp05 <= k < rifp15+extraL[0])
-                    or (CState+rifp15-cutoffp15 <= k < rifd15+extraL[0])
-                    or (CState+rifd15-cutoffd15 <= k < rifd25+extraL[0])
-                    or (CState+rifd25-cutoffd25 <= k < riff25+extraL[0])
-                    or (CState+riff25-cutofff25 <= k < riff35+extraL[0])
-                    or (CState+riff35-cutofff35 <= k < riftot)):
-                    # above the threshold state
-                    popall += pop[0, k]
-            ListRed.append(popall)
-            ListBlue.append(popall - pop[0, (rifinitial + STATE)])
-        ListGreen.append(pop[0, (rifinitial + STATE)])
-        sys.stdout.write("\rProgress: %d%%" % ((t / totaltime) * 100))
-        sys.stdout.flush()
-        t = t + Dt
-
-    if thresholdState == False:
-        with open("Lifetime" + str(STATE) +StrL+StrJ+".txt", 'a') as f:
-            f.writelines("%.4f \t %.5f \n" %
-                (ListTime[index], ListGreen[index]) for index in range(0, len(ListTime)))
-    else:
-        with open("Lifetime" + str(STATE) +StrL+StrJ+".txt", 'a') as f:
-            f.writelines("%.4f \t %.5f \t %.5f \t %.5f \n" %
-                (ListTime[index], ListRed[index], ListBlue[index],
-                 ListGreen[index]) for index in range(0,len(ListTime)))
+        ListRed = list(results["ensemble"])
+        ListBlue = list(results["support"])
+    ListGreen = list(results["target"])
 
     #########################################################
 
@@ -656,4 +508,98 @@ def getPopulationLifetime(atom, n, l, j,
     # It returns the time elapsed
     print('\nIt took', time.time() - start, 'seconds.')
 
-    return
+    return results
+
+
+def getRateMatrix(atom, temperature, includeLevelsUpTo, maxL=3):
+    r"""
+    Matrix of transition rates between all the states of the atom, due to
+    spontaneous and black body induced transitions.
+
+    States included are all :math:`n,l,j` states with orbital angular
+    momentum :math:`l \le` `maxL` and principal quantum number up to
+    `includeLevelsUpTo`, starting from the lowest of the ground state and
+    the :obj:`extraLevels` of the atom. States that are below the ground
+    state, and are not among the :obj:`extraLevels`, are kept in the list of
+    states (so that each series of states starts from the same principal
+    quantum number), but are not coupled to any other state.
+
+    Rates of all dipole allowed transitions are calculated together, with
+    `getTransitionRates`, and the same matrix can be used in
+    :obj:`getPopulationLifetime` for any initial state and threshold state.
+
+    Args:
+        atom: atom type (e.g. `Rubidium()`)
+        temperature (float): Temperature at which the atom environment
+            is, measured in K.
+        includeLevelsUpTo (int): maximum principal quantum number of the
+            states included.
+        maxL (int): optional. Maximum orbital angular momentum of the states
+            included. By default 3 (S, P, D and F states).
+
+    Returns:
+        states, rates: array of states, with rows (n, l, j), ordered by
+        series (l, and then j) and then by principal quantum number;
+        and sparse matrix of transition rates (in s :math:`{}^{-1}`), where
+        element [a, b] is the rate of transition from state a to state b.
+
+    Example:
+        >>> rates = getRateMatrix(atom, 300, 30)
+        >>> for n in range(20, 26):
+        >>>     getPopulationLifetime(atom, n, 0, 0.5, temperature=300,
+                    includeLevelsUpTo=30, plotting=0, rateMatrix=rates)
+    """
+    extraLevels = [list(state[:3]) for state in atom.extraLevels]
+    nMin = min([atom.groundStateN] + [state[0] for state in extraLevels])
+
+    # series of states, ordered by l and then by j
+    states = []
+    for l in xrange(maxL + 1):
+        for j in (l - 0.5, l + 0.5):
+            if j < 0:
+                continue
+            for n in xrange(max(nMin, l + 1), includeLevelsUpTo + 1):
+                states.append((n, l, j))
+    states = np.array(states, dtype=np.float64).reshape(-1, 3)
+    coupled = np.array([(sn >= atom.groundStateN)
+                        or ([sn, sl, sj] in extraLevels)
+                        for sn, sl, sj in states], dtype=bool)
+
+    # all dipole allowed transitions between coupled states
+    a, b = np.nonzero(coupled[:, None] & coupled[None, :]
+                      & (np.abs(states[:, None, 1] - states[None, :, 1]) == 1)
+                      & (np.abs(states[:, None, 2] - states[None, :, 2]) < 1.1))
+    rates = atom.getTransitionRates(states[a, 0], states[a, 1], states[a, 2],
+                                    states[b, 0], states[b, 1], states[b, 2],
+                                    temperature)
+    rates = csr_matrix((rates, (a, b)), shape=(len(states), len(states)))
+    return states, rates
+
+
+def _evolvePopulations(generator, population, times):
+    """
+    Populations at given times for rate equations :math:`dP/dt = G P`.
+
+    Args:
+        generator (sparse matrix): generator :math:`G` of the rate equations
+        population (array): populations at time 0
+        times (array): increasing times (in s)
+
+    Returns:
+        array: populations, indexed [time, state]
+    """
+    if len(times) == 0:
+        return np.zeros((0, len(population)))
+    populations = np.zeros((len(times), len(population)))
+    step = np.diff(times)
+    if len(times) > 2 and np.allclose(step, step[0], rtol=1e-9, atol=0):
+        # equally spaced times
+        populations[:] = expm_multiply(generator, population,
+                                       start=times[0], stop=times[-1],
+                                       num=len(times), endpoint=True)
+        return populations
+    populations[0] = expm_multiply(generator * times[0], population)
+    for i in xrange(1, len(times)):
+        populations[i] = expm_multiply(generator * step[i - 1],
+                                       populations[i - 1])
+    return populations
@@ -24,6 +24,10 @@ from mpmath import angerj
 import numpy as np
 import re
 import shutil
+import json
+import importlib
+import zipfile
+import tempfile
 
 from .wigner import Wigner6j, Wigner3j, CG, WignerDmatrix
 from scipy.constants import physical_constants, pi, epsilon_0, hbar
@@ -34,7 +38,7 @@ from scipy.constants import e as C_e
 from scipy.constants import m_e as C_m_e
 
 # for matrices
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, issparse
 from scipy import floor
 
 import sys
@@ -187,6 +191,11 @@ class AlkaliAtom(object):
     #: uses measured energy levels otherwise
     minQuantumDefectN = 0
 
+    #: maximal principal quantum number of the states whose energies are
+    #: tabulated for fast look-up (see :obj:`getEnergyTable`). Energies of
+    #: states above this value are calculated directly by :obj:`getEnergy`.
+    energyTableNmax = 200
+
     def __init__(self, preferQuantumDefects=True, cpp_numerov=True):
         # should the wavefunction be calculated with Numerov algorithm
         # implemented in C; if false, it uses Python implementation
@@ -195,6 +204,9 @@ class AlkaliAtom(object):
         self.cpp_numerov = cpp_numerov
         self.preferQuantumDefects = preferQuantumDefects
 
+        # state lifetimes that are already calculated (see getStateLifetime)
+        self._stateLifetimes = {}
+
         self._databaseInit()
         c = self.conn.cursor()
 
@@ -605,8 +617,9 @@ class AlkaliAtom(object):
         """
         if s2 is None:
             s2 = s
-        return (C_h * C_c) / ((self.getEnergy(n2, l2, j2, s=s2)
-                               - self.getEnergy(n1, l1, j1, s=s)) * C_e)
+        return (C_h * C_c) / ((self._getTabulatedEnergy(n2, l2, j2, s=s2)
+                               - self._getTabulatedEnergy(n1, l1, j1, s=s))
+                              * C_e)
 
     def getTransitionFrequency(self, n1, l1, j1, n2, l2, j2, s=0.5, s2=None):
         """
@@ -641,8 +654,8 @@ class AlkaliAtom(object):
         """
         if s2 is None:
             s2 = s
-        return (self.getEnergy(n2, l2, j2, s=s2)
-                - self.getEnergy(n1, l1, j1, s=s)) * C_e / C_h
+        return (self._getTabulatedEnergy(n2, l2, j2, s=s2)
+                - self._getTabulatedEnergy(n1, l1, j1, s=s)) * C_e / C_h
 
     def getEnergy(self, n, l, j, s=0.5):
         """
@@ -733,6 +746,212 @@ class AlkaliAtom(object):
                 modifiedRRcoef[5] / ((n - modifiedRRcoef[0])**10)
         return defect
 
+    def getEnergies(self, n, l, j, s=0.5):
+        """
+            Energies of many levels relative to the ionisation level (in eV)
+
+            Vectorized version of :obj:`getEnergy`. Quantum numbers can be
+            given as numbers or arrays, which are broadcast against each other.
+            Measured (NIST) energies and energies calculated from quantum
+            defects are selected with the same rules as in :obj:`getEnergy`.
+
+            Args:
+                n (array of int): principal quantum numbers
+                l (array of int): orbital angular momenta
+                j (array of float): total angular momenta
+                s (array of float): optional, total spin angular momentum.
+                    Default value of 0.5 is correct for Alkali atoms, and has
+                    to be specified explicitly for divalent atoms.
+
+            Returns:
+                numpy.ndarray: state energies (eV), with the broadcast shape
+                of the input quantum numbers
+        """
+        return self._getEnergies(n, l, j, s=s)[0]
+
+    def _getEnergies(self, n, l, j, s=0.5):
+        # returns energies, and mask of the energies extrapolated outside of
+        # the quantum defect fitting range (never the case for AlkaliAtom)
+        n, l, j, s = _broadcastQuantumNumbers(n, l, j, s)
+        if np.any(l >= n):
+            i = np.argmax(l >= n)
+            raise ValueError(
+                "Requested energy for state l=%d >= n=%d !" % (l[i], n[i]))
+
+        savedEnergy = self._getSavedEnergies(n, l, j, s=s)
+        useNIST = (n <= self.NISTdataLevels) & (np.abs(savedEnergy) > 1e-8)
+        if self.preferQuantumDefects:
+            useNIST &= (n < self.minQuantumDefectN)
+
+        energy = np.array(savedEnergy, dtype=np.float64)
+        qd = ~useNIST
+        defect = self.getQuantumDefects(n[qd], l[qd], j[qd], s=s[qd])
+        energy[qd] = -self.scaledRydbergConstant / ((n[qd] - defect)**2)
+        return energy, np.zeros(n.shape, dtype=bool)
+
+    def _getSavedEnergies(self, n, l, j, s=0.5):
+        # vectorized _getSavedEnergy; missing measurements are returned as 0
+        lower = np.abs(j - (l - 0.5)) < 0.001
+        upper = np.abs(j - (l + 0.5)) < 0.001
+        if not np.all(lower | upper):
+            i = np.argmax(~(lower | upper))
+            raise ValueError("j (=%.1f) is not equal to l+1/2 nor l-1/2 (l=%d)"
+                             % (j[i], l[i]))
+        savedEnergy = np.zeros(n.shape)
+        inTable = (n <= self.NISTdataLevels) & (l <= self.NISTdataLevels)
+        # sEnergy[n, l] for j = l-1/2 and sEnergy[l, n] for j = l+1/2
+        sel = lower & inTable
+        savedEnergy[sel] = self.sEnergy[n[sel], l[sel]]
+        sel = upper & ~lower & inTable
+        savedEnergy[sel] = self.sEnergy[l[sel], n[sel]]
+        return savedEnergy
+
+    def getQuantumDefects(self, n, l, j, s=0.5):
+        """
+            Quantum defects of many levels.
+
+            Vectorized version of :obj:`getQuantumDefect`. Quantum numbers can
+            be given as numbers or arrays, which are broadcast against each
+            other.
+
+            Args:
+                n (array of int): principal quantum numbers
+                l (array of int): orbital angular momenta
+                j (array of float): total angular momenta
+                s (array of float): (optional). Total spin angular momentum.
+                    Default value of 0.5 correct for Alkali atoms. For divalent
+                    atoms it has to be explicitly defined.
+
+            Returns:
+                numpy.ndarray: quantum defects
+        """
+        n, l, j, s = _broadcastQuantumNumbers(n, l, j, s)
+        defect = np.zeros(n.shape)
+
+        lowL = l < 5
+        if not np.any(lowL):
+            return defect
+        # modified Rydberg-Ritz coefficients for each of the requested states
+        series = np.rint(np.floor(s) + s + j - l).astype(int)[lowL]
+        modifiedRRcoef = self._getQuantumDefectTable()[series, l[lowL]]
+        if self.Z != 1:
+            unknown = (l[lowL] < 3) & (np.abs(modifiedRRcoef[:, 0]) < 1e-9)
+            if np.any(unknown):
+                i = np.argmax(unknown)
+                raise ValueError("Quantum defects for requested state "
+                                 + ("(n = %d, l = %d, j = %.1f, s=%.1f) are"
+                                    % (n[lowL][i], l[lowL][i], j[lowL][i],
+                                       s[lowL][i]))
+                                 + " uknown. Aborting calculation.")
+        x = 1. / (n[lowL] - modifiedRRcoef[:, 0])**2
+        # Horner's scheme for the series in 1/(n-delta_0)^2
+        series = modifiedRRcoef[:, 5]
+        for k in xrange(4, 0, -1):
+            series = series * x + modifiedRRcoef[:, k]
+        defect[lowL] = modifiedRRcoef[:, 0] + series * x
+        return defect
+
+    def _getQuantumDefectTable(self):
+        # quantumDefect as a float array of shape (series, l < 5, 6); rows of
+        # the (possibly ragged) table are truncated to the 6 coefficients
+        # used by getQuantumDefect, or padded with nan if they are shorter
+        if getattr(self, "_quantumDefectTable", None) is None:
+            table = np.full((len(self.quantumDefect), 5, 6), np.nan)
+            for series, coefficients in enumerate(self.quantumDefect):
+                for l in xrange(min(len(coefficients), 5)):
+                    row = coefficients[l][:6]
+                    table[series, l, :len(row)] = row
+            self._quantumDefectTable = table
+        return self._quantumDefectTable
+
+    def getEnergyTable(self, s=0.5):
+        """
+            Table of state energies relative to the ionisation level (in eV)
+
+            Table is calculated (with :obj:`getEnergies`) on the first call
+            for a given spin, for all states with principal quantum number up
+            to :obj:`energyTableNmax`, and is reused in all subsequent calls.
+            Energy of the state :math:`n,l,j` is stored at index
+            `[n, l, j - l + s]`. Entries that don't correspond to a state,
+            or to a state whose energy can't be calculated, are `nan`.
+
+            Args:
+                s (float): optional, total spin angular momentum. Default value
+                    of 0.5 is correct for Alkali atoms, and has to be specified
+                    explicitly for divalent atoms.
+
+            Returns:
+                numpy.ndarray: array of shape
+                (:obj:`energyTableNmax` +1, :obj:`energyTableNmax`, 2s+1)
+                with state energies (eV)
+        """
+        return self._getEnergyTable(s)[0]
+
+    def _getEnergyTable(self, s):
+        # returns table of energies, and table marking energies extrapolated
+        # outside of quantum defect fitting range
+        if getattr(self, "_energyTables", None) is None:
+            self._energyTables = {}
+        key = int(round(2 * s))
+        if key in self._energyTables:
+            return self._energyTables[key]
+
+        nMax = self.energyTableNmax
+        table = np.full((nMax + 1, nMax, key + 1), np.nan)
+        extrapolated = np.zeros(table.shape, dtype=bool)
+        for l in xrange(nMax):
+            n = np.arange(l + 1, nMax + 1)
+            for k in xrange(key + 1):
+                j = l - s + k
+                if j < -0.1:
+                    continue
+                try:
+                    table[n, l, k], extrapolated[n, l, k] = \
+                        self._getEnergies(n, l, j, s=s)
+                except ValueError:
+                    # energies for this series can't be calculated (e.g.
+                    # quantum defects are unknown); leave them undefined
+                    pass
+        self._energyTables[key] = (table, extrapolated)
+        return self._energyTables[key]
+
+    def _getTabulatedEnergy(self, n, l, j, s=0.5):
+        """
+            Energy of the level relative to the ionisation level (in eV)
+
+            Same as :obj:`getEnergy`, but reads the value from the table
+            of energies (see :obj:`getEnergyTable`), falling back to
+            :obj:`getEnergy` for states that are not tabulated.
+        """
+        if 0 <= l < n <= self.energyTableNmax:
+            table, extrapolated = self._getEnergyTable(s)
+            k = int(round(j - l + s))
+            if 0 <= k < table.shape[2]:
+                energy = table[int(n), int(l), k]
+                if not np.isnan(energy):
+                    if extrapolated[int(n), int(l), k]:
+                        self.energyLevelsExtrapolated = True
+                    return energy
+        return self.getEnergy(n, l, j, s=s)
+
+    def _getTabulatedEnergies(self, n, l, j, s=0.5):
+        # vectorized _getTabulatedEnergy, for states with the same spin s
+        n, l, j, _ = _broadcastQuantumNumbers(n, l, j, s)
+        table, extrapolated = self._getEnergyTable(s)
+        k = np.rint(j - l + s).astype(int)
+        inTable = (0 <= l) & (l < n) & (n <= self.energyTableNmax) \
+            & (0 <= k) & (k < table.shape[2])
+        index = (n[inTable], l[inTable], k[inTable])
+        energy = np.full(n.shape, np.nan)
+        energy[inTable] = table[index]
+        if np.any(extrapolated[index]):
+            self.energyLevelsExtrapolated = True
+        missing = np.isnan(energy)
+        if np.any(missing):
+            energy[missing] = self.getEnergies(n[missing], l[missing],
+                                               j[missing], s=s)
+        return energy
+
     def getRadialMatrixElement(self,
                                n1, l1, j1,
                                n2, l2, j2,
@@ -1330,9 +1549,9 @@ class AlkaliAtom(object):
             Returns:
                 float:  energy defect (SI units: J)
         """
-        return C_e * (self.getEnergy(n1, l1, j1, s=s)
-                      + self.getEnergy(n2, l2, j2, s=s)
-                      - 2 * self.getEnergy(n, l, j, s=s))
+        return C_e * (self._getTabulatedEnergy(n1, l1, j1, s=s)
+                      + self._getTabulatedEnergy(n2, l2, j2, s=s)
+                      - 2 * self._getTabulatedEnergy(n, l, j, s=s))
 
     def getEnergyDefect2(self, n, l, j, nn, ll, jj, n1, l1, j1, n2, l2, j2,
                          s=0.5):
@@ -1367,10 +1586,10 @@ class AlkaliAtom(object):
             Returns:
                 float:  energy defect (SI units: J)
         """
-        return C_e * (self.getEnergy(n1, l1, j1, s=s)
-                      + self.getEnergy(n2, l2, j2, s=s)
-                      - self.getEnergy(n, l, j, s=s)
-                      - self.getEnergy(nn, ll, jj, s=s))
+        return C_e * (self._getTabulatedEnergy(n1, l1, j1, s=s)
+                      + self._getTabulatedEnergy(n2, l2, j2, s=s)
+                      - self._getTabulatedEnergy(n, l, j, s=s)
+                      - self._getTabulatedEnergy(nn, ll, jj, s=s))
 
     def updateDipoleMatrixElementsFile(self):
         """
@@ -1456,9 +1675,12 @@ class AlkaliAtom(object):
 
         degeneracyTerm = 1.
 
+        transitionFrequency = self.getTransitionFrequency(n1, l1, j1,
+                                                          n2, l2, j2,
+                                                          s=s, s2=s)
+
         # find dipoleRadialPart
-        if (self.getTransitionFrequency(n1, l1, j1, n2, l2, j2,
-                                        s=s, s2=s) > 0):
+        if (transitionFrequency > 0):
             dipoleRadialPart = self.getReducedMatrixElementJ_asymmetric(
                 n1, l1, j1,
                 n2, l2, j2,
@@ -1473,13 +1695,10 @@ class AlkaliAtom(object):
                 C_e * (physical_constants["Bohr radius"][0])
             degeneracyTerm = (2. * j2 + 1.0) / (2. * j1 + 1.)
 
-        omega = abs(
-            2.0 * pi * self.getTransitionFrequency(n1, l1, j1, n2, l2, j2,
-                                                   s=s, s2=s))
+        omega = abs(2.0 * pi * transitionFrequency)
 
         modeOccupationTerm = 0.
-        if (self.getTransitionFrequency(n1, l1, j1, n2, l2, j2,
-                                        s=s, s2=s) < 0):
+        if (transitionFrequency < 0):
             modeOccupationTerm = 1.
 
         # only possible by absorbing thermal photons ?
@@ -1491,6 +1710,91 @@ class AlkaliAtom(object):
             (3 * pi * epsilon_0 * hbar * C_c**3)\
             * degeneracyTerm * modeOccupationTerm
 
+    def getTransitionRates(self, n1, l1, j1, n2, l2, j2, temperature=0.,
+                           s=0.5):
+        """
+            Transition rates due to coupling to vacuum modes for many
+            transitions (black body included)
+
+            Vectorized version of :obj:`getTransitionRate`. Quantum numbers of
+            initial and final states, and temperature, can be given as numbers
+            or arrays, which are broadcast against each other. State energies
+            are read from the table of energies, and each distinct Wigner 6j
+            symbol and radial matrix element is calculated only once.
+
+            Args:
+                n1 (int or array): principal quantum number
+                l1 (int or array): orbital angular momentum
+                j1 (float or array): total angular momentum
+                n2 (int or array): principal quantum number
+                l2 (int or array): orbital angular momentum
+                j2 (float or array): total angular momentum
+                [temperature] (float or array): temperature in K
+                s (float): optional, total spin angular momentum of state.
+                    By default 0.5 for Alkali atoms.
+
+            Returns:
+                array: transition rates in s :math:`{}^{-1}` (SI), with the
+                broadcast shape of the inputs
+        """
+        n1, l1, j1, n2, l2, j2 = np.broadcast_arrays(n1, l1, j1, n2, l2, j2)
+        shape = n1.shape
+        n1, l1, j1, n2, l2, j2 = [np.asarray(x, dtype=np.float64).ravel()
+                                  for x in (n1, l1, j1, n2, l2, j2)]
+
+        transitionFrequency = (self._getTabulatedEnergies(n2, l2, j2, s=s)
+                               - self._getTabulatedEnergies(n1, l1, j1, s=s)) \
+            * C_e / C_h
+
+        # dipole matrix element is evaluated from the lower to the upper state
+        down = transitionFrequency <= 0
+        na, la, ja = [np.where(down, b, a)
+                      for a, b in ((n1, n2), (l1, l2), (j1, j2))]
+        nb, lb, jb = [np.where(down, a, b)
+                      for a, b in ((n1, n2), (l1, l2), (j1, j2))]
+
+        def number(x):
+            # integer angular momenta as int, as for tabulated Wigner symbols
+            return int(x) if x == round(x) else float(x)
+
+        wigner = np.zeros(len(n1))
+        radial = np.zeros(len(n1))
+        if len(n1) > 0:
+            unique, inverse = np.unique(np.stack((la, lb, ja, jb), axis=-1),
+                                        axis=0, return_inverse=True)
+            wigner = np.array([Wigner6j(int(t[0]), int(t[1]), 1,
+                                        number(t[3]), number(t[2]),
+                                        number(s))
+                               for t in unique])[inverse.reshape(-1)]
+            unique, inverse = np.unique(
+                np.stack((na, la, ja, nb, lb, jb), axis=-1),
+                axis=0, return_inverse=True)
+            radial = np.array([
+                self.getRadialMatrixElement(int(t[0]), int(t[1]), t[2],
+                                            int(t[3]), int(t[4]), t[5], s=s)
+                for t in unique], dtype=np.float64)[inverse.reshape(-1)]
+
+        # square of the reduced dipole matrix element (Steck notation)
+        dipoleRadialPart2 = (2. * jb + 1.) * np.maximum(la, lb) \
+            * wigner**2 * radial**2 \
+            * (C_e * physical_constants["Bohr radius"][0])**2
+        degeneracyTerm = np.where(down, (2. * j2 + 1.) / (2. * j1 + 1.), 1.)
+
+        omega = np.abs(2.0 * pi * transitionFrequency).reshape(shape)
+        prefactor = (dipoleRadialPart2 * degeneracyTerm).reshape(shape) \
+            / (3 * pi * epsilon_0 * hbar * C_c**3)
+
+        temperature = np.asarray(temperature, dtype=np.float64)
+        modeOccupationTerm = np.zeros(np.broadcast(omega, temperature).shape)
+        modeOccupationTerm += (transitionFrequency < 0).reshape(shape)
+        # only possible by absorbing thermal photons ?
+        omega, temperature = np.broadcast_arrays(omega, temperature)
+        thermal = (hbar * omega < 100 * C_k * temperature) & (omega > 1e2)
+        modeOccupationTerm[thermal] += 1. / np.expm1(
+            hbar * omega[thermal] / (C_k * temperature[thermal]))
+
+        return omega**3 * prefactor * modeOccupationTerm
+
     def getStateLifetime(self, n, l, j, temperature=0, includeLevelsUpTo=0,
                          s=0.5):
         """
@@ -1522,6 +1826,11 @@ class AlkaliAtom(object):
                     By default 0.5 for Alkali atoms.
 
 
+            Calculated lifetimes are stored for the atom, so repeated calls
+            for the same state, temperature and `includeLevelsUpTo` (e.g.
+            from :obj:`DynamicPolarizability` for different target states
+            sharing the same basis) return the stored value.
+
             Returns:
                 float:
                     State lifetime in units of s (seconds)
@@ -1541,54 +1850,190 @@ class AlkaliAtom(object):
         elif (temperature < 0.1):
             includeLevelsUpTo = max(n, self.groundStateN)
 
-        transitionRate = 0.
-
-        for nto in xrange(max(self.groundStateN, l), includeLevelsUpTo + 1):
-
-            # sum over all l-1
-            if l > 0:
-                lto = l - 1
-                if lto > j - 0.5 - 0.1:
-                    jto = j
-                    transitionRate += self.getTransitionRate(n, l, j,
-                                                             nto, lto, jto,
-                                                             temperature,
-                                                             s=s)
-                jto = j - 1.
-                if jto > 0:
-                    transitionRate += self.getTransitionRate(n, l, j,
-                                                             nto, lto, jto,
-                                                             temperature,
-                                                             s=s)
-
-        for nto in xrange(max(self.groundStateN, l + 2),
-                          includeLevelsUpTo + 1):
-            # sum over all l+1
-            lto = l + 1
-            if lto - 0.5 - 0.1 < j:
-                jto = j
-                transitionRate += self.getTransitionRate(n, l, j,
-                                                         nto, lto, jto,
-                                                         temperature,
-                                                         s=s)
-            jto = j + 1
-            transitionRate += self.getTransitionRate(n, l, j,
-                                                     nto, lto, jto,
-                                                     temperature,
-                                                     s=s)
-        # sum over additional states
+        key = (int(n), int(l), int(round(2 * j)), int(round(2 * s)),
+               float(temperature), int(includeLevelsUpTo))
+        if getattr(self, "_stateLifetimes", None) is None:
+            # e.g. atom restored from pickle made before lifetimes were cached
+            self._stateLifetimes = {}
+        if key in self._stateLifetimes:
+            return self._stateLifetimes[key]
+
+        nto, lto, jto = self._getDecayChannels(n, l, j, includeLevelsUpTo)
+        transitionRate = np.sum(self.getTransitionRates(n, l, j,
+                                                        nto, lto, jto,
+                                                        temperature,
+                                                        s=s))
+
+        # add something small decay (1e-50) rate to prevent division by zero
+        lifetime = 1. / (transitionRate + 1e-50)
+        self._stateLifetimes[key] = lifetime
+        return lifetime
+
+    def getStateLifetimes(self, nList, lList, jList=None, temperatures=0.,
+                          includeLevelsAbove=0, s=0.5):
+        """
+            Returns the table of lifetimes (in s) for many states and
+            temperatures
+
+            Calculates lifetimes for all states :math:`n,l,j` with
+            :math:`n` in `nList`, :math:`l` in `lList` and :math:`j` in
+            `jList`, at all the given temperatures. Transition rates to all
+            the states coupled to any of the requested states are calculated
+            together, so that Wigner 6j symbols and radial matrix elements
+            shared between the states are evaluated only once, and all
+            temperatures are obtained by broadcasting black-body occupation
+            factors. Results are the same as calling :obj:`getStateLifetime`
+            for each of the states and temperatures.
+
+            Args:
+                nList (list of int): principal quantum numbers
+                lList (list of int): orbital angular momenta
+                jList (list of float): optional, total angular momenta. By
+                    default all :math:`j` allowed for given :math:`l` and
+                    :math:`s` are used. States with :math:`l \\ge n`, or
+                    with :math:`j` not allowed for given :math:`l`, are
+                    skipped.
+                temperatures (float or list of float): optional, temperatures
+                    in K. Default is 0.
+                includeLevelsAbove (int): needed for non-zero temperatures.
+                    Black-body induced transitions are included to the states
+                    with principal quantum number up to :math:`n` +
+                    `includeLevelsAbove`, where :math:`n` is principal
+                    quantum number of the state whose lifetime is calculated
+                    (see `includeLevelsUpTo` in :obj:`getStateLifetime`).
+                s (float): optional, total spin angular momentum of states.
+                    By default 0.5 for Alkali atoms.
+
+            Returns:
+                numpy.ndarray:
+                    structured array with fields `n`, `l`, `j`,
+                    `temperature` and `lifetime` (in s), with one record for
+                    each state and temperature, ordered by state and then
+                    by temperature.
+
+            Example:
+                Lifetimes of Rubidium nS, nP and nD states at 0 K and 300 K::
+
+                    atom = Rubidium()
+                    table = atom.getStateLifetimes(range(20, 151), [0, 1, 2],
+                                                   temperatures=[0, 300],
+                                                   includeLevelsAbove=50)
+                    roomTemperature = table[table["temperature"] == 300]
+                    plt.plot(roomTemperature["n"], roomTemperature["lifetime"])
+
+            See also:
+                :obj:`getStateLifetime` for lifetime of individual state
+        """
+        temperatures = np.atleast_1d(np.asarray(temperatures,
+                                                dtype=np.float64)).ravel()
+        if np.any(temperatures > 0.1) and includeLevelsAbove < 1:
+            raise ValueError(
+                "For non-zero temperatures, user has to specify "
+                + "how many principal quantum numbers *above* the "
+                + "state for which we are calculating the lifetime should be "
+                + "included (includeLevelsAbove). This is in order to include "
+                + "black-body induced transitions to higher lying up in "
+                + "energy levels.")
+
+        states = []
+        for n in nList:
+            for l in lList:
+                if l >= n:
+                    continue
+                allowed = np.arange(abs(l - s), l + s + 0.1)
+                if jList is None:
+                    jValues = allowed
+                else:
+                    jValues = [j for j in jList
+                               if np.any(np.abs(allowed - j) < 0.1)]
+                for j in jValues:
+                    states.append((n, l, j))
+
+        # decay channels of all the states, labeled by the initial state
+        initial = []
+        channels = []
+        for i, (n, l, j) in enumerate(states):
+            if np.any(temperatures > 0.1):
+                includeLevelsUpTo = n + includeLevelsAbove
+            else:
+                includeLevelsUpTo = max(n, self.groundStateN)
+            channel = np.stack(self._getDecayChannels(n, l, j,
+                                                      includeLevelsUpTo))
+            channels.append(channel)
+            initial.append(np.full(channel.shape[1], i))
+        initial = np.concatenate([np.zeros(0, dtype=int)] + initial)
+        channels = np.concatenate([np.zeros((3, 0))] + channels, axis=1)
+        # at zero temperature only levels up to n are included, as in
+        # getStateLifetime
+        zeroTemperatureLimit = np.maximum(
+            np.array([state[0] for state in states], dtype=int),
+            self.groundStateN)[initial]
+        excluded = (channels[0] > zeroTemperatureLimit)[:, None] \
+            & (temperatures < 0.1)[None, :]
+        nInitial, lInitial, jInitial = \
+            np.array(states, dtype=np.float64).reshape(-1, 3)[initial].T
+
+        rates = self.getTransitionRates(nInitial[:, None], lInitial[:, None],
+                                        jInitial[:, None],
+                                        channels[0][:, None],
+                                        channels[1][:, None],
+                                        channels[2][:, None],
+                                        temperatures[None, :], s=s)
+        rates[excluded] = 0.
+        # total decay rate of each state
+        transitionRate = np.zeros((len(states), len(temperatures)))
+        np.add.at(transitionRate, initial, rates)
+
+        table = np.zeros((len(states), len(temperatures)),
+                         dtype=[("n", int), ("l", int), ("j", float),
+                                ("temperature", float),
+                                ("lifetime", float)])
+        if len(states) > 0:
+            n, l, j = np.array(states, dtype=np.float64).T
+            table["n"] = n[:, None]
+            table["l"] = l[:, None]
+            table["j"] = j[:, None]
+        table["temperature"] = temperatures[None, :]
+        # add something small decay (1e-50) rate to prevent division by zero
+        table["lifetime"] = 1. / (transitionRate + 1e-50)
+        return table.ravel()
+
+    def _getDecayChannels(self, n, l, j, includeLevelsUpTo):
+        """
+            States to which the state :math:`n,l,j` is coupled by dipole
+            transitions, with principal quantum number up to
+            `includeLevelsUpTo`, and all the :obj:`extraLevels` it is
+            coupled to.
+
+            Returns:
+                arrays of principal quantum numbers, orbital and total
+                angular momenta of the coupled states
+        """
+        channels = []
+
+        def addChannels(nMin, lto, jto):
+            nto = np.arange(nMin, includeLevelsUpTo + 1)
+            channels.append(np.stack(np.broadcast_arrays(nto, lto, jto)))
+
+        # all l-1
+        if l > 0:
+            lto = l - 1
+            if lto > j - 0.5 - 0.1:
+                addChannels(max(self.groundStateN, l), lto, j)
+            if j - 1. > 0:
+                addChannels(max(self.groundStateN, l), lto, j - 1.)
+        # all l+1
+        lto = l + 1
+        if lto - 0.5 - 0.1 < j:
+            addChannels(max(self.groundStateN, l + 2), lto, j)
+        addChannels(max(self.groundStateN, l + 2), lto, j + 1.)
+        # additional states
         for state in self.extraLevels:
             if (abs(j - state[2]) < 1.1) and \
                     (abs(state[1] - l) < 1.1) and (abs(state[1] - l) > 0.9):
-                transitionRate += self.getTransitionRate(
-                    n, l, j,
-                    state[0], state[1], state[2],
-                    temperature,
-                    s=s
-                    )
-
-        # add something small decay (1e-50) rate to prevent division by zero
-        return 1. / (transitionRate + 1e-50)
+                channels.append(np.array(state[:3], dtype=np.float64)[:, None])
+        channels = np.concatenate([np.zeros((3, 0))] + channels, axis=1)
+        return channels[0], channels[1], channels[2]
 
     def getRadialCoupling(self, n, l, j, n1, l1, j1, s=0.5):
         """
@@ -1623,6 +2068,41 @@ class AlkaliAtom(object):
             # neglect octopole coupling and higher
             return 0
 
+    def getRadialCouplings(self, n, l, j, n1, l1, j1, s=0.5):
+        """
+            Radial parts of the couplings between many pairs of states
+
+            Vectorized version of :obj:`getRadialCoupling`. Quantum numbers
+            can be given as numbers or arrays that are broadcasted together.
+            Each distinct coupling is looked up (or calculated) only once.
+
+            Args:
+                n (int or array): principal quantum number
+                l (int or array): orbital angular momentum
+                j (float or array): total angular momentum
+                n1 (int or array): principal quantum number
+                l1 (int or array): orbital angular momentum
+                j1 (float or array): total angular momentum
+                s (float): optional, total spin angular momentum of state.
+                    By default 0.5 for Alkali atoms.
+
+            Returns:
+                array: radial coupling strengths (in a.u.), or zeros for
+                forbidden transitions in dipole and quadrupole approximation.
+        """
+        n, l, j, n1, l1, j1 = np.broadcast_arrays(n, l, j, n1, l1, j1)
+        transitions = np.stack((n, l, j, n1, l1, j1),
+                               axis=-1).astype(np.float64).reshape(-1, 6)
+        if transitions.shape[0] == 0:
+            return np.zeros(n.shape)
+        unique, inverse = np.unique(transitions, axis=0, return_inverse=True)
+        couplings = np.array([
+            self.getRadialCoupling(int(round(t[0])), int(round(t[1])), t[2],
+                                   int(round(t[3])), int(round(t[4])), t[5],
+                                   s=s)
+            for t in unique], dtype=np.float64)
+        return couplings[inverse.reshape(-1)].reshape(n.shape)
+
     def getAverageSpeed(self, temperature):
         """
             Average (mean) speed at a given temperature
@@ -2118,6 +2598,17 @@ def _atomLightAtomCoupling(n, l, j, nn, ll, jj, n1, l1, j1, n2, l2, j2,
     return coupling
 
 
+def _broadcastQuantumNumbers(n, l, j, s):
+    """
+        Broadcasts quantum numbers (numbers or arrays) to arrays of common
+        shape, with integer `n` and `l`, and float `j` and `s`.
+    """
+    n, l, j, s = np.broadcast_arrays(np.asarray(n), np.asarray(l),
+                                     np.asarray(j), np.asarray(s))
+    return (np.rint(n).astype(int), np.rint(l).astype(int),
+            np.asarray(j, dtype=np.float64), np.asarray(s, dtype=np.float64))
+
+
 # ================== Saving and loading calculations (START) ==================
 
 def saveCalculation(calculation, fileName):
@@ -2126,8 +2617,13 @@ def saveCalculation(calculation, fileName):
 
     Saves :obj:`calculations_atom_pairstate.PairStateInteractions` and
     :obj:`calculations_atom_single.StarkMap`
-    calculations in compact binary format in file named `filename`. It uses
-    cPickle serialization library in Python, and also zips the final file.
+    calculations in a folder named `fileName`. Each array (basis, sparse
+    interaction matrices in CSR components, eigenvalues, highlights, state
+    compositions...) is saved as a separate binary `.npy` file, and the
+    description of all the attributes of the calculation is saved in
+    `metadata.json`. Saved arrays can be loaded individually, or memory
+    mapped (`np.load(file, mmap_mode="r")`), without reading the whole
+    calculation.
 
     Calculation can be retrieved and used with :obj:`loadSavedCalculation`
 
@@ -2136,13 +2632,19 @@ def saveCalculation(calculation, fileName):
             :obj:`calculations_atom_pairstate.PairStateInteractions`
             or :obj:`calculations_atom_single.StarkMap`)
             to be saved.
-        fileName: name of the file where calculation will be saved
+        fileName: name of the folder where calculation will be saved. If
+            folder already contains previously saved calculation, it will be
+            overwritten. If `fileName` is a calculation saved previously in
+            the older single-file format (zipped pickle), that file is
+            replaced by the folder (with a warning). Any other existing file
+            is not overwritten, and saving fails.
 
     Example:
         Let's suppose that we did the part of the
         :obj:`calculation_atom_pairstate.PairStateInteractions`
         calculation that involves generation of the interaction
-        matrix. After that we can save the full calculation in a single file::
+        matrix. After that we can save the full calculation in a single
+        folder::
 
             calc = PairStateInteractions(Rubidium(),
                     60,0,0.5,
@@ -2150,13 +2652,13 @@ def saveCalculation(calculation, fileName):
                     0.5,0.5)
             calc.defineBasis(0,0, 5,5, 25.e9)
             calc.diagonalise(np.linspace(0.5,10.0,200),150)
-            saveCalculation(calc, "mySavedCalculation.pkl")
+            saveCalculation(calc, "mySavedCalculation")
 
         Then, at a later time, and even on the another machine, we can load
         that file and continue with calculation. We can for example explore
         the calculated level diagram::
 
-            calc = loadSavedCalculation("mySavedCalculation.pkl")
+            calc = loadSavedCalculation("mySavedCalculation")
             calc.plotLevelDiagram()
             calc.showPlot()
             rvdw = calc.getVdwFromLevelDiagram(0.5,14,
@@ -2166,7 +2668,7 @@ def saveCalculation(calculation, fileName):
         Or, we can do additional matrix diagonalization, in some new range,
         then and find C6 by fitting the obtained level diagram::
 
-            calc = loadSavedCalculation("mySavedCalculation.pkl")
+            calc = loadSavedCalculation("mySavedCalculation")
             calc.diagonalise(np.linspace(3,6.0,200),20)
             calc.getC6fromLevelDiagram(3,6.0,showPlot=True)
 
@@ -2179,38 +2681,60 @@ def saveCalculation(calculation, fileName):
         corresponding calculations. Call the plot function before calling
         :obj:`showPlot` function for the corresponding calculation.
 
+    Note:
+        Atoms used in the calculation are saved only by their type and
+        `preferQuantumDefects` and `cpp_numerov` options. Other data stored
+        in atom instances (e.g. cached state lifetimes) is not saved, and
+        atoms are initialised again on loading.
+
     """
 
     try:
-        ax = calculation.ax
-        fig = calculation.fig
-        calculation.ax = 0
-        calculation.fig = 0
-
-        # close database connections
-        atomNumber = 0
-        if hasattr(calculation, 'atom'):
-            atomNumber = 1
-            atomDatabaseConn1 = calculation.atom.conn
-            calculation.atom.conn = False
-        elif hasattr(calculation, 'atom1'):
-            atomNumber = 2
-            atomDatabaseConn1 = calculation.atom1.conn
-            calculation.atom1.conn = False
-            atomDatabaseConn2 = calculation.atom2.conn
-            calculation.atom2.conn = False
-
-        output = gzip.GzipFile(fileName, 'wb')
-        pickle.dump(calculation, output, pickle.HIGHEST_PROTOCOL)
-        output.close()
-
-        calculation.ax = ax
-        calculation.fig = fig
-        if atomNumber == 1:
-            calculation.atom.conn = atomDatabaseConn1
-        elif atomNumber == 2:
-            calculation.atom1.conn = atomDatabaseConn1
-            calculation.atom2.conn = atomDatabaseConn2
+        if os.path.isfile(fileName):
+            with open(fileName, "rb") as f:
+                isGzipFile = (f.read(2) == b"\x1f\x8b")
+            if not isGzipFile:
+                raise ValueError("File '%s' already exists and it isn't "
+                                 "calculation saved in older format."
+                                 % fileName)
+            print("WARNING: calculation previously saved in older "
+                  "single-file format in '%s' is replaced by folder with "
+                  "calculation saved in the new format." % fileName)
+            os.remove(fileName)
+        if os.path.isdir(fileName):
+            oldFiles = _getSavedCalculationFiles(fileName)
+            if oldFiles is None:
+                raise ValueError("Folder '%s' already exists and it doesn't "
+                                 "contain saved calculation." % fileName)
+            # remove only files of the previously saved calculation
+            for file in oldFiles:
+                if os.path.isfile(os.path.join(fileName, file)):
+                    os.remove(os.path.join(fileName, file))
+        else:
+            os.makedirs(fileName)
+
+        atoms = []
+        attributes = {}
+        for name, value in vars(calculation).items():
+            if name in ("ax", "fig"):
+                # plots are not saved
+                value = 0
+            attributes[name] = _encodeSavedValue(value, name, fileName,
+                                                 atoms)
+
+        metadata = {"format": "ARC calculation",
+                    "version": 1,
+                    "module": calculation.__class__.__module__,
+                    "class": calculation.__class__.__name__,
+                    "atoms": [{"module": atom.__class__.__module__,
+                               "class": atom.__class__.__name__,
+                               "preferQuantumDefects":
+                                   atom.preferQuantumDefects,
+                               "cpp_numerov": atom.cpp_numerov}
+                              for atom in atoms],
+                    "attributes": attributes}
+        with open(os.path.join(fileName, "metadata.json"), "w") as f:
+            json.dump(metadata, f, indent=1)
     except Exception as ex:
         print(ex)
         print("ERROR: saving of the calculation failed.")
@@ -2225,14 +2749,18 @@ def loadSavedCalculation(fileName):
 
     Loads :obj:`calculations_atom_pairstate.PairStateInteractions` and
     :obj:`calculations_atom_single.StarkMap`
-    calculation instance from file named `filename` where it was previously
-    saved with :obj:`saveCalculation` .
+    calculation instance from folder named `filename` where it was
+    previously saved with :obj:`saveCalculation` . Arrays of the
+    calculation are memory mapped, so they are read from the disk only
+    when used. Calculations saved in the older single-file format (zipped
+    pickle) are also supported.
 
     Example:
         See example for :obj:`saveCalculation`.
 
     Args:
-        fileName: name of the file where calculation will be saved
+        fileName: name of the folder (or file, for calculations saved in
+            older format) where calculation was saved
 
     Returns:
         saved calculation
@@ -2240,8 +2768,25 @@ def loadSavedCalculation(fileName):
 
     calculation = False
     try:
-        calcInput = gzip.GzipFile(fileName, 'rb')
-        calculation = pickle.load(calcInput)
+        if os.path.isdir(fileName):
+            with open(os.path.join(fileName, "metadata.json"), "r") as f:
+                metadata = json.load(f)
+            module = importlib.import_module(metadata["module"])
+            calculationClass = getattr(module, metadata["class"])
+            calculation = calculationClass.__new__(calculationClass)
+            atoms = []
+            for atom in metadata.get("atoms", []):
+                atomClass = getattr(importlib.import_module(atom["module"]),
+                                    atom["class"])
+                atoms.append(atomClass(
+                    preferQuantumDefects=atom["preferQuantumDefects"],
+                    cpp_numerov=atom["cpp_numerov"]))
+            for name, spec in metadata["attributes"].items():
+                setattr(calculation, name,
+                        _decodeSavedValue(spec, fileName, atoms))
+        else:
+            calcInput = gzip.GzipFile(fileName, 'rb')
+            calculation = pickle.load(calcInput)
     except Exception as ex:
         print(ex)
         print("ERROR: loading of the calculation from '%s' failed" % fileName)
@@ -2253,12 +2798,368 @@ def loadSavedCalculation(fileName):
     # establish conneciton to the database
     if hasattr(calculation, 'atom'):
         calculation.atom._databaseInit()
-    elif hasattr(calculation, 'atom'):
+    elif hasattr(calculation, 'atom1'):
         calculation.atom1._databaseInit()
-        calculation.atom2._databaseInit()
+        if calculation.atom2 is not calculation.atom1:
+            calculation.atom2._databaseInit()
 
     return calculation
 
+
+def _getSavedCalculationFiles(folder):
+    """
+        Returns list of all files of calculation saved in `folder` by
+        :obj:`saveCalculation` (including `metadata.json`). Returns empty
+        list for an empty folder, and None if folder contains something else.
+    """
+    if len(os.listdir(folder)) == 0:
+        return []
+    try:
+        with open(os.path.join(folder, "metadata.json"), "r") as f:
+            metadata = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not (isinstance(metadata, dict)
+            and metadata.get("format") == "ARC calculation"):
+        return None
+
+    files = ["metadata.json"]
+    specs = list(metadata.get("attributes", {}).values())
+    while len(specs) > 0:
+        spec = specs.pop()
+        for key in ("file", "data", "indices", "indptr", "array", "leaves",
+                    "integer"):
+            if key in spec:
+                files.append(spec[key])
+        files.extend(spec.get("offsets", []))
+        specs.extend(spec.get("items", []))
+    # only plain file names inside the folder
+    return [file for file in files
+            if os.path.basename(file) == file and file not in ("", ".", "..")]
+
+
+def _flattenNested(value):
+    """
+        For (nested) lists with scalar values at the same depth, returns
+        list of offsets for each level of nesting and list of the scalar
+        values. Otherwise returns None.
+    """
+    scalar = (bool, int, float, complex, str, np.number, np.bool_)
+    level = [value]
+    offsets = []
+    while len(level) > 0:
+        if all(isinstance(item, (list, tuple)) for item in level):
+            offsets.append(np.cumsum([0] + [len(item) for item in level]))
+            level = [x for item in level for x in item]
+        elif all(isinstance(item, scalar) for item in level):
+            return offsets, level
+        else:
+            return None
+    return offsets, level
+
+
+def _getSavedLeaves(leaves, integer, start, stop):
+    """
+        Values from `start` to `stop` of the flattened nested list saved by
+        :obj:`saveCalculation`. Returns slice of (memory mapped) array
+        `leaves`, or list if values are strings or mix of integers (marked
+        by `integer`) and floats, so that their types are preserved.
+    """
+    values = leaves[start:stop]
+    if integer is None and values.dtype.kind not in "SU":
+        return values
+    values = values.tolist()
+    if integer is not None:
+        for i in np.nonzero(integer[start:stop])[0]:
+            values[i] = int(values[i].real)
+    return values
+
+
+class _SavedNestedList(object):
+    """
+        Read-only nested list saved by :obj:`saveCalculation`, whose values
+        are read from memory mapped arrays only when they are accessed.
+
+        Items at nesting `level` from `start` to `stop` are described by
+        `offsets` (see :obj:`_flattenNested`). Innermost lists are returned
+        as with :obj:`_getSavedLeaves`.
+    """
+
+    def __init__(self, leaves, offsets, integer, level, start, stop):
+        self._leaves = leaves
+        self._offsets = offsets
+        self._integer = integer
+        self._level = level
+        self._start = int(start)
+        self._stop = int(stop)
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("list index out of range")
+        offsets = self._offsets[self._level]
+        start = offsets[self._start + index]
+        stop = offsets[self._start + index + 1]
+        if self._level + 1 < len(self._offsets):
+            return _SavedNestedList(self._leaves, self._offsets,
+                                    self._integer, self._level + 1,
+                                    start, stop)
+        return _getSavedLeaves(self._leaves, self._integer, start, stop)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def tolist(self):
+        """
+            Returns values as (nested) list.
+        """
+        return [item.tolist() if hasattr(item, "tolist") else item
+                for item in self]
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+
+def _encodeSavedValue(value, name, folder, atoms):
+    """
+        Saves attribute `value` of calculation in `folder`, in files whose
+        names start with `name`, and returns its description for
+        metadata of :obj:`saveCalculation`. Atoms are not saved, but are
+        added to the list `atoms` (each atom instance only once), and
+        referred to by their index in that list.
+    """
+    def saveArray(suffix, array):
+        file = "%s.%s.npy" % (name, suffix)
+        np.save(os.path.join(folder, file), array)
+        return file
+
+    if isinstance(value, _SavedNestedList):
+        # e.g. calculation that was loaded is saved again
+        value = value.tolist()
+    if isinstance(value, AlkaliAtom):
+        for index, atom in enumerate(atoms):
+            if atom is value:
+                return {"type": "atom", "index": index}
+        atoms.append(value)
+        return {"type": "atom", "index": len(atoms) - 1}
+    if issparse(value):
+        matrix = value.tocsr()
+        return {"type": "sparse",
+                "format": value.format,
+                "shape": list(matrix.shape),
+                "data": saveArray("data", matrix.data),
+                "indices": saveArray("indices", matrix.indices),
+                "indptr": saveArray("indptr", matrix.indptr)}
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        return {"type": "array", "file": saveArray("array", value)}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return {"type": "json", "value": value}
+    if isinstance(value, (np.bool_, np.integer, np.floating)):
+        return {"type": "json", "value": value.item()}
+    if isinstance(value, (complex, np.complexfloating)):
+        return {"type": "complex", "value": [value.real, value.imag]}
+
+    if isinstance(value, (list, tuple)):
+        isTuple = isinstance(value, tuple)
+        if (len(value) > 0
+                and all(isinstance(item, np.ndarray) for item in value)
+                and len(set(item.dtype for item in value)) == 1
+                and value[0].dtype != object):
+            # list of arrays, saved as single flattened array
+            return {"type": "arrayList",
+                    "tuple": isTuple,
+                    "array": saveArray("array", np.concatenate(
+                        [item.ravel() for item in value])),
+                    "shapes": [list(item.shape) for item in value]}
+
+        nested = _flattenNested(value)
+        if nested is not None:
+            kinds = set("str" if isinstance(x, str)
+                        else "bool" if isinstance(x, (bool, np.bool_))
+                        else "number" for x in nested[1])
+            if len(kinds) > 1:
+                # values of different kinds can't be saved in single array
+                nested = None
+        if nested is not None:
+            offsets, leaves = nested
+            if len(leaves) <= 16 and not any(
+                    isinstance(x, (complex, np.complexfloating))
+                    for x in leaves):
+                return {"type": "json", "tuple": isTuple,
+                        "value": json.loads(json.dumps(
+                            value, default=lambda x: x.item()))}
+            spec = {"type": "nested",
+                    "tuple": isTuple,
+                    "offsets": [saveArray("offsets%d" % i, o)
+                                for i, o in enumerate(offsets)]}
+            isInteger = np.array([isinstance(x, (int, np.integer))
+                                  and not isinstance(x, (bool, np.bool_))
+                                  for x in leaves], dtype=bool)
+            leaves = np.array(leaves)
+            spec["leaves"] = saveArray("leaves", leaves)
+            if (leaves.dtype.kind in "fc"
+                    and np.any(isInteger)):
+                spec["integer"] = saveArray("integer", isInteger)
+            return spec
+
+        if len(value) <= 64:
+            return {"type": "list",
+                    "tuple": isTuple,
+                    "items": [_encodeSavedValue(item, "%s.%d" % (name, i),
+                                                folder, atoms)
+                              for i, item in enumerate(value)]}
+
+    # anything else is pickled
+    file = "%s.pkl" % name
+    with open(os.path.join(folder, file), "wb") as f:
+        pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+    return {"type": "pickle", "file": file}
+
+
+def _decodeSavedValue(spec, folder, atoms):
+    """
+        Loads attribute of calculation described by `spec`, saved by
+        :obj:`_encodeSavedValue`. `atoms` is list of atoms used in the
+        calculation.
+    """
+    def loadArray(file, mode="c"):
+        try:
+            # by default copy-on-write memory map: data is read from disk
+            # only when used, and changes are not written back to the file
+            return np.load(os.path.join(folder, file), mmap_mode=mode)
+        except ValueError:
+            # empty arrays can't be memory mapped
+            return np.load(os.path.join(folder, file))
+
+    def toSequence(items):
+        if spec.get("tuple", False):
+            return tuple(items)
+        return items
+
+    if spec["type"] == "atom":
+        return atoms[spec["index"]]
+    if spec["type"] == "sparse":
+        matrix = csr_matrix((loadArray(spec["data"]),
+                             loadArray(spec["indices"]),
+                             loadArray(spec["indptr"])),
+                            shape=tuple(spec["shape"]))
+        return matrix.asformat(spec["format"])
+    if spec["type"] == "array":
+        return loadArray(spec["file"])
+    if spec["type"] == "json":
+        if isinstance(spec["value"], list):
+            return toSequence(spec["value"])
+        return spec["value"]
+    if spec["type"] == "complex":
+        return complex(*spec["value"])
+    if spec["type"] == "arrayList":
+        flat = loadArray(spec["array"])
+        items = []
+        start = 0
+        for shape in spec["shapes"]:
+            size = int(np.prod(shape))
+            items.append(flat[start:start + size].reshape(shape))
+            start += size
+        return toSequence(items)
+    if spec["type"] == "nested":
+        # values are read from the files only when they are accessed
+        leaves = loadArray(spec["leaves"], "r")
+        integer = None
+        if "integer" in spec:
+            integer = loadArray(spec["integer"], "r")
+        offsets = [np.load(os.path.join(folder, file))
+                   for file in spec["offsets"]]
+        if len(offsets) == 1:
+            return toSequence(_getSavedLeaves(leaves, integer,
+                                              offsets[0][0], offsets[0][1]))
+        return toSequence(_SavedNestedList(leaves, offsets, integer, 1,
+                                           offsets[0][0], offsets[0][1]))
+    if spec["type"] == "list":
+        return toSequence([_decodeSavedValue(item, folder, atoms)
+                           for item in spec["items"]])
+    if spec["type"] == "pickle":
+        with open(os.path.join(folder, spec["file"]), "rb") as f:
+            return pickle.load(f)
+    raise ValueError("Unknown type '%s' of saved value." % spec["type"])
+
+def _exportArrays(fileBase, header, arrays, compressed=False,
+                  blockSize=1024):
+    """
+        Saves arrays for `exportData` methods of calculations as a single
+        binary `.npz` file, together with text `header` describing the
+        calculation. Returns name of the saved file.
+
+        Values of `arrays` are arrays, or lists of rows of equal shape (e.g.
+        energy levels for each value of the electric field), which are saved
+        as float64 arrays. They are written in blocks of `blockSize` rows,
+        so the full array is never created in memory.
+    """
+    filename = fileBase + ".npz"
+    if compressed:
+        compression = zipfile.ZIP_DEFLATED
+    else:
+        compression = zipfile.ZIP_STORED
+    arrays = dict(arrays)
+    arrays["header"] = np.array(header)
+    with zipfile.ZipFile(filename, "w", compression=compression,
+                         allowZip64=True) as archive:
+        for name, rows in arrays.items():
+            if sys.version_info >= (3, 6):
+                with archive.open(name + ".npy", "w",
+                                  force_zip64=True) as output:
+                    _writeArrayInBlocks(output, rows, blockSize)
+            else:
+                # older zipfile can't write to archive member directly
+                fd, tmpFile = tempfile.mkstemp(suffix="-arc.npy")
+                os.close(fd)
+                try:
+                    with open(tmpFile, "wb") as output:
+                        _writeArrayInBlocks(output, rows, blockSize)
+                    archive.write(tmpFile, arcname=name + ".npy")
+                finally:
+                    os.remove(tmpFile)
+    return filename
+
+
+def _writeArrayInBlocks(output, rows, blockSize):
+    """
+        Writes array given as array or list of rows `rows` in `.npy` format
+        to file `output`, converting at most `blockSize` rows at a time.
+    """
+    if isinstance(rows, np.ndarray):
+        dtype = rows.dtype
+        shape = rows.shape
+        if rows.ndim == 0 or dtype.hasobject:
+            # no rows to iterate over, or not a plain binary array
+            np.lib.format.write_array(output, rows)
+            return
+    else:
+        dtype = np.dtype(np.float64)
+        if len(rows) == 0:
+            np.lib.format.write_array(output, np.zeros(0, dtype=dtype))
+            return
+        shape = (len(rows),) + np.shape(rows[0])
+
+    np.lib.format.write_array_header_1_0(
+        output, {"descr": np.lib.format.dtype_to_descr(dtype),
+                 "fortran_order": False,
+                 "shape": shape})
+    for start in xrange(0, shape[0], blockSize):
+        block = np.ascontiguousarray(rows[start:start + blockSize],
+                                     dtype=dtype)
+        if block.shape[1:] != shape[1:]:
+            raise ValueError("Rows of the exported array have different "
+                             "shapes %s and %s." % (str(shape[1:]),
+                                                    str(block.shape[1:])))
+        output.write(block.tobytes())
+
 # =================== Saving and loading calculations (END) ===================
 
 # =================== State generation and printing (START) ===================
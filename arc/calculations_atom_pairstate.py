@@ -19,7 +19,7 @@
             calc1 = PairStateInteractions(Rubidium(), 60, 0, 0.5, 60, 0, 0.5,0.5, 0.5)
             calc1.defineBasis( 0., 0., 4, 5,10e9)
             # optionally we can save now results of calculation for future use
-            saveCalculation(calc1,"mycalculation.pkl")
+            saveCalculation(calc1,"mycalculation")
             calculation1.diagonalise(linspace(1,10.0,30),250,progressOutput = True,drivingFromState=[6,1,0.5,0.5,0])
             calc1.plotLevelDiagram()
             calc1.ax.set_xlim(1,10)
@@ -32,10 +32,15 @@ from __future__ import division, print_function, absolute_import
 
 from .wigner import Wigner6j, Wigner3j, CG, WignerDmatrix
 from .alkali_atom_functions import _atomLightAtomCoupling
-from scipy.constants import physical_constants, pi
+from .alkali_atom_functions import _exportArrays
+from scipy.constants import physical_constants, pi, epsilon_0
 import gzip
 import sys
 import datetime
+import logging
+import time
+import functools
+import inspect
 import matplotlib
 from matplotlib.colors import LinearSegmentedColormap
 from .calculations_atom_single import StarkMap
@@ -79,6 +84,227 @@ if sys.version_info > (2,):
 
 DPATH = os.path.join(os.path.expanduser('~'), '.arc-data')
 
+# progress and debugging output of the calculations. Messages are printed
+# to the standard output when progressOutput or debugOutput is requested,
+# and are otherwise passed only to the handlers configured by the user.
+_logger = logging.getLogger(__name__)
+
+
+def _logProgress(message, *args):
+    """
+    Logs progress `message` of the calculation (at INFO level). When
+    printed to the standard output (see :obj:`_PrintOutput`), each
+    progress message overwrites the previous one on the same line.
+    """
+    _logger.info(message, *args, extra={"progress": True})
+
+
+class _ProgressStreamHandler(logging.StreamHandler):
+    """
+    Stream handler that prints progress messages (see :obj:`_logProgress`)
+    without the line break, returning to the start of the line instead.
+    """
+
+    def emit(self, record):
+        if not getattr(record, "progress", False):
+            logging.StreamHandler.emit(self, record)
+            return
+        try:
+            self.stream.write("\r" + self.format(record))
+            self.flush()
+        except Exception:
+            self.handleError(record)
+
+
+class _PrintOutput(object):
+    """
+    Context in which the messages of the module logger are printed to the
+    standard output, as requested by `progressOutput` (progress messages)
+    and `debugOutput` (progress and debugging messages) arguments. For the
+    duration of the context messages are not propagated to the handlers of
+    the parent loggers, so that they are not printed twice.
+    """
+
+    def __init__(self, progressOutput=False, debugOutput=False):
+        self.level = None
+        if debugOutput:
+            self.level = logging.DEBUG
+        elif progressOutput:
+            self.level = logging.INFO
+
+    def __enter__(self):
+        if self.level is not None:
+            self.handler = _ProgressStreamHandler(sys.stdout)
+            self.handler.setFormatter(logging.Formatter("%(message)s"))
+            self.handler.setLevel(self.level)
+            self.previousLevel = _logger.level
+            self.previousPropagate = _logger.propagate
+            _logger.propagate = False
+            if _logger.getEffectiveLevel() > self.level:
+                _logger.setLevel(self.level)
+            _logger.addHandler(self.handler)
+        return self
+
+    def __exit__(self, *exc):
+        if self.level is not None:
+            _logger.removeHandler(self.handler)
+            _logger.setLevel(self.previousLevel)
+            _logger.propagate = self.previousPropagate
+        return False
+
+
+def _instrumented(stage):
+    """
+    Decorator for the calculation methods with `progressOutput` and
+    `debugOutput` arguments. Records time spent in the method as a `stage`
+    in the instance :obj:`CalculationStatistics` (`statistics`), and prints
+    messages of the module logger to the standard output for the duration
+    of the call, if requested by the arguments.
+    """
+    def decorator(method):
+        def arguments(args, kwargs):
+            # values of all the arguments, including the default ones
+            if sys.version_info > (3,):
+                bound = inspect.signature(method).bind(*args, **kwargs)
+                bound.apply_defaults()
+                return bound.arguments
+            return inspect.getcallargs(method, *args, **kwargs)
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            values = arguments(args, kwargs)
+            calculation = args[0]
+            if getattr(calculation, "statistics", None) is None:
+                # e.g. calculation saved before statistics were recorded
+                calculation.statistics = CalculationStatistics()
+            with _PrintOutput(values.get("progressOutput", False),
+                              values.get("debugOutput", False)), \
+                    calculation.statistics.stage(stage):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _padded(rows, fill):
+    """
+    Stacks rows of possibly different lengths into 2D array, padding
+    shorter rows with `fill`.
+    """
+    width = max([len(row) for row in rows] + [0])
+    result = np.full((len(rows), width), fill, dtype=float)
+    for i, row in enumerate(rows):
+        result[i, :len(row)] = row
+    return result
+
+
+class CalculationStatistics(object):
+    """
+        Counters and timings of the stages of a calculation
+
+        Collection is disabled by default, in which case counting and
+        timing requests return immediately without recording anything.
+        When enabled, counters and times (in s) accumulate over the
+        subsequent calculations, until :obj:`reset` is called.
+
+        Examples:
+            Statistics of the basis construction for pair-state
+            interaction calculation can be obtained as
+
+            >>> calc = PairStateInteractions(Rubidium(), 60, 0, 0.5,
+                                             60, 0, 0.5, 0.5, 0.5)
+            >>> calc.statistics.enabled = True
+            >>> calc.defineBasis(0, 0, 4, 5, 25e9)
+            >>> print(calc.statistics)
+            channel enumeration                 0.062 s
+            channel couplings                   0.019 s
+            basis definition                    1.285 s
+            channels enumerated                 103
+            pairs tested                        5253
+            couplings kept                      338
+            basis states                        412
+
+            Stages can be nested, e.g. time of the basis definition
+            includes the time of the channel enumeration.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        """
+            if True, counters and timings are recorded
+        """
+        self.counters = {}
+        """
+            counters, accessed by their name
+        """
+        self.timings = {}
+        """
+            total time spent in a stage (in s), accessed by stage name
+        """
+
+    def reset(self):
+        """
+            Clears all the recorded counters and timings
+        """
+        self.counters = {}
+        self.timings = {}
+
+    def count(self, name, value=1):
+        """
+            Increases counter
+
+            Args:
+                name (str): name of the counter
+                value (int): optional, increment (1 by default)
+        """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def stage(self, name):
+        """
+            Times a stage of the calculation
+
+            Args:
+                name (str): name of the stage
+
+            Returns:
+                context manager that records the time spent in its body
+
+            Example:
+                >>> with statistics.stage("diagonalisation"):
+                >>>     ev, egvector = eigsh(m)
+        """
+        return _Stage(self, name)
+
+    def __str__(self):
+        lines = ["%-35s %.3f s" % (name, value)
+                 for name, value in self.timings.items()]
+        lines += ["%-35s %d" % (name, value)
+                  for name, value in self.counters.items()]
+        return "\n".join(lines)
+
+
+class _Stage(object):
+    """
+    Records time spent in a stage of calculation in the
+    :obj:`CalculationStatistics`, if their collection is enabled.
+    """
+
+    def __init__(self, statistics, name):
+        self.statistics = statistics
+        self.name = name
+
+    def __enter__(self):
+        if self.statistics.enabled:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        if self.statistics.enabled:
+            timings = self.statistics.timings
+            timings[self.name] = (timings.get(self.name, 0.)
+                                  + time.time() - self.start)
+        return False
+
 
 class PairStateInteractions:
     """
@@ -180,6 +406,11 @@ class PairStateInteractions:
 
     dataFolder = DPATH
 
+    #: maximal number of pair-state combinations whose coupling is checked
+    #: at once when finding the couplings between the basis states. Bounds
+    #: memory used for bases with large number of channels.
+    couplingBlockSize = 2**22
+
     # =============================== Methods ===============================
 
     def __init__(self, atom, n, l, j, nn, ll, jj, m1, m2,
@@ -261,6 +492,13 @@ class PairStateInteractions:
             :math:`m_j`. Used as intermediary for full interaction matrix
             calculation by :obj:`defineBasis`.
         """
+        self.channelCache = None
+        """
+            channels and their (radial) couplings, with the parameters
+            (nRange, lrange, energyDelta, Bz, limitBasisToMj) used to find
+            them. These don't depend on the orientation of the atoms, and
+            are reused by :obj:`defineBasis` for the same parameters.
+        """
 
         # ======================= Full basis (resolving mj) ===================
 
@@ -309,12 +547,24 @@ class PairStateInteractions:
         self.matB_1 = []
         self.matB_2 = []
 
+        self.statistics = CalculationStatistics()
+        """
+            counters and timings of the calculation stages, see
+            :obj:`CalculationStatistics`. Disabled by default.
+        """
+
         # ===================== Eigen states and plotting =====================
 
         # finding perturbed energy levels
         self.r = []    # detuning scale
         self.y = []    # energy levels
         self.highlight = []
+        self.targetStateContributions = []
+        """
+            contributions of target states, specified in call of
+            :obj:`diagonalise`, in the eigenstates, indexed as
+            [distance, target state, eigenstate]
+        """
 
         # pointers towards figure
         self.fig = 0
@@ -599,6 +849,37 @@ class PairStateInteractions:
         else:
             return False
 
+    def __getCouplingOrders(self, l, j, l1, j1):
+        """
+        Order of the coupling of single-atom states |l,j> and |l1,j1>,
+        1 for dipole and 2 for quadrupole coupling, or 0 if the states are
+        not coupled. Vectorized version of selection rules in `__isCoupled`.
+
+        Args:
+            l (array): orbital angular momentum
+            j (array): total angular momentum
+            l1 (array): orbital angular momentum
+            j1 (array): total angular momentum
+
+        Returns:
+            array of coupling orders
+        """
+        dl = np.abs(l - l1)
+        dj = np.abs(j - j1)
+        orders = np.zeros(dl.shape, dtype=int)
+        if 2 <= self.interactionsUpTo:
+            orders[(dl < 2.1) & (dj < 2.1)] = 2  # quadrupole coupling
+        orders[(np.abs(dl - 1) < 0.1) & (dj < 1.1)] = 1  # dipole coupling
+
+        forbidden = (np.abs(dl - 1) > 0.1) & (
+            ((np.abs(j - 0.5) < 0.1) & (np.abs(j1 - 0.5) < 0.1))
+            | ((np.abs(j) < 0.1) & (np.abs(j1 - 1) < 0.1))
+            | ((np.abs(j - 1) < 0.1) & (np.abs(j1) < 0.1)))
+        forbidden |= (np.abs(j) < 0.1) & (np.abs(j1) < 0.1)
+        forbidden |= (np.abs(l) < 0.1) & (np.abs(l1) < 0.1)
+        orders[forbidden] = 0
+        return orders
+
     def __getEnergyDefect(self,
                           n, l, j,
                           nn, ll, jj,
@@ -627,108 +908,138 @@ class PairStateInteractions:
         Returns:
             float:  energy defect (SI units: J)
         """
-        return C_e * (self.atom1.getEnergy(n1, l1, j1, s=self.s1)
-                      + self.atom2.getEnergy(n2, l2, j2, s=self.s2)
-                      - self.atom1.getEnergy(n, l, j, s=self.s1)
-                      - self.atom2.getEnergy(nn, ll, jj, s=self.s2))
+        return C_e * (self.atom1._getTabulatedEnergy(n1, l1, j1, s=self.s1)
+                      + self.atom2._getTabulatedEnergy(n2, l2, j2, s=self.s2)
+                      - self.atom1._getTabulatedEnergy(n, l, j, s=self.s1)
+                      - self.atom2._getTabulatedEnergy(nn, ll, jj, s=self.s2))
+
+    def __getSingleAtomStates(self, atom, n, l, s, k, lrange):
+        """
+        Single-atom states |n1,l1,j1> of the given atom that can be part of
+        the pair-state basis around the state |n,l,j>, and their energies
+
+        Returns:
+            array of states [[n1, l1, j1], ...] and array of corresponding
+            energies (in eV)
+        """
+        l1start = max(l - 1, 0)
+        l1max = max(l + self.interactionsUpTo, lrange) + 1
+
+        states = []
+        for n1 in xrange(max(n - k, 1), n + k + 1):
+            for l1 in xrange(l1start, min(l1max, n1 - 1)):
+                j1 = l1 - s
+                while j1 < -0.1:
+                    j1 += 2 * s
+                while j1 <= l1 + s + 0.1:
+                    if (n1 >= atom.groundStateN
+                            or [n1, l1, j1] in atom.extraLevels):
+                        states.append([n1, l1, j1])
+                    j1 = j1 + 1.0
+        states = np.array(states, dtype=np.float64).reshape(-1, 3)
+        energies = atom._getTabulatedEnergies(states[:, 0], states[:, 1],
+                                              states[:, 2], s=s)
+        return states, energies
 
     def __makeRawMatrix2(self,
                          n, l, j,
                          nn, ll, jj,
-                         k, lrange, limit, limitBasisToMj,
-                         progressOutput=False, debugOutput=False):
+                         k, lrange, limit, limitBasisToMj):
         # limit = limit in Hz on energy defect
         # k defines range of n' = [n-k, n+k]
-        dimension = 0
-
-        # which states/channels contribute significantly in the second order perturbation?
-        states = []
+        with self.statistics.stage("channel enumeration"):
+            states = self.__getChannels(n, l, j, nn, ll, jj,
+                                        k, lrange, limit, limitBasisToMj)
+        with self.statistics.stage("channel couplings"):
+            couplingMatArray = self.__getChannelCouplings(states, k, limit)
+        return states, couplingMatArray
 
-        # original pairstate index
-        opi = 0
+    def __getChannels(self,
+                      n, l, j,
+                      nn, ll, jj,
+                      k, lrange, limit, limitBasisToMj):
+        """
+        Pair-states (channels) |n1,l1,j1>x|n2,l2,j2> within energy defect
+        `limit` (in Hz) from the pair-state |n,l,j>x|nn,ll,jj>, with
+        n1 and n2 in range [n-k, n+k] and [nn-k, nn+k] respectively.
 
+        Returns:
+            list of channels [n1, l1, j1, n2, l2, j2, energyDefect], with
+            energy defect (in GHz) including Zeeman shift of the original
+            pair-state
+        """
         # this numbers are conserved if we use only dipole-dipole interactions
         Lmod2 = ((l + ll) % 2)
 
-        l1start = l - 1
-        if l == 0:
-            l1start = 0
-
-        l2start = ll - 1
-        if ll == 0:
-            l2start = 0
-
-        if debugOutput:
-            print("\n ======= Relevant states =======\n")
-
-        for n1 in xrange(max(n - k, 1), n + k + 1):
-            for n2 in xrange(max(nn - k, 1), nn + k + 1):
-                l1max = max(l + self.interactionsUpTo, lrange) + 1
-                l1max = min(l1max, n1 - 1)
-                for l1 in xrange(l1start, l1max):
-                    l2max = max(ll + self.interactionsUpTo, lrange) + 1
-                    l2max = min(l2max, n2 - 1)
-                    for l2 in xrange(l2start, l2max):
-                        j1 = l1 - self.s1
-                        while j1 < -0.1:
-                            j1 += 2 * self.s1
-                        while j1 <= l1 + self.s1 + 0.1:
-                            j2 = l2 - self.s2
-                            while j2 < -0.1:
-                                j2 += 2 * self.s2
-
-                            while j2 <= l2 + self.s2 + 0.1:
-                                ed = self.__getEnergyDefect(n, l, j,
-                                                            nn, ll, jj,
-                                                            n1, l1, j1,
-                                                            n2, l2, j2) / C_h
-                                if (abs(ed) < limit
-                                    and (not (self.interactionsUpTo == 1)
-                                         or (Lmod2 == ((l1 + l2) % 2)))
-                                    and ((not limitBasisToMj)
-                                         or (j1 + j2 + 0.1
-                                             > self.m1 + self.m2))
-                                    and (n1 >= self.atom1.groundStateN
-                                         or [n1, l1, j1] in self.atom1.extraLevels)
-                                    and (n2 >= self.atom2.groundStateN
-                                        or [n2, l2, j2] in self.atom2.extraLevels)
-                                        ):
-
-                                    if debugOutput:
-                                        pairState = (
-                                            "|"
-                                            + printStateString(n1, l1, j1,
-                                                               s=self.s1)
-                                            + ","
-                                            + printStateString(n2, l2, j2,
-                                                               s=self.s2)
-                                            + ">")
-                                        print(
-                                            pairState
-                                            + ("\t EnergyDefect = %.3f GHz"
-                                               % (ed * 1.e-9)
-                                              )
-                                            )
-
-                                    states.append([n1, l1, j1, n2, l2, j2])
+        debugOutput = _logger.isEnabledFor(logging.DEBUG)
+        _logger.debug("\n ======= Relevant states =======\n")
+
+        # which states/channels contribute significantly in the second order
+        # perturbation? Pair-states within the energy window are found by
+        # binary search in the sorted energies of the second atom
+        states1, energies1 = self.__getSingleAtomStates(
+            self.atom1, n, l, self.s1, k, lrange)
+        states2, energies2 = self.__getSingleAtomStates(
+            self.atom2, nn, ll, self.s2, k, lrange)
+        originalEnergy1 = self.atom1._getTabulatedEnergy(n, l, j, s=self.s1)
+        originalEnergy2 = self.atom2._getTabulatedEnergy(nn, ll, jj,
+                                                         s=self.s2)
+
+        order = np.argsort(energies2, kind="stable")
+        window = limit * C_h / C_e * (1. + 1e-6)  # in eV, with safety margin
+        target = originalEnergy1 + originalEnergy2 - energies1
+        lower = np.searchsorted(energies2[order], target - window, "left")
+        upper = np.searchsorted(energies2[order], target + window, "right")
+        counts = upper - lower
+        i1 = np.repeat(np.arange(len(states1)), counts)
+        i2 = order[np.repeat(lower - (np.cumsum(counts) - counts), counts)
+                   + np.arange(np.sum(counts))]
+
+        ed = C_e * (energies1[i1] + energies2[i2]
+                    - originalEnergy1 - originalEnergy2) / C_h
+        selected = np.abs(ed) < limit
+        if self.interactionsUpTo == 1:
+            selected &= (Lmod2 == ((states1[i1, 1] + states2[i2, 1]) % 2))
+        if limitBasisToMj:
+            selected &= (states1[i1, 2] + states2[i2, 2] + 0.1
+                         > self.m1 + self.m2)
+        i1, i2, ed = i1[selected], i2[selected], ed[selected]
+
+        # keep the ordering of the states (n1, n2, l1, l2, j1, j2)
+        sortOrder = np.lexsort((states2[i2, 2], states1[i1, 2],
+                                states2[i2, 1], states1[i1, 1],
+                                states2[i2, 0], states1[i1, 0]))
+        i1, i2, ed = i1[sortOrder], i2[sortOrder], ed[sortOrder]
+
+        states = [[int(states1[a, 0]), int(states1[a, 1]),
+                   float(states1[a, 2]),
+                   int(states2[b, 0]), int(states2[b, 1]),
+                   float(states2[b, 2])]
+                  for a, b in zip(i1, i2)]
+        dimension = len(states)
+        self.statistics.count("channels enumerated", dimension)
 
-                                    if (n == n1 and nn == n2
-                                        and l == l1 and ll == l2
-                                        and j == j1 and jj == j2
-                                            ):
-                                        opi = dimension
-
-                                    dimension = dimension + 1
-                                j2 = j2 + 1.0
-                            j1 = j1 + 1.0
+        # original pairstate index
+        opi = 0
+        for i, st in enumerate(states):
+            if (n == st[0] and nn == st[3]
+                    and l == st[1] and ll == st[4]
+                    and j == st[2] and jj == st[5]):
+                opi = i
 
         if debugOutput:
-            print("\tMatrix dimension\t=\t", dimension)
-
-        # mat_value, mat_row, mat_column for each sparce matrix describing
-        # dipole-dipole, dipole-quadrupole (and quad-dipole) and quadrupole-quadrupole
-        couplingMatConstructor = [[[], [], []]
-                                  for i in xrange(2 * self.interactionsUpTo - 1)]
+            for st, energyDefect in zip(states, ed):
+                pairState = (
+                    "|"
+                    + printStateString(st[0], st[1], st[2], s=self.s1)
+                    + ","
+                    + printStateString(st[3], st[4], st[5], s=self.s2)
+                    + ">")
+                _logger.debug(pairState
+                              + ("\t EnergyDefect = %.3f GHz"
+                                 % (energyDefect * 1.e-9)))
+
+        _logger.debug("\tMatrix dimension\t=\t%d", dimension)
 
         # original pair-state (i.e. target pair state) Zeeman Shift
         opZeemanShift = (self.atom1.getZeemanEnergyShift(
@@ -741,100 +1052,282 @@ class PairStateInteractions:
                 s=self.s2)
             ) / C_h * 1.0e-9  # in GHz
 
-        if debugOutput:
-            print("\n ======= Coupling strengths (radial part only) =======\n")
-
-        maxCoupling = "quadrupole-quadrupole"
-        if (self.interactionsUpTo == 1):
-            maxCoupling = "dipole-dipole"
-        if debugOutput:
-            print("Calculating coupling (up to ",
-                  maxCoupling, ") between the pair states")
+        # energy defects of all the states with respect to the original
+        # pair-state (in GHz)
+        energyDefects = np.zeros(dimension)
+        if dimension > 0:
+            st = np.array(states, dtype=np.float64)
+            pairEnergies = (
+                self.atom1.getEnergies(st[:, 0], st[:, 1], st[:, 2], s=self.s1)
+                + self.atom2.getEnergies(st[:, 3], st[:, 4], st[:, 5],
+                                         s=self.s2))
+            energyDefects = (pairEnergies - pairEnergies[opi]) * C_e / C_h\
+                * 1.0e-9 - opZeemanShift
 
         for i in xrange(dimension):
+            states[i].append(float(energyDefects[i]))  # energy defect
+        return states
 
-            ed = self.__getEnergyDefect(
-                states[opi][0], states[opi][1], states[opi][2],
-                states[opi][3], states[opi][4], states[opi][5],
-                states[i][0], states[i][1], states[i][2],
-                states[i][3], states[i][4], states[i][5]) / C_h * 1.0e-9\
-                - opZeemanShift
-
-            pairState1 = (
-                "|"
-                + printStateString(states[i][0], states[i][1], states[i][2],
-                                   s=self.s1)
-                + ","
-                + printStateString(states[i][3], states[i][4], states[i][5],
-                                   s=self.s2)
-                + ">"
-                )
-
-            states[i].append(ed)  # energy defect of given state
+    def __getChannelCouplings(self, states, k, limit):
+        """
+        Radial parts of the couplings between the channels `states` within
+        energy defect `limit` (in Hz), with principal quantum numbers
+        differing at most by `k`.
 
-            for j in xrange(i + 1, dimension):
+        Returns:
+            list of sparse matrices (upper triangle) with dipole-dipole,
+            dipole-quadrupole and quadrupole-quadrupole couplings (in GHz)
+        """
+        dimension = len(states)
+        debugOutput = _logger.isEnabledFor(logging.DEBUG)
 
-                coupled = self.__isCoupled(
-                    states[i][0], states[i][1], states[i][2],
-                    states[i][3], states[i][4], states[i][5],
-                    states[j][0], states[j][1], states[j][2],
-                    states[j][3], states[j][4], states[j][5], limit)
+        _logger.debug("\n ======= Coupling strengths (radial part only)"
+                      " =======\n")
 
-                if (states[i][0] == 24 and states[j][0] == 18):
-                    print("\n")
-                    print(states[i])
-                    print(states[j])
-                    print(coupled)
+        maxCoupling = "quadrupole-quadrupole"
+        if (self.interactionsUpTo == 1):
+            maxCoupling = "dipole-dipole"
+        _logger.debug("Calculating coupling (up to %s) between the pair"
+                      " states", maxCoupling)
+
+        # couplings between the pair-states, found row-block by row-block
+        # with the selection rules applied as masks over the index arrays
+        # (only the upper triangle i < j is stored, as before)
+        st = np.array([state[:6] for state in states],
+                      dtype=np.float64).reshape(-1, 6)
+        stateEnergies1 = self.atom1._getTabulatedEnergies(
+            st[:, 0], st[:, 1], st[:, 2], s=self.s1)
+        stateEnergies2 = self.atom2._getTabulatedEnergies(
+            st[:, 3], st[:, 4], st[:, 5], s=self.s2)
+
+        self.statistics.count("pairs tested", dimension * (dimension - 1) // 2)
+        rows, columns, orders = [], [], []
+        blockSize = max(1, self.couplingBlockSize // max(dimension, 1))
+        for start in xrange(0, dimension, blockSize):
+            r = np.arange(start, min(start + blockSize, dimension))[:, None]
+            c = np.arange(dimension)[None, :]
+            coupled = (
+                (c > r)
+                & (np.abs(st[r, 0] - st[c, 0]) <= k)
+                & (np.abs(st[r, 3] - st[c, 3]) <= k)
+                & (np.abs(C_e * (stateEnergies1[c] + stateEnergies2[c]
+                                 - stateEnergies1[r] - stateEnergies2[r])
+                          ) / C_h < limit))
+            r, c = np.nonzero(coupled)
+            r += start
+            c1 = self.__getCouplingOrders(st[r, 1], st[r, 2],
+                                          st[c, 1], st[c, 2])
+            c2 = self.__getCouplingOrders(st[r, 4], st[r, 5],
+                                          st[c, 4], st[c, 5])
+            selected = (c1 > 0) & (c2 > 0)
+            rows.append(r[selected])
+            columns.append(c[selected])
+            orders.append(c1[selected] + c2[selected])
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=int)
+        columns = np.concatenate(columns) if columns \
+            else np.zeros(0, dtype=int)
+        orders = np.concatenate(orders) if orders else np.zeros(0, dtype=int)
+
+        # radial parts, with one batch look-up per atom
+        radial1 = self.atom1.getRadialCouplings(
+            st[rows, 0], st[rows, 1], st[rows, 2],
+            st[columns, 0], st[columns, 1], st[columns, 2], s=self.s1)
+        radial2 = self.atom2.getRadialCouplings(
+            st[rows, 3], st[rows, 4], st[rows, 5],
+            st[columns, 3], st[columns, 4], st[columns, 5], s=self.s2)
+        couplingStrengths = C_e**2 / (4.0 * pi * epsilon_0) * radial1 \
+            * radial2 * (physical_constants["Bohr radius"][0])**orders \
+            / C_h * 1.0e-9
+        self.statistics.count("couplings kept", len(rows))
 
-                if coupled and (abs(states[i][0] - states[j][0]) <= k
-                                and abs(states[i][3] - states[j][3]) <= k):
-                    if debugOutput:
-                        pairState2 = ("|"
-                            + printStateString(states[j][0],
-                                               states[j][1],
-                                               states[j][2],
-                                               s=self.s1)
-                            + ","
-                            + printStateString(states[j][3],
-                                               states[j][4],
-                                               states[j][5],
-                                               s=self.s2)
-                            + ">")
-                        print(pairState1 + " <---> " + pairState2)
-
-                    couplingStregth = _atomLightAtomCoupling(
-                        states[i][0], states[i][1], states[i][2],
-                        states[i][3], states[i][4], states[i][5],
-                        states[j][0], states[j][1], states[j][2],
-                        states[j][3], states[j][4], states[j][5],
-                        self.atom1, atom2=self.atom2,
-                        s=self.s1, s2=self.s2) / C_h * 1.0e-9
-
-                    couplingMatConstructor[coupled - 2][0].append(
-                        couplingStregth)
-                    couplingMatConstructor[coupled - 2][1].append(i)
-                    couplingMatConstructor[coupled - 2][2].append(j)
-
-                    exponent = coupled + 1
-                    if debugOutput:
-                        print(("\tcoupling (C_%d/R^%d) = %.5f"
-                               % (exponent, exponent,
-                                  couplingStregth * (1e6)**(exponent))),
-                              "/R^", exponent, " GHz  (mu m)^", exponent, "\n"
-                              )
+        if debugOutput:
+            for i, j, coupled, couplingStregth in zip(rows, columns, orders,
+                                                      couplingStrengths):
+                pairState1 = (
+                    "|"
+                    + printStateString(states[i][0], states[i][1],
+                                       states[i][2], s=self.s1)
+                    + ","
+                    + printStateString(states[i][3], states[i][4],
+                                       states[i][5], s=self.s2)
+                    + ">")
+                pairState2 = (
+                    "|"
+                    + printStateString(states[j][0], states[j][1],
+                                       states[j][2], s=self.s1)
+                    + ","
+                    + printStateString(states[j][3], states[j][4],
+                                       states[j][5], s=self.s2)
+                    + ">")
+                _logger.debug(pairState1 + " <---> " + pairState2)
+                exponent = coupled + 1
+                _logger.debug("\tcoupling (C_%d/R^%d) = %.5f /R^%d GHz"
+                              " (mu m)^%d\n",
+                              exponent, exponent,
+                              couplingStregth * (1e6)**(exponent),
+                              exponent, exponent)
 
         # coupling = [1,1] dipole-dipole, [2,1]  quadrupole dipole, [2,2] quadrupole quadrupole
 
         couplingMatArray = [
             csr_matrix(
-                (couplingMatConstructor[i][0],
-                 (couplingMatConstructor[i][1], couplingMatConstructor[i][2])
+                (couplingStrengths[orders == i + 2],
+                 (rows[orders == i + 2], columns[orders == i + 2])
                  ),
                 shape=(dimension, dimension)
                 )
-            for i in xrange(len(couplingMatConstructor))
+            for i in xrange(2 * self.interactionsUpTo - 1)
             ]
-        return states, couplingMatArray
+        return couplingMatArray
+
+    def __getDiagonalMatrix(self):
+        """
+        Diagonal part of the Hamiltonian in the m-resolved basis: energy
+        defects of the channels with Zeeman shifts of the basis states (in
+        GHz).
+        """
+        dimension = len(self.basisStates)
+        basis = np.array(self.basisStates, dtype=np.float64).reshape(-1, 8)
+        channel = np.array([c[6] for c in self.channel], dtype=np.float64)
+        energyDefects = channel[np.array(self.matrixElement, dtype=int)]
+
+        # Zeeman shifts are calculated once for each single-atom state
+        zeemanShifts = []
+        for atom, s, columns in ((self.atom1, self.s1, [1, 2, 3]),
+                                 (self.atom2, self.s2, [5, 6, 7])):
+            unique, inverse = np.unique(basis[:, columns], axis=0,
+                                        return_inverse=True)
+            shifts = np.array([
+                atom.getZeemanEnergyShift(int(round(state[0])), state[1],
+                                          state[2], self.Bz, s=s)
+                for state in unique], dtype=np.float64)
+            zeemanShifts.append(shifts[inverse.reshape(-1)])
+        zeemanShift = (zeemanShifts[0] + zeemanShifts[1]) / C_h * 1.0e-9
+
+        # solves problems with exactly degenerate basisStates, offset
+        # increases with the position of the state within its channel
+        channelStart = self.index[np.array(self.matrixElement, dtype=int)]
+        position = np.arange(dimension) - channelStart
+        degeneracyOffset = np.cumsum(
+            np.full(np.max(position, initial=-1) + 1, 0.00000001))[position]
+
+        return csr_matrix(
+            (energyDefects + zeemanShift + degeneracyOffset,
+             (np.arange(dimension), np.arange(dimension))),
+            shape=(dimension, dimension)
+            )
+
+    def __expandCoupling(self, coupling, wgd, matRIndex):
+        r"""
+        Expands couplings between the channels into the m-resolved basis.
+
+        The angular part of the coupling between the channels
+        (l1,j1)x(l2,j2) -> (l3,j3)x(l4,j4) is the block
+        :math:`(D_3 \otimes D_4) A (D_1 \otimes D_2)^\dagger`,
+        where :math:`D` are Wigner D matrices of the rotation and :math:`A`
+        is the angular matrix in the unrotated frame. The block is
+        calculated once for all the channel pairs of the same angular
+        momenta, scaled by their radial parts and scattered into the
+        sparse matrix.
+
+        Args:
+            coupling (csr_matrix): radial parts of the couplings between
+                the channels (upper triangle)
+            wgd (WignerDmatrix): rotation of the basis
+            matRIndex (int): index of the coupling, 0 for dipole-dipole,
+                1 for dipole-quadrupole, 2 for quadrupole-quadrupole
+
+        Returns:
+            csr_matrix: coupling (in GHz) in the basis :obj:`basisStates`
+        """
+        dimension = len(self.basisStates)
+        basis = np.array(self.basisStates, dtype=np.float64).reshape(-1, 8)
+        # index of each basis state in the |m1>x|m2> product space of its
+        # channel, i.e. the index in the composite state vector
+        mIndex = np.rint((basis[:, 2] + basis[:, 3]) * (2 * basis[:, 6] + 1)
+                         + basis[:, 6] + basis[:, 7]).astype(int)
+
+        # channels are classified by angular momenta (l1, j1, l2, j2) and
+        # by the set of m-states of the channel included in the basis
+        channel = np.array([c[:6] for c in self.channel],
+                           dtype=np.float64).reshape(-1, 6)
+        momenta, channelMomenta = np.unique(channel[:, [1, 2, 4, 5]],
+                                            axis=0, return_inverse=True)
+        channelMomenta = channelMomenta.reshape(-1)
+        typeIndex = {}
+        types = []
+        typeMIndices = []
+        channelType = np.zeros(len(self.channel), dtype=int)
+        for ii in xrange(len(self.channel)):
+            mSet = mIndex[self.index[ii]:self.index[ii + 1]]
+            key = (channelMomenta[ii], tuple(mSet))
+            if key not in typeIndex:
+                typeIndex[key] = len(types)
+                types.append(tuple(momenta[channelMomenta[ii]]))
+                typeMIndices.append(mSet)
+            channelType[ii] = typeIndex[key]
+
+        coupling = coupling.tocoo()
+        pairTypes, pairGroup = np.unique(
+            np.stack((channelType[coupling.row],
+                      channelType[coupling.col]), axis=-1).reshape(-1, 2),
+            axis=0, return_inverse=True)
+        pairGroup = pairGroup.reshape(-1)
+
+        rotations = {}
+
+        def rotation(t):
+            # (D1 x D2) for channels of type t, dense
+            l1, j1, l2, j2 = types[t]
+            if (j1, j2) not in rotations:
+                rotations[(j1, j2)] = np.kron(wgd.get(j1).toarray(),
+                                              wgd.get(j2).toarray())
+            return rotations[(j1, j2)]
+
+        values, rows, columns = [], [], []
+        for group, (sourceType, targetType) in enumerate(pairTypes):
+            _logProgress("Matrix R%d %.1f %% (channel group %d of %d)",
+                         matRIndex + 3,
+                         float(group + 1) / len(pairTypes) * 100.,
+                         group + 1, len(pairTypes))
+
+            sourceM = typeMIndices[sourceType]
+            targetM = typeMIndices[targetType]
+            if len(sourceM) == 0 or len(targetM) == 0:
+                continue
+
+            l1, j1, l2, j2 = types[sourceType]
+            l3, j3, l4, j4 = types[targetType]
+            d = self.__getAngularMatrix_M(int(round(l1)), j1,
+                                          int(round(l2)), j2,
+                                          int(round(l3)), j3,
+                                          int(round(l4)), j4)
+            block = rotation(targetType).dot(d).dot(
+                rotation(sourceType).T.conjugate())
+            block = block[np.ix_(targetM, sourceM)]
+            if (abs(self.phi) < 1e-9):
+                block = block.real
+            target, source = np.nonzero(np.abs(block) > 1.e-5)
+            angularFactor = block[target, source]
+
+            inGroup = (pairGroup == group)
+            ii = coupling.row[inGroup]
+            jj = coupling.col[inGroup]
+            radialPart = coupling.data[inGroup]
+
+            i = (self.index[ii][:, None] + source[None, :]).reshape(-1)
+            j = (self.index[jj][:, None] + target[None, :]).reshape(-1)
+            value = (radialPart[:, None] * angularFactor[None, :]).reshape(-1)
+
+            values += [value.conj(), value]
+            rows += [i, j]
+            columns += [j, i]
+
+        if len(values) == 0:
+            return csr_matrix((dimension, dimension))
+        return csr_matrix((np.concatenate(values),
+                           (np.concatenate(rows), np.concatenate(columns))),
+                          shape=(dimension, dimension))
 
     def __initializeDatabaseForMemoization(self):
         # memoization of angular parts
@@ -941,13 +1434,18 @@ class PairStateInteractions:
        .. _`degenerate pertubation C6 calculation example snippet`:
            ./ARC_3_0_introduction.html#Pertubative-C6-calculation-in-the-manifold-of-degenerate-states
 
+        Second order radial sums don't depend on orientation of the atoms,
+        and are calculated only once when `theta` and `phi` are arrays of
+        orientations.
+
         Args:
-            theta (float): orientation of inter-atomic axis with respect
-                to quantization axis (:math:`z`) in Euler coordinates
-                (measured in units of radian)
-            phi (float): orientation of inter-atomic axis with respect
-                to quantization axis (:math:`z`) in Euler coordinates
+            theta (float or array): orientation of inter-atomic axis with
+                respect to quantization axis (:math:`z`) in Euler coordinates
                 (measured in units of radian)
+            phi (float or array): orientation of inter-atomic axis with
+                respect to quantization axis (:math:`z`) in Euler coordinates
+                (measured in units of radian). Broadcasted together with
+                `theta`.
             nRange (int): how much below and above the given principal quantum number
                 of the pair state we should be looking
             energyDelta (float): what is maximum energy difference ( :math:`\Delta E/h` in Hz)
@@ -966,7 +1464,10 @@ class PairStateInteractions:
             AND array of corresponding eigenvectors in
             :math:`\{m_{j_1}=-j_1, \ldots, m_{j_1} = +j1\}\bigotimes \
             \{ m_{j_2}=-j_2, \ldots, m_{j_2} = +j2\}`
-            basis
+            basis. For arrays of orientations, returns array of :math:`C_6`
+            values with the shape of orientations, or arrays of :math:`C_6`
+            values and eigenvectors with additional last axes for
+            eigenstates (and basis) respectively.
 
 
         Example:
@@ -991,10 +1492,8 @@ class PairStateInteractions:
                 # list of atom orientations
                 thetaList = np.linspace(0,pi,30)
                 # do calculation of C6 pertubatively for all atom orientations
-                c6 = []
-                for theta in thetaList:
-                    value = calculation1.getC6perturbatively(theta,0,5,25e9)
-                    c6.append(value)
+                c6 = calculation1.getC6perturbatively(thetaList,0,5,25e9)
+                for theta, value in zip(thetaList, c6):
                     print ("theta = %.2f * pi \tC6 = %.2f GHz  mum^6" % (theta/pi,value))
                 # plot results
                 plot(thetaList/pi,c6,"b-")
@@ -1005,13 +1504,53 @@ class PairStateInteractions:
 
         """
         self.__initializeDatabaseForMemoization()
-
-        # ========= START OF THE MAIN CODE ===========
+        interactionMatrix = self.__getC6InteractionMatrix(nRange, energyDelta)
+        self.__closeDatabaseForMemoization()
 
         # wigner D matrix allows calculations with arbitrary orientation of
         # the two atoms
-        wgd = WignerDmatrix(theta, phi)
+        theta, phi = np.broadcast_arrays(np.asarray(theta, dtype=np.float64),
+                                         np.asarray(phi, dtype=np.float64))
+        rotatedMatrices = []
+        for t, p in zip(theta.ravel(), phi.ravel()):
+            wgd = WignerDmatrix(t, p)
+            rotationMatrix = np.kron(wgd.get(self.j).toarray(),
+                                     wgd.get(self.jj).toarray())
+            rotatedMatrices.append(rotationMatrix.dot(
+                interactionMatrix.dot(rotationMatrix.conj().T)
+                ))
+        interactionMatrix = np.array(rotatedMatrices)
+        dimension = interactionMatrix.shape[-1]
+
+        value, vectors = np.linalg.eigh(interactionMatrix)
+        value = value.reshape(theta.shape + (dimension,))
+        # eigenvectors as rows
+        vectors = np.swapaxes(vectors, -1, -2).reshape(
+            theta.shape + (dimension, dimension))
 
+        if not degeneratePerturbation:
+            # index of the original pair-state in the composite basis
+            stateIndex = int(round((self.j + self.m1) * (2 * self.jj + 1)
+                                   + self.jj + self.m2))
+            isEigenstate = np.abs(vectors[..., stateIndex]) > 1 - 1e-9
+            # if initial state is not eigen state, returns its
+            # expectation value
+            c6 = np.where(
+                np.any(isEigenstate, axis=-1),
+                np.take_along_axis(
+                    value, np.argmax(isEigenstate, axis=-1)[..., None],
+                    axis=-1)[..., 0],
+                np.real(interactionMatrix[:, stateIndex, stateIndex]
+                        ).reshape(theta.shape))
+            return c6[()]
+        return np.real(value), vectors
+
+    def __getC6InteractionMatrix(self, nRange, energyDelta):
+        """
+        Second order interaction matrix (in GHz mum^6) of the pair-state in
+        the unrotated basis of its m_j states, as sum over the dipole
+        coupled pair-states within energy defect `energyDelta` (in Hz).
+        """
         # any conservation?
         # this numbers are conserved if we use only dipole-dipole interactions
         Lmod2 = ((self.l + self.ll) % 2)
@@ -1115,47 +1654,9 @@ class PairStateInteractions:
 
                                     j2 = j2 + 1.0
                                 j1 = j1 + 1.0
+        return interactionMatrix
 
-        rotationMatrix = np.kron(wgd.get(self.j).toarray(),
-                                 wgd.get(self.jj).toarray())
-
-        interactionMatrix = rotationMatrix.dot(
-            interactionMatrix.dot(rotationMatrix.conj().T)
-            )
-        # ========= END OF THE MAIN CODE ===========
-        self.__closeDatabaseForMemoization()
-
-        value, vectors = np.linalg.eigh(interactionMatrix)
-        vectors = vectors.T
-        stateCom = compositeState(singleAtomState(self.j, self.m1),
-                           singleAtomState(self.jj, self.m2)).T
-
-        if not degeneratePerturbation:
-            for i, v in enumerate(vectors):
-                if (abs(np.vdot(v, stateCom)) > 1-1e-9):
-                    return value[i]
-            #    else:
-            #        print(np.vdot(v, stateCom))
-            # if initial state is not eigen state print warning and return
-            # results for eigenstates, and eigenstate composition
-            """
-            print("WARNING: Requested state is not eigenstate when dipole-dipole "
-                  "interactions and/or relative position of atoms are "
-                  "taken into account.\n"
-                  "We will use degenerate pertubative theory to correctly "
-                  "calculate C6.\n"
-                  "Method will return values AND eigenvectors in basis \n"
-                  "{mj1 = -j1, ... , mj1 = +j1} x {mj2 = -j2, ... , m2 = +j2}, "
-                  "where x denotes Kronecker product\n"
-                  "To not see this warning request explicitly "
-                  "degeneratePerturbation=True in call of this method.\n")
-            """
-            #print(stateCom.conj().dot(interactionMatrix.dot(stateCom.T)))
-            #print(stateCom.conj().dot(interactionMatrix.dot(stateCom.T)).shape)
-            return np.real(stateCom.conj().dot(
-                            interactionMatrix.dot(stateCom.T))[0][0])
-        return np.real(value), vectors
-
+    @_instrumented("basis definition")
     def defineBasis(self, theta, phi, nRange, lrange, energyDelta,
                     Bz=0, progressOutput=False, debugOutput=False):
         r"""
@@ -1175,6 +1676,13 @@ class PairStateInteractions:
             (:math:`\propto R^{-3}`), :obj:`matR[0]` stores dipole-quadrupole
             couplings etc.
 
+            Channels (:obj:`channel`) and their radial couplings don't depend
+            on orientation of the atoms. They are saved in
+            :obj:`channelCache` and reused when the basis is defined again
+            for different `theta` and `phi`, but same `nRange`, `lrange`,
+            `energyDelta` and `Bz` (for `theta` > 0). This speeds up scans of
+            anisotropy of interactions.
+
             Args:
                 theta (float):  relative orientation of the two atoms
                     (see figure on top of the page), range 0 to :math:`\pi`
@@ -1217,6 +1725,7 @@ class PairStateInteractions:
         self.Bz = Bz
 
         self.basisStates = []
+        self.matrixElement = []
 
         # wignerDmatrix
         wgd = WignerDmatrix(theta, phi)
@@ -1227,13 +1736,23 @@ class PairStateInteractions:
 
         originalMj = self.m1 + self.m2
 
-        self.channel, self.coupling = self.__makeRawMatrix2(
-            self.n, self.l, self.j,
-            self.nn, self.ll, self.jj,
-            nRange, lrange, energyDelta,
-            limitBasisToMj,
-            progressOutput=progressOutput,
-            debugOutput=debugOutput)
+        # channels and their couplings don't depend on orientation, and
+        # are reused from previous call with the same parameters
+        channelParameters = (nRange, lrange, energyDelta, Bz, limitBasisToMj)
+        if (getattr(self, "channelCache", None) is not None
+                and self.channelCache[0] == channelParameters):
+            channel, self.coupling = self.channelCache[1:]
+            self.channel = [list(c) for c in channel]
+            self.statistics.count("channel bases reused")
+        else:
+            self.channel, self.coupling = self.__makeRawMatrix2(
+                self.n, self.l, self.j,
+                self.nn, self.ll, self.jj,
+                nRange, lrange, energyDelta,
+                limitBasisToMj)
+            self.channelCache = (channelParameters,
+                                 [list(c) for c in self.channel],
+                                 self.coupling)
 
         self.atom1.updateDipoleMatrixElementsFile()
         self.atom2.updateDipoleMatrixElementsFile()
@@ -1244,7 +1763,7 @@ class PairStateInteractions:
         opi = 0
 
         # NEW FOR SPACE MATRIX
-        self.index = np.zeros(len(self.channel) + 1, dtype=np.int16)
+        self.index = np.zeros(len(self.channel) + 1, dtype=int)
 
         for i in xrange(len(self.channel)):
             self.index[i] = len(self.basisStates)
@@ -1274,156 +1793,34 @@ class PairStateInteractions:
                             and abs(m2c - self.m2) < 0.1):
                             opi = len(self.basisStates) - 1
             if (self.index[i] == len(self.basisStates)):
-                print(stateCoupled)
+                _logger.debug("No basis states for the channel %s",
+                              stateCoupled)
         self.index[-1] = len(self.basisStates)
 
-        if progressOutput or debugOutput:
-            print("\nCalculating Hamiltonian matrix...\n")
+        _logger.info("\nCalculating Hamiltonian matrix...\n")
 
         dimension = len(self.basisStates)
-        if progressOutput or debugOutput:
-            print("\n\tmatrix (dimension ", dimension, ")\n")
+        self.statistics.count("basis states", dimension)
+        _logger.info("\n\tmatrix (dimension %d)\n", dimension)
 
-        # INITIALIZING MATICES
-        # all (sparce) matrices will be saved in csr format
-        # value, row, column
-        matDiagonalConstructor = [[], [], []]
-
-        matRConstructor = [[[], [], []]
-                           for i in xrange(self.interactionsUpTo * 2 - 1)]
-
-        matRIndex = 0
-        for c in self.coupling:
-            progress = 0.
-            for ii in xrange(len(self.channel)):
-                if progressOutput:
-                    dim = len(self.channel)
-                    progress += ((dim - ii) * 2 - 1)
-                    sys.stdout.write(
-                        "\rMatrix R%d %.1f %% (state %d of %d)"
-                        % (matRIndex + 3,
-                           float(progress) / float(dim**2) * 100.,
-                           ii + 1,
-                           len(self.channel)))
-                    sys.stdout.flush()
-
-                ed = self.channel[ii][6]
-
-                # solves problems with exactly degenerate basisStates
-                degeneracyOffset = 0.00000001
-
-                i = self.index[ii]
-                dMatrix1 = wgd.get(self.basisStates[i][2])
-                dMatrix2 = wgd.get(self.basisStates[i][6])
-
-                for i in xrange(self.index[ii], self.index[ii + 1]):
-                    statePart1 = singleAtomState(
-                        self.basisStates[i][2], self.basisStates[i][3])
-                    statePart2 = singleAtomState(
-                        self.basisStates[i][6], self.basisStates[i][7])
-                    # rotate individual states
-
-                    statePart1 = dMatrix1.T.conjugate().dot(statePart1)
-                    statePart2 = dMatrix2.T.conjugate().dot(statePart2)
-
-                    stateCom = compositeState(statePart1, statePart2)
-
-                    if (matRIndex == 0):
-                        zeemanShift = (
-                            self.atom1.getZeemanEnergyShift(
-                                self.basisStates[i][1],
-                                self.basisStates[i][2],
-                                self.basisStates[i][3],
-                                self.Bz,
-                                s=self.s1)
-                            + self.atom2.getZeemanEnergyShift(
-                                self.basisStates[i][5],
-                                self.basisStates[i][6],
-                                self.basisStates[i][7],
-                                self.Bz,
-                                s=self.s2)
-                            ) / C_h * 1.0e-9   # in GHz
-                        matDiagonalConstructor[0].append(ed + zeemanShift
-                                                         + degeneracyOffset)
-                        degeneracyOffset += 0.00000001
-                        matDiagonalConstructor[1].append(i)
-                        matDiagonalConstructor[2].append(i)
-
-                    for dataIndex in xrange(c.indptr[ii], c.indptr[ii + 1]):
-
-                        jj = c.indices[dataIndex]
-                        radialPart = c.data[dataIndex]
-
-                        j = self.index[jj]
-                        dMatrix3 = wgd.get(self.basisStates[j][2])
-                        dMatrix4 = wgd.get(self.basisStates[j][6])
-
-                        if (self.index[jj] != self.index[jj + 1]):
-                            d = self.__getAngularMatrix_M(
-                                self.basisStates[i][1], self.basisStates[i][2],
-                                self.basisStates[i][5], self.basisStates[i][6],
-                                self.basisStates[j][1], self.basisStates[j][2],
-                                self.basisStates[j][5], self.basisStates[j][6])
-                            secondPart = d.dot(stateCom)
-                        else:
-                            print(" - - - ", self.channel[jj])
-
-                        for j in xrange(self.index[jj], self.index[jj + 1]):
-                            statePart1 = singleAtomState(
-                                self.basisStates[j][2], self.basisStates[j][3])
-                            statePart2 = singleAtomState(
-                                self.basisStates[j][6], self.basisStates[j][7])
-                            # rotate individual states
-
-                            statePart1 = dMatrix3.T.conjugate().dot(statePart1)
-                            statePart2 = dMatrix4.T.conjugate().dot(statePart2)
-                            # composite state of two atoms
-                            stateCom2 = compositeState(statePart1, statePart2)
-
-                            angularFactor = stateCom2.T.conjugate().dot(secondPart)
-                            if (abs(self.phi) < 1e-9):
-                                angularFactor = angularFactor[0, 0].real
-                            else:
-                                angularFactor = angularFactor[0, 0]
-
-                            if (abs(angularFactor) > 1.e-5):
-                                matRConstructor[matRIndex][0].append(
-                                    (radialPart * angularFactor).conj())
-                                matRConstructor[matRIndex][1].append(i)
-                                matRConstructor[matRIndex][2].append(j)
-
-                                matRConstructor[matRIndex][0].append(
-                                    radialPart * angularFactor)
-                                matRConstructor[matRIndex][1].append(j)
-                                matRConstructor[matRIndex][2].append(i)
-            matRIndex += 1
-            if progressOutput or debugOutput:
-                print("\n")
-
-        self.matDiagonal = csr_matrix(
-            (matDiagonalConstructor[0],
-             (matDiagonalConstructor[1], matDiagonalConstructor[2])),
-            shape=(dimension, dimension)
-            )
-
-        self.matR = [
-            csr_matrix((matRConstructor[i][0],
-                        (matRConstructor[i][1], matRConstructor[i][2])),
-                       shape=(dimension, dimension)
-                       ) for i in xrange(self.interactionsUpTo * 2 - 1)
-            ]
+        with self.statistics.stage("m-resolved expansion"):
+            self.matDiagonal = self.__getDiagonalMatrix()
+            self.matR = [self.__expandCoupling(c, wgd, matRIndex)
+                         for matRIndex, c in enumerate(self.coupling)]
 
         self.originalPairStateIndex = opi
 
         self.__updateAngularMatrixElementsFile()
         self.__closeDatabaseForMemoization()
 
+    @_instrumented("diagonalisation")
     def diagonalise(self, rangeR, noOfEigenvectors,
                     drivingFromState=[0, 0, 0, 0, 0],
                     eigenstateDetuning=0.,
                     sortEigenvectors=False,
                     progressOutput=False,
-                    debugOutput=False):
+                    debugOutput=False,
+                    targetStates=None):
         r"""
             Finds eigenstates in atom pair basis.
 
@@ -1473,6 +1870,13 @@ class PairStateInteractions:
                     similarly to progressOutput=True, this will print
                     information about the progress of calculations, but with
                     more verbose output.
+                targetStates (list): optional, list of pair-states
+                    [[n1,l1,j1,mj1,n2,l2,j2,mj2], ...] from
+                    :obj:`basisStates`. If specified, contributions of each of
+                    these states in the obtained eigenstates are saved in
+                    :obj:`targetStateContributions`, which allows finding
+                    interaction coefficients for all of them with
+                    :obj:`getCnFromLevelDiagram`.
         """
 
         self.r = np.sort(rangeR)
@@ -1487,6 +1891,18 @@ class PairStateInteractions:
         # what are the dominant contributing states?
         self.composition = []
 
+        # how much of each of the target states is contained in eigenvectors
+        self.targetStateContributions = []
+        targetIndices = []
+        if targetStates is not None:
+            basisIndex = dict((tuple(state), i)
+                              for i, state in enumerate(self.basisStates))
+            for state in targetStates:
+                if tuple(state) not in basisIndex:
+                    raise ValueError("Target state %s is not in the basis "
+                                     "(basisStates)." % str(state))
+                targetIndices.append(basisIndex[tuple(state)])
+
         if (noOfEigenvectors >= dimension - 1):
             noOfEigenvectors = dimension - 1
             print("Warning: Requested number of eigenvectors >=dimension-1\n \
@@ -1500,8 +1916,8 @@ class PairStateInteractions:
         self.maxCoupledStateIndex = 0
         if (drivingFromState[0] != 0):
             self.drivingFromState = drivingFromState
-            if progressOutput:
-                print("Finding coupling strengths")
+            _logger.info("Finding coupling strengths")
+            debugOutput = _logger.isEnabledFor(logging.DEBUG)
             # get first what was the state we are calculating coupling with
             state1 = drivingFromState
             n1 = int(round(state1[0]))
@@ -1533,9 +1949,10 @@ class PairStateInteractions:
                     j2 = state2[2 + 4]
                     m2 = state2[3 + 4]
                     if debugOutput:
-                        print(n1, " ", l1, " ", j1, " ", m1, " ", n2,
-                              " ", l2, " ", j2, " ", m2, " q=", q)
-                        print(self.basisStates[i])
+                        _logger.debug("%s   %s   %s   %s   %s   %s   %s"
+                                      "   %s  q= %s",
+                                      n1, l1, j1, m1, n2, l2, j2, m2, q)
+                        _logger.debug("%s", self.basisStates[i])
                     dme = self.atom2.getDipoleMatrixElement(n1, l1, j1, m1,
                                                            n2, l2, j2, m2,
                                                            q,  s=self.s2)
@@ -1546,29 +1963,25 @@ class PairStateInteractions:
                     self.maxCoupling = thisCoupling
                     self.maxCoupledStateIndex = i
                 if (thisCoupling > 0.000001) and debugOutput:
-                    print("original pairstate index = ",
-                          self.originalPairStateIndex)
-                    print("this pairstate index = ", i)
-                    print("state itself ", self.basisStates[i])
-                    print("coupling = ", thisCoupling)
+                    _logger.debug("original pairstate index =  %d",
+                                  self.originalPairStateIndex)
+                    _logger.debug("this pairstate index =  %d", i)
+                    _logger.debug("state itself  %s", self.basisStates[i])
+                    _logger.debug("coupling =  %s", thisCoupling)
                 coupling.append(thisCoupling)
 
-            print("Maximal coupling from a state")
-            print("is to a state ",
-                  self.basisStates[self.maxCoupledStateIndex])
-            print("is equal to %.3e a_0 e" % self.maxCoupling)
+            _logger.info("Maximal coupling from a state")
+            _logger.info("is to a state  %s",
+                         self.basisStates[self.maxCoupledStateIndex])
+            _logger.info("is equal to %.3e a_0 e", self.maxCoupling)
 
-        if progressOutput:
-            print("\n\nDiagonalizing interaction matrix...\n")
+        _logger.info("\n\nDiagonalizing interaction matrix...\n")
 
         rvalIndex = 0.
         previousEigenvectors = []
 
         for rval in self.r:
-            if progressOutput:
-                sys.stdout.write("\r%d%%" %
-                                 (rvalIndex / len(self.r - 1) * 100.))
-                sys.stdout.flush()
+            _logProgress("%d%%", rvalIndex / len(self.r - 1) * 100.)
             rvalIndex += 1.
 
             # calculate interaction matrix
@@ -1587,6 +2000,7 @@ class PairStateInteractions:
                 sigma=eigenstateDetuning * 1.e-9,
                 which='LM',
                 tol=1E-6)
+            self.statistics.count("diagonalisations")
 
             if sortEigenvectors:
                 # Find which eigenvectors overlap most with eigenvectors from
@@ -1626,6 +2040,9 @@ class PairStateInteractions:
                 previousEigenvectors = np.copy(egvector)
 
             self.y.append(ev)
+            if targetStates is not None:
+                self.targetStateContributions.append(
+                    np.abs(egvector[targetIndices, :])**2)
 
             if (drivingFromState[0] < 0.1):
                 # if we've defined from which state we are driving
@@ -1652,12 +2069,15 @@ class PairStateInteractions:
                 self.composition.append(comp)
 
         # end of FOR loop over inter-atomic dinstaces
+        if targetStates is not None:
+            self.targetStateContributions = np.array(
+                self.targetStateContributions)
 
-    def exportData(self, fileBase, exportFormat="csv"):
+    def exportData(self, fileBase, exportFormat="csv", compressed=False):
         """
             Exports PairStateInteractions calculation data.
 
-            Only supported format (selected by default) is .csv in a
+            Default format is .csv in a
             human-readable form with a header that saves details of calculation.
             Function saves three files: 1) `filebase` _r.csv;
             2) `filebase` _energyLevels
@@ -1665,12 +2085,26 @@ class PairStateInteractions:
 
             For more details on the format, see header of the saved files.
 
+            Alternatively, with `exportFormat="npz"`, data is saved in binary
+            form in a single file `filebase`.npz, with arrays `r`,
+            `energyLevels` and `highlight` (one row for each
+            interatomic distance),
+            `basisStates` (one row for each basis state) and `header`
+            (string with the details of calculation). Such files are much
+            faster to write and read, and can be loaded with `np.load`.
+            Arrays are written in blocks of rows, so large calculations are
+            exported without making additional copy of all the data in
+            memory, but arrays are not chunked within the saved file, and
+            `np.load` reads each of them as a whole.
+
             Args:
                 filebase (string): filebase for the names of the saved files
                     without format extension. Add as a prefix a directory path
                     if necessary (e.g. saving outside the current working directory)
-                exportFormat (string): optional. Format of the exported file. Currently
-                    only .csv is supported but this can be extended in the future.
+                exportFormat (string): optional. Format of the exported
+                    file, "csv" (default) or "npz".
+                compressed (bool): optional. Should binary "npz" file be
+                    compressed. Default False.
         """
         fmt = 'on %Y-%m-%d @ %H:%M:%S'
         ts = datetime.datetime.now().strftime(fmt)
@@ -1767,8 +2201,18 @@ class PairStateInteractions:
             print("   Highlight values saved in %s" % filename)
 
             print("... data export finished!")
+        elif exportFormat == "npz":
+            filename = _exportArrays(
+                fileBase, commonHeader,
+                {"r": self.r,
+                 "energyLevels": self.y,
+                 "highlight": self.highlight,
+                 "basisStates": self.basisStates},
+                compressed=compressed)
+            print("Calculation data saved in %s" % filename)
         else:
-            raise ValueError("Unsupported export format (.%s)." % format)
+            raise ValueError("Unsupported export format (.%s)."
+                             % exportFormat)
 
     def _stateComposition(self, stateVector):
         contribution = np.absolute(stateVector)
@@ -1991,6 +2435,144 @@ class PairStateInteractions:
 
             event.canvas.draw()
 
+    def __getLevelBranches(self, rStart, rStop, minStateContribution,
+                           contributions, resonantBranch=0,
+                           detectDiscontinuity=False):
+        """
+        Energy levels of the eigenstates with the highest contribution of
+        the target states, at distances in the range [`rStart`, `rStop`].
+
+        Args:
+            contributions (array): contributions of the target states in
+                the eigenstates, indexed [target, distance, eigenstate]
+            resonantBranch (int): if non-zero, only eigenstates with
+                energies of that sign are considered
+            detectDiscontinuity (bool): if True, distances are ordered from
+                `rStop` to `rStart`, and the branch is ended at the first
+                discontinuity of its slope
+
+        Returns:
+            list of (distances, absolute energies) arrays for each target,
+            or None if there are no distances in the range
+        """
+        r = np.asarray(self.r)
+        inRange = (r >= rStart) & (r <= rStop)
+        if not np.any(inRange):
+            return None
+
+        energies = _padded(self.y, np.nan)
+        contributions = np.abs(contributions)
+        if resonantBranch != 0:
+            contributions = np.where(energies * resonantBranch > 0.,
+                                     contributions, -np.inf)
+        index = np.argmax(contributions, axis=-1)[..., None]
+        found = inRange & (np.take_along_axis(contributions, index, -1)[..., 0]
+                           > minStateContribution)
+        detunings = np.abs(
+            np.take_along_axis(energies[None], index, -1)[..., 0])
+
+        branches = []
+        for targetFound, detuning in zip(found, detunings):
+            x = r[targetFound]
+            y = detuning[targetFound]
+            if detectDiscontinuity:
+                x, y = x[::-1], y[::-1]
+                slope = np.diff(y) / np.diff(x)
+                # after first three points, slope of the branch can't
+                # suddenly increase more than 3 times
+                jumps = np.nonzero(np.abs(slope[2:])
+                                   > 3. * np.abs(slope[1:-1]))[0]
+                if len(jumps) > 0:
+                    x, y = x[:jumps[0] + 3], y[:jumps[0] + 3]
+            branches.append((x, y))
+        return branches
+
+    def __fitPowerLaw(self, r, energy, exponent):
+        """
+        Fits energies to :math:`C_n/R^n+A` by closed-form linear least
+        squares, weighted by energy to give relative errors (as when
+        fitting log of energies).
+
+        Points with zero (or relatively negligible) energy, e.g. where the
+        level crosses the asymptote, can't be weighted in this way and are
+        not used in the fit.
+
+        Returns:
+            :math:`C_n` and offset :math:`A`
+        """
+        r = np.asarray(r, dtype=np.float64)
+        energy = np.asarray(energy, dtype=np.float64)
+        valid = np.isfinite(energy) & np.isfinite(r)
+        if np.any(valid):
+            valid &= (np.abs(energy)
+                      > 1.e-12 * np.max(np.abs(energy[valid])))
+        r = r[valid]
+        energy = energy[valid]
+        if len(r) < 2:
+            raise ValueError("Not enough data points with non-zero energy "
+                             "for fitting (found %d)." % len(r))
+        design = np.stack((r**(-float(exponent)), np.ones(len(r))),
+                          axis=-1) / energy[:, None]
+        solution, residuals, rank, sv = np.linalg.lstsq(
+            design, np.ones(len(r)), rcond=None)
+        if rank < 2:
+            raise ValueError("Fitting problem is singular.")
+        return solution[0], solution[1]
+
+    def getCnFromLevelDiagram(self, rStart, rStop, exponent,
+                              minStateContribution=0.0):
+        """
+            Finds :math:`C_n` coefficients for many target pair states.
+
+            For each of the target states specified in the call of
+            :obj:`diagonalise` (`targetStates`), function finds the eigen
+            state with the highest contribution of the target state at each
+            distance in the range [ `rStart` , `rStop` ], and fits the
+            energy of this state :math:`E(R)` to :math:`A+C_n/R^n`, where
+            :math:`A` is some offset. If target states were not specified,
+            fits only the original pair state, as :obj:`getC6fromLevelDiagram`
+            does.
+
+            Args:
+                rStart (float): smallest inter-atomic distance to be used for
+                    fitting
+                rStop (float): maximum inter-atomic distance to be used for
+                    fitting
+                exponent (int): power :math:`n` of the interaction, e.g. 6
+                    for van der Waals and 3 for resonant dipole-dipole
+                    interactions
+                minStateContribution (float): valid values are in the range
+                    [0,1). It specifies minimum amount of the target state in
+                    the given energy state necessary for the state to be
+                    considered for the adiabatic continuation of the target
+                    state.
+
+            Returns:
+                array: :math:`C_n` measured in
+                :math:`\\text{GHz }\\mu\\text{m}^n` for each of the target
+                states, `nan` where the fit was not possible.
+        """
+        if len(self.targetStateContributions) > 0:
+            contributions = np.swapaxes(self.targetStateContributions, 0, 1)
+        else:
+            contributions = _padded(self.highlight, 0.)[None]
+
+        branches = self.__getLevelBranches(rStart, rStop,
+                                           minStateContribution,
+                                           contributions)
+        if branches is None:
+            print("\nERROR: could not find data for energy levels for interatomic")
+            print("distances between %2.f and %.2f mu m.\n\n" % (rStart, rStop))
+            return np.full(len(contributions), np.nan)
+
+        cn = np.full(len(branches), np.nan)
+        for i, (x, y) in enumerate(branches):
+            try:
+                cn[i] = self.__fitPowerLaw(x, y, exponent)[0]
+            except ValueError:
+                pass
+        return cn
+
     def getC6fromLevelDiagram(self, rStart, rStop, showPlot=False,
                               minStateContribution=0.0):
         """
@@ -2033,57 +2615,30 @@ class PairStateInteractions:
                 `drivingFromState` parameter should not be set, which
                 corresponds to `drivingFromState` = [0,0,0,0,0]).
         """
-        initialStateDetuning = []
-        initialStateDetuningX = []
-
-        fromRindex = -1
-        toRindex = -1
-        for br in xrange(len(self.r)):
-            if (fromRindex == -1) and (self.r[br] >= rStart):
-                fromRindex = br
-            if (self.r[br] > rStop):
-                toRindex = br - 1
-                break
-        if (fromRindex != -1) and (toRindex == -1):
-            toRindex = len(self.r) - 1
-        if (fromRindex == -1):
+        branches = self.__getLevelBranches(rStart, rStop,
+                                           minStateContribution,
+                                           _padded(self.highlight, 0.)[None])
+        if branches is None:
             print("\nERROR: could not find data for energy levels for interatomic")
             print("distances between %2.f and %.2f mu m.\n\n" % (rStart, rStop))
             return 0
-
-        for br in xrange(fromRindex, toRindex + 1):
-            index = -1
-            maxPortion = minStateContribution
-            for br2 in xrange(len(self.y[br])):
-                if (abs(self.highlight[br][br2]) > maxPortion):
-                    index = br2
-                    maxPortion = abs(self.highlight[br][br2])
-            if (index != -1):
-                initialStateDetuning.append(abs(self.y[br][index]))
-                initialStateDetuningX.append(self.r[br])
-
-        initialStateDetuning = np.log(np.array(initialStateDetuning))
-        initialStateDetuningX = np.array(initialStateDetuningX)
+        initialStateDetuningX, initialStateDetuning = branches[0]
 
         def c6fit(r, c6, offset):
             return np.log(c6 / r**6 + offset)
 
         try:
-            popt, pcov = curve_fit(c6fit,
-                                   initialStateDetuningX,
-                                   initialStateDetuning,
-                                   [1, 0])
+            popt = self.__fitPowerLaw(initialStateDetuningX,
+                                      initialStateDetuning, 6)
         except Exception as ex:
             print(ex)
             print("ERROR: unable to find a fit for C6.")
             return False
+        initialStateDetuning = np.log(initialStateDetuning)
         print("c6 = ", popt[0], " GHz /R^6 (mu m)^6")
         print("offset = ", popt[1])
 
-        y_fit = []
-        for val in initialStateDetuningX:
-            y_fit.append(c6fit(val, popt[0], popt[1]))
-        y_fit = np.array(y_fit)
+        y_fit = c6fit(initialStateDetuningX, popt[0], popt[1])
 
         if showPlot:
             fig, ax = plt.subplots(1, 1, figsize=(8.0, 5.0))
@@ -2166,73 +2721,35 @@ class PairStateInteractions:
                 corresponds to `drivingFromState` = [0,0,0,0,0]).
         """
 
-        selectBranch = False
-        if (abs(self.l - self.ll) == 1):
-            selectBranch = True
-            resonantBranch = float(resonantBranch)
-
-        initialStateDetuning = []
-        initialStateDetuningX = []
-
-        fromRindex = -1
-        toRindex = -1
-        for br in xrange(len(self.r)):
-            if (fromRindex == -1) and (self.r[br] >= rStart):
-                fromRindex = br
-            if (self.r[br] > rStop):
-                toRindex = br - 1
-                break
-        if (fromRindex != -1) and (toRindex == -1):
-            toRindex = len(self.r) - 1
-        if (fromRindex == -1):
+        if (abs(self.l - self.ll) != 1):
+            resonantBranch = 0
+
+        branches = self.__getLevelBranches(rStart, rStop,
+                                           minStateContribution,
+                                           _padded(self.highlight, 0.)[None],
+                                           resonantBranch=resonantBranch,
+                                           detectDiscontinuity=True)
+        if branches is None:
             print("\nERROR: could not find data for energy levels for interatomic")
             print("distances between %2.f and %.2f mu m.\n\n" % (rStart, rStop))
             return False
-
-        discontinuityDetected = False
-        for br in xrange(toRindex, fromRindex - 1, -1):
-            index = -1
-            maxPortion = minStateContribution
-            for br2 in xrange(len(self.y[br])):
-                if (abs(self.highlight[br][br2]) > maxPortion) \
-                        and (not selectBranch or (self.y[br][br2] * selectBranch > 0.)):
-                    index = br2
-                    maxPortion = abs(self.highlight[br][br2])
-
-            if (len(initialStateDetuningX) > 2):
-                slope1 = (initialStateDetuning[-1] - initialStateDetuning[-2]) /\
-                    (initialStateDetuningX[-1] - initialStateDetuningX[-2])
-                slope2 = (abs(self.y[br][index]) - initialStateDetuning[-1]) /\
-                    (self.r[br] - initialStateDetuningX[-1])
-                if abs(slope2) > 3. * abs(slope1):
-                    discontinuityDetected = True
-            if (index != -1)and (not discontinuityDetected):
-                initialStateDetuning.append(abs(self.y[br][index]))
-                initialStateDetuningX.append(self.r[br])
-
-        initialStateDetuning = np.log(np.array(initialStateDetuning))  # *1e9
-        initialStateDetuningX = np.array(initialStateDetuningX)
+        initialStateDetuningX, initialStateDetuning = branches[0]
 
         def c3fit(r, c3, offset):
             return np.log(c3 / r**3 + offset)
 
         try:
-            popt, pcov = curve_fit(c3fit,
-                                   initialStateDetuningX,
-                                   initialStateDetuning,
-                                   [1, 0])
+            popt = self.__fitPowerLaw(initialStateDetuningX,
+                                      initialStateDetuning, 3)
         except Exception as ex:
             print(ex)
             print("ERROR: unable to find a fit for C3.")
             return False
+        initialStateDetuning = np.log(initialStateDetuning)
         print("c3 = ", popt[0], " GHz /R^3 (mu m)^3")
         print("offset = ", popt[1])
 
-        y_fit = []
-
-        for val in initialStateDetuningX:
-            y_fit.append(c3fit(val, popt[0], popt[1]))
-        y_fit = np.array(y_fit)
+        y_fit = c3fit(initialStateDetuningX, popt[0], popt[1])
 
         if showPlot:
             fig, ax = plt.subplots(1, 1, figsize=(8.0, 5.0))
@@ -2321,45 +2838,16 @@ class PairStateInteractions:
                 corresponds to `drivingFromState` = [0,0,0,0,0]).
         """
 
-        initialStateDetuning = []
-        initialStateDetuningX = []
-
-        fromRindex = -1
-        toRindex = -1
-        for br in xrange(len(self.r)):
-            if (fromRindex == -1) and (self.r[br] >= rStart):
-                fromRindex = br
-            if (self.r[br] > rStop):
-                toRindex = br - 1
-                break
-        if (fromRindex != -1) and (toRindex == -1):
-            toRindex = len(self.r) - 1
-        if (fromRindex == -1):
+        branches = self.__getLevelBranches(rStart, rStop,
+                                           minStateContribution,
+                                           _padded(self.highlight, 0.)[None],
+                                           detectDiscontinuity=True)
+        if branches is None:
             print("\nERROR: could not find data for energy levels for interatomic")
             print("distances between %2.f and %.2f mu m.\n\n" % (rStart, rStop))
             return False
-
-        discontinuityDetected = False
-        for br in xrange(toRindex, fromRindex - 1, -1):
-            index = -1
-            maxPortion = minStateContribution
-            for br2 in xrange(len(self.y[br])):
-                if (abs(self.highlight[br][br2]) > maxPortion):
-                    index = br2
-                    maxPortion = abs(self.highlight[br][br2])
-            if (len(initialStateDetuningX) > 2):
-                slope1 = (initialStateDetuning[-1] - initialStateDetuning[-2]) /\
-                    (initialStateDetuningX[-1] - initialStateDetuningX[-2])
-                slope2 = (abs(self.y[br][index]) - initialStateDetuning[-1]) /\
-                    (self.r[br] - initialStateDetuningX[-1])
-                if abs(slope2) > 3. * abs(slope1):
-                    discontinuityDetected = True
-            if (index != -1)and (not discontinuityDetected):
-                initialStateDetuning.append(abs(self.y[br][index]))
-                initialStateDetuningX.append(self.r[br])
-
-        initialStateDetuning = np.log(abs(np.array(initialStateDetuning)))
-        initialStateDetuningX = np.array(initialStateDetuningX)
+        initialStateDetuningX, initialStateDetuning = branches[0]
+        initialStateDetuning = np.log(initialStateDetuning)
 
         def vdwFit(r, offset, scale, vdw):
             return np.log(abs(offset
@@ -2392,11 +2880,7 @@ class PairStateInteractions:
         print("Rvdw =  ", popt[2], " mu m")
         print("offset = ", popt[0], "\n scale = ", popt[1])
 
-        y_fit = []
-
-        for val in initialStateDetuningX:
-            y_fit.append(vdwFit(val, popt[0], popt[1], popt[2]))
-        y_fit = np.array(y_fit)
+        y_fit = vdwFit(initialStateDetuningX, popt[0], popt[1], popt[2])
 
         if showPlot:
             fig, ax = plt.subplots(1, 1, figsize=(8.0, 5.0))
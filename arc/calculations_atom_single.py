@@ -11,8 +11,10 @@
 from __future__ import print_function
 
 from .alkali_atom_functions import printStateString, _EFieldCoupling, printStateLetter, printStateStringLatex
+from .alkali_atom_functions import _exportArrays
 import datetime
 import sqlite3
+from multiprocessing import Pool
 import matplotlib
 from matplotlib.colors import LinearSegmentedColormap
 from math import sqrt
@@ -27,7 +29,7 @@ from scipy.constants import c as C_c
 from scipy.constants import h as C_h
 from scipy.constants import e as C_e
 from scipy.constants import m_e as C_m_e
-from scipy.optimize import curve_fit
+from scipy.optimize import curve_fit, brentq
 from scipy import interpolate
 
 # for matrices
@@ -35,6 +37,7 @@ from numpy.linalg import eigh
 
 from scipy.sparse import csr_matrix
 from scipy.sparse.linalg import eigsh
+from scipy.linalg import eigh_tridiagonal
 from scipy.special import sph_harm
 
 import sys
@@ -51,6 +54,98 @@ sqlite3.register_adapter(np.int32, int)
 def Ylm(l, m, theta, phi):
     return sph_harm(m, l, phi, theta)
 
+
+def _rTimesPsiSpherical(wavefunction, theta, phi, r):
+    r"""
+        :math:`r \cdot \psi_{m_s}` for :math:`m_s=+1/2` and :math:`-1/2`
+        (see :obj:`Wavefunction.getRtimesPsiSpherical`) of the state
+        described by `wavefunction`, tuple of basis states, coefficients,
+        radial wavefunction indices, radial wavefunctions on grids, and
+        Clebsch-Gordan coefficients of the basis states (see
+        :obj:`Wavefunction`).
+    """
+    basisStates, coef, radialIndex, radialGrids, cgCoefficients = \
+        wavefunction
+    theta, phi, r = np.broadcast_arrays(theta, phi, r)
+
+    wfElectronP = np.zeros(theta.shape, dtype=np.complex128)  # spin +1/2
+    wfElectronM = np.zeros(theta.shape, dtype=np.complex128)  # spin -1/2
+
+    # radial and angular parts are evaluated once for all the basis
+    # states that share them
+    radial = {}
+    angular = {}
+    for i, state in enumerate(basisStates):
+        l = state[1]
+        mj = state[3]
+        cgP, cgM = cgCoefficients[i]
+        if cgP == 0 and cgM == 0:
+            continue
+
+        k = radialIndex[i]
+        if k not in radial:
+            rGrid, rWavefunc = radialGrids[k]
+            radial[k] = np.interp(r, rGrid, rWavefunc, left=0., right=0.)
+        amplitude = radial[k] * coef[i]
+
+        for cg, m, wf in ((cgP, mj - 0.5, wfElectronP),
+                          (cgM, mj + 0.5, wfElectronM)):
+            if cg == 0:
+                continue
+            key = (l, int(round(m)))
+            if key not in angular:
+                angular[key] = Ylm(l, m, theta, phi)
+            wf += cg * angular[key] * amplitude
+
+    return wfElectronP[()], wfElectronM[()]
+
+
+# wavefunction evaluated by the worker processes (see _getDensityTile)
+_tileWavefunction = None
+
+
+def _setTileWavefunction(wavefunction):
+    global _tileWavefunction
+    _tileWavefunction = wavefunction
+
+
+def _getDensityTile(tile, wavefunction=None):
+    r"""
+        Evaluates :math:`|\psi|^2` (or :math:`|r \cdot \psi|^2`) in one
+        tile of :obj:`Wavefunction._getDensityOnGrid`, for (x, y) rows from
+        `start` to `stop`. Result is written to `outputFile` if given,
+        otherwise it's returned. If `wavefunction` (see
+        :obj:`_rTimesPsiSpherical`) is not given, wavefunction set for the
+        worker process by :obj:`_setTileWavefunction` is used.
+    """
+    x, y, z, start, stop, scale, rTimesPsi, outputFile = tile
+    if wavefunction is None:
+        wavefunction = _tileWavefunction
+    ny = len(y)
+    index = np.arange(start, stop)
+    tileX = x[index // ny][:, None]
+    tileY = y[index % ny][:, None]
+    tileZ = z[None, :]
+    r2 = tileX**2 + tileY**2 + tileZ**2
+    wfP, wfM = _rTimesPsiSpherical(
+        wavefunction, np.arctan2(np.sqrt(tileX**2 + tileY**2), tileZ),
+        np.arctan2(tileY, tileX), np.sqrt(r2))
+    result = np.abs(wfP)**2 + np.abs(wfM)**2
+    if rTimesPsi:
+        result /= scale**2
+    else:
+        # radial wavefunctions vanish close to the core
+        np.divide(result, r2, out=result, where=r2 > 0)
+        result /= scale**3
+
+    if outputFile is None:
+        return result
+    density = np.load(outputFile, mmap_mode="r+")
+    density.reshape(-1, len(z))[start:stop] = result
+    density.flush()
+    del density
+    return None
+
 class Wavefunction:
     r"""
         Calculates and plots electron wavefunctions.
@@ -89,28 +184,60 @@ class Wavefunction:
                              "separete array [c1, ...]")
         self.basisStates = basisStates
         self.coef = coefficients
-        self.basisWavefunctions = []
+        self._basisWavefunctions = None
+
+        # radial wavefunctions are calculated only once for states that
+        # differ only in mj; basis state i uses radial wavefunction
+        # self._radialIndex[i] stored on grid self._radialGrids
+        self._radialIndex = []
+        self._radialGrids = []
+        radialIndex = {}
+        # Clebsch-Gordan coefficients for electron spin +1/2 and -1/2
+        self._cgCoefficients = []
 
         for state in self.basisStates:
             n = state[0]
             l = state[1]
             j = state[2]
+            mj = state[3]
 
-            # calculate radial wavefunction
-            step = 0.001
-            r, rWavefunc = atom.radialWavefunction(
-                l, 0.5, j,
-                self.atom.getEnergy(n, l, j) / 27.211,
-                self.atom.alphaC**(1 / 3.0),
-                2.0 * n * (n + 15.0), step)
-            suma = np.trapz(rWavefunc**2, x=r)
-            rWavefunc = rWavefunc / (sqrt(suma))
-
-            self.basisWavefunctions.append(
-                interpolate.interp1d(r, rWavefunc,
-                                    bounds_error=False,
-                                    fill_value=(0,0))
-                )
+            if (n, l, j) not in radialIndex:
+                # calculate radial wavefunction
+                step = 0.001
+                r, rWavefunc = atom.radialWavefunction(
+                    l, 0.5, j,
+                    self.atom.getEnergy(n, l, j) / 27.211,
+                    self.atom.alphaC**(1 / 3.0),
+                    2.0 * n * (n + 15.0), step)
+                suma = np.trapz(rWavefunc**2, x=r)
+                rWavefunc = rWavefunc / (sqrt(suma))
+
+                radialIndex[(n, l, j)] = len(self._radialGrids)
+                self._radialGrids.append((r, rWavefunc))
+            self._radialIndex.append(radialIndex[(n, l, j)])
+
+            cgP = 0.
+            cgM = 0.
+            if abs(mj - 0.5) - 0.1 < l:
+                cgP = CG(l, mj-0.5, 0.5, +0.5, j, mj)
+            if abs(mj + 0.5) - 0.1 < l:
+                cgM = CG(l, mj+0.5, 0.5, -0.5, j, mj)
+            self._cgCoefficients.append((cgP, cgM))
+
+    @property
+    def basisWavefunctions(self):
+        """
+            Interpolated radial wavefunctions of the basis states (functions
+            of the distance in units of :math:`a_0`). They are not used by
+            the calculations, and are created only when requested.
+        """
+        if self._basisWavefunctions is None:
+            self._basisWavefunctions = [
+                interpolate.interp1d(self._radialGrids[k][0],
+                                     self._radialGrids[k][1],
+                                     bounds_error=False, fill_value=(0, 0))
+                for k in self._radialIndex]
+        return self._basisWavefunctions
 
     def getRtimesPsiSpherical(self, theta, phi, r):
         r"""
@@ -141,26 +268,19 @@ class Wavefunction:
                 returns :math:`r \cdot \psi_{m_s=+1/2} (\theta, \phi, r)` and
                 :math:`r \cdot \psi_{m_s=-1/2} (\theta, \phi, r) `.
                 )`
-        """
 
-        wfElectronP = 0+0j  # electron spin +1/2
-        wfElectronM = 0+0j  # electron spin -1/2
+            Coordinates can also be given as arrays (e.g. a mesh of points),
+            in which case wavefunction is evaluated for all points at once,
+            and returned values are arrays of the same shape.
+        """
+        return _rTimesPsiSpherical(self._getWavefunctionData(),
+                                   theta, phi, r)
 
-        for i, state in enumerate(self.basisStates):
-            l = state[1]
-            j = state[2]
-            mj = state[3]
-            if abs(mj - 0.5) - 0.1 < l:
-                wfElectronP += CG(l, mj-0.5, 0.5, +0.5, j, mj) \
-                               * Ylm(l, mj-0.5, theta, phi)\
-                               * self.basisWavefunctions[i](r) \
-                               * self.coef[i]
-            if abs(mj + 0.5) - 0.1 < l:
-                wfElectronM += CG(l, mj+0.5, 0.5, -0.5, j, mj) \
-                               * Ylm(l, mj+0.5, theta, phi) \
-                               * self.basisWavefunctions[i](r) \
-                               * self.coef[i]
-        return wfElectronP, wfElectronM
+    def _getWavefunctionData(self):
+        # everything needed for evaluation of the wavefunction
+        # (see _rTimesPsiSpherical), without the atom
+        return (self.basisStates, self.coef, self._radialIndex,
+                self._radialGrids, self._cgCoefficients)
 
     def getRtimesPsi(self, x, y, z):
         r"""
@@ -233,7 +353,9 @@ class Wavefunction:
                                    plane="x-z",
                                    pointsPerAxis=150,
                                    axisLength=None,
-                                   units="atomic"
+                                   units="atomic",
+                                   memoryLimit=2**28,
+                                   processes=1
                                    ):
         r"""
         Calculates :math:`|r \cdot \psi|^2` on a mesh in a given plane.
@@ -252,6 +374,11 @@ class Wavefunction:
                 will be **returned** (note that `axisLength` is on the other
                 hand always in atomi units.). Supported values are
                 `'atomic'` or `'nm'`. Default value `'atomic'` .
+            memoryLimit (int): optional, approximate upper limit for memory
+                (in bytes) used for intermediate results, see
+                :obj:`getPsiSquaredInBox`. Default is 256 MB.
+            processes (int): optional, number of processes evaluating
+                parts of the mesh in parallel. Default 1.
 
         Returns:
             meshCoordinate1, meshCoordinate2 and
@@ -266,36 +393,153 @@ class Wavefunction:
                 nMax = max(nMax, state[0])
             axisLength = 2.0 * 2.0 * nMax * (nMax + 15.0)
 
+        if units == "nm":
+            scale = physical_constants["Bohr radius"][0]*1e9
+        elif units == "atomic":
+            scale = 1.
+        else:
+            raise ValueError("Only 'atomic' (a_0) and 'nm' are recognised"
+                             "as possible units. Received: %s" % units)
+
         coord1 = np.linspace(- axisLength / 2., axisLength / 2., pointsPerAxis)
         coord2 = np.linspace(- axisLength / 2., axisLength / 2., pointsPerAxis)
-        meshCoord1, meshCoord2 = np.meshgrid(coord1, coord2)
+        meshCoord1, meshCoord2 = np.meshgrid(coord1 * scale, coord2 * scale)
 
-        coord = []
+        # plane is evaluated as a box with a single point along third axis
         if (plane == "x-z"):
-            coord = [meshCoord1, 0, meshCoord2]
+            f = self._getDensityOnGrid(coord1, np.zeros(1), coord2, scale,
+                                       True, memoryLimit, processes)[:, 0, :]
         elif (plane == "x-y"):
-            coord = [meshCoord1, meshCoord2, 0]
+            f = self._getDensityOnGrid(coord1, coord2, np.zeros(1), scale,
+                                       True, memoryLimit, processes)[:, :, 0]
         else:
             raise ValueError("Only 'x-y' and 'x-z' planes are supported.")
 
-        wfP, wfM = self.getRtimesPsi(*coord)
+        return meshCoord1, meshCoord2, f.T
+
+
+    def getPsiSquaredInBox(self,
+                           pointsPerAxis=100,
+                           axisLength=None,
+                           units="atomic",
+                           memoryLimit=2**28,
+                           processes=1,
+                           outputFile=None
+                           ):
+        r"""
+        Calculates :math:`|\psi|^2` on a 3D mesh in a box centred on the atom.
+
+        The box is evaluated in tiles, so that memory used for intermediate
+        results stays within `memoryLimit`, allowing high-resolution
+        densities (e.g. :math:`200^3` points or more) to be calculated.
+        Tiles can be evaluated in parallel, and the result can be written
+        directly to a memory-mapped `.npy` file, so that the whole density
+        doesn't have to be kept in memory.
+
+        Args:
+            pointsPerAxis (int or list of int): optional, a number of mesh
+                points per Carthesian axis, or list of three numbers for
+                :math:`x`, :math:`y` and :math:`z` axis. Default 100.
+            axisLength (float or list of float): optional, side length of the
+                box, or list of three side lengths for :math:`x`, :math:`y`
+                and :math:`z` axis. By default it is large enough to fit the
+                whole wavefunction (in atomic units of Bohr radius
+                :math:`a_0`).
+            units (str): optional, units of length in which calculated mesh
+                and density will be **returned** (note that `axisLength` is
+                on the other hand always in atomi units.). Supported values
+                are `'atomic'` or `'nm'`. Default value `'atomic'` .
+            memoryLimit (int): optional, approximate upper limit for memory
+                (in bytes) used for intermediate results of all tiles
+                evaluated at the same time. Default is 256 MB.
+            processes (int): optional, number of processes evaluating
+                tiles in parallel. Default 1.
+            outputFile (str): optional, if specified, density is written to
+                memory-mapped `.npy` file with this name (that can be loaded
+                with `np.load(outputFile, mmap_mode="r")`), and returned as
+                `numpy.memmap` array.
+
+        Returns:
+            coordinates of mesh points along :math:`x`, :math:`y` and
+            :math:`z` axis, and array
+            :math:`|\psi|^2 = \sum_{m_s} |\psi_{m_s}|^2` with shape
+            (number of points along :math:`x`, along :math:`y`, along
+            :math:`z`), where sum is over possible electron spin projection
+            values :math:`m_s`.
+        """
+        pointsPerAxis = np.broadcast_to(pointsPerAxis, (3,)).astype(int)
+        if axisLength is None:
+            nMax = 1
+            for state in self.basisStates:
+                nMax = max(nMax, state[0])
+            axisLength = 2.0 * 2.0 * nMax * (nMax + 15.0)
+        axisLength = np.broadcast_to(axisLength, (3,)).astype(float)
 
-        # change units
         if units == "nm":
             scale = physical_constants["Bohr radius"][0]*1e9
-            meshCoord1 *= scale
-            meshCoord2 *= scale
-            wfP /= scale
-            wfM /= scale
         elif units == "atomic":
-            pass
+            scale = 1.
         else:
             raise ValueError("Only 'atomic' (a_0) and 'nm' are recognised"
                              "as possible units. Received: %s" % units)
 
-        f = np.power(np.abs(wfP), 2) + np.power(np.abs(wfM), 2)
-        return meshCoord1, meshCoord2, f
+        x, y, z = [np.linspace(- axisLength[i] / 2., axisLength[i] / 2.,
+                               pointsPerAxis[i]) for i in xrange(3)]
+
+        density = self._getDensityOnGrid(x, y, z, scale, False,
+                                         memoryLimit, processes, outputFile)
+        return x * scale, y * scale, z * scale, density
+
+    def _getDensityOnGrid(self, x, y, z, scale, rTimesPsi, memoryLimit,
+                          processes, outputFile=None):
+        r"""
+            Evaluates :math:`|\psi|^2`, or :math:`|r \cdot \psi|^2` if
+            `rTimesPsi` is True, on the mesh with coordinates `x`, `y`, `z`
+            (in atomic units), in tiles, returning array of shape
+            (len(x), len(y), len(z)). See :obj:`getPsiSquaredInBox`.
+        """
+        nx, ny, nz = len(x), len(y), len(z)
+        shape = (nx, ny, nz)
+        if outputFile is None:
+            density = np.zeros(shape)
+            # each tile is a block of consecutive (x, y) rows of points
+            # along z, which is contiguous in the output array
+            rows = density.reshape(nx * ny, nz)
+        else:
+            density = np.lib.format.open_memmap(outputFile, mode="w+",
+                                                dtype=np.float64,
+                                                shape=shape)
+            del density
+
+        # approximate memory per point used for coordinates, radial and
+        # angular parts of the wavefunction and spin components
+        bytesPerPoint = 8 * (8 + len(self._radialGrids)) \
+            + 16 * (5 + 2 * len(self.basisStates))
+        rowsPerTile = max(1, int(memoryLimit
+                                 // (max(1, processes) * bytesPerPoint * nz)))
+        tiles = [(x, y, z, start, min(start + rowsPerTile, nx * ny),
+                  scale, rTimesPsi, outputFile)
+                 for start in xrange(0, nx * ny, rowsPerTile)]
+
+        wavefunction = self._getWavefunctionData()
+        if processes > 1:
+            # only data needed for wavefunction evaluation is sent to the
+            # worker processes, once per process
+            pool = Pool(processes, initializer=_setTileWavefunction,
+                        initargs=(wavefunction,))
+            results = pool.map(_getDensityTile, tiles)
+            pool.close()
+            pool.join()
+        else:
+            results = [_getDensityTile(tile, wavefunction) for tile in tiles]
 
+        if outputFile is None:
+            for tile, result in zip(tiles, results):
+                rows[tile[3]:tile[4]] = result
+        else:
+            # tiles were written directly to the file
+            density = np.load(outputFile, mmap_mode="r+")
+        return density
 
     def plot2D(self,
                plane="x-z",
@@ -724,10 +968,10 @@ class StarkMap:
                 sys.stdout.flush()
 
             # add diagonal element
-            self.mat1[ii][ii] = self.atom.getEnergy(states[ii][0],
-                                                    states[ii][1],
-                                                    states[ii][2],
-                                                    s=self.s)\
+            self.mat1[ii][ii] = self.atom._getTabulatedEnergy(states[ii][0],
+                                                              states[ii][1],
+                                                              states[ii][2],
+                                                              s=self.s)\
                 * C_e / C_h * 1e-9 \
                 + self.atom.getZeemanEnergyShift(
                 states[ii][1],
@@ -886,11 +1130,11 @@ class StarkMap:
             print("\n")
         return
 
-    def exportData(self, fileBase, exportFormat="csv"):
+    def exportData(self, fileBase, exportFormat="csv", compressed=False):
         """
             Exports StarkMap calculation data.
 
-            Only supported format (selected by default) is .csv in a
+            Default format is .csv in a
             human-readable form with a header that saves details of calculation.
             Function saves three files: 1) `filebase` _eField.csv;
             2) `filebase` _energyLevels
@@ -898,12 +1142,26 @@ class StarkMap:
 
             For more details on the format, see header of the saved files.
 
+            Alternatively, with `exportFormat="npz"`, data is saved in binary
+            form in a single file `filebase`.npz, with arrays `eField`,
+            `energyLevels` and `highlight` (one row for each
+            electric field),
+            `basisStates` (one row for each basis state) and `header`
+            (string with the details of calculation). Such files are much
+            faster to write and read, and can be loaded with `np.load`.
+            Arrays are written in blocks of rows, so large calculations are
+            exported without making additional copy of all the data in
+            memory, but arrays are not chunked within the saved file, and
+            `np.load` reads each of them as a whole.
+
             Args:
                 filebase (string): filebase for the names of the saved files
                     without format extension. Add as a prefix a directory path
                     if necessary (e.g. saving outside the current working directory)
-                exportFormat (string): optional. Format of the exported file. Currently
-                    only .csv is supported but this can be extended in the future.
+                exportFormat (string): optional. Format of the exported
+                    file, "csv" (default) or "npz".
+                compressed (bool): optional. Should binary "npz" file be
+                    compressed. Default False.
         """
 
         fmt = 'on %Y-%m-%d @ %H:%M:%S'
@@ -969,8 +1227,18 @@ class StarkMap:
             print("   Highlight values saved in %s" % filename)
 
             print("... data export finished!")
+        elif exportFormat == "npz":
+            filename = _exportArrays(
+                fileBase, commonHeader,
+                {"eField": self.eFieldList,
+                 "energyLevels": self.y,
+                 "highlight": self.highlight,
+                 "basisStates": self.basisStates},
+                compressed=compressed)
+            print("Calculation data saved in %s" % filename)
         else:
-            raise ValueError("Unsupported export format (.%s)." % format)
+            raise ValueError("Unsupported export format (.%s)."
+                             % exportFormat)
 
     def plotLevelDiagram(self, units=1, highlighState=True, progressOutput=False,
                          debugOutput=False, highlightColour='red',
@@ -1551,46 +1819,76 @@ class LevelPlot:
 
 
     def makeTransitionMatrix(self, environmentTemperature=0.0, printDecays=True):
-        self.transitionMatrix = []
-
-        for i in xrange(len(self.levelLabel)):
-            state1 = self.levelLabel[i]
-            transitionVector = []
-
-            # decay of the stay
-            decay = 0.0
-
-            for state2 in self.levelLabel:
-                dipoleAllowed = (abs(state1[1] - state2[1]) == 1)and\
-                                (abs(state1[2] - state2[2]) <= 1.01)
-                if (dipoleAllowed):
-                    # decay to this state
-                    rate = self.atom.getTransitionRate(state2[0], state2[1], state2[2],
-                                                       state1[0], state1[1], state1[2],
-                                                       temperature=environmentTemperature)
-
-                    transitionVector.append(rate)
+        """
+            Constructs matrix of transition rates between the levels
 
-                    # decay from this state
-                    rate = self.atom.getTransitionRate(state1[0], state1[1], state1[2],
-                                                       state2[0], state2[1], state2[2],
-                                                       temperature=environmentTemperature)
+            Element `[a, b]` of the matrix is the rate of transition from
+            level `a` to level `b` (for dipole allowed transitions between
+            the levels with the same spin), and diagonal element `[a, a]` is
+            minus the total decay rate of level `a` to all other levels.
+            Rates of all the transitions are calculated together, each only
+            once (see :obj:`AlkaliAtom.getTransitionRates`).
 
-                    decay = decay - rate
-                else:
-                    transitionVector.append(0.0)
+            Args:
+                environmentTemperature (float or array): optional,
+                    temperature (in K) of the environment, used for black
+                    body induced transitions. Default 0.
+                printDecays (bool): optional, prints decay times of the levels
+                    if True (default).
+
+            Sets :obj:`transitionMatrix` to the sparse matrix of the rates
+            (in s :math:`{}^{-1}`), or, if array of temperatures is given,
+            to the list of sparse matrices, one for each temperature.
+        """
+        labels = np.array(self.levelLabel, dtype=np.float64).reshape(-1, 4)
+        temperatures = np.asarray(environmentTemperature, dtype=np.float64)
+        nLevels = len(labels)
+
+        # dipole allowed transitions, from level a to level b, between the
+        # levels with j allowed for given l and s
+        valid = labels[:, 2] > np.abs(labels[:, 1] - labels[:, 3]) - 0.01
+        a, b = np.nonzero(
+            valid[:, None] & valid[None, :]
+            & (np.abs(labels[:, None, 1] - labels[None, :, 1]) == 1)
+            & (np.abs(labels[:, None, 2] - labels[None, :, 2]) <= 1.01)
+            & (labels[:, None, 2] + labels[None, :, 2] > 0.99)
+            & (labels[:, None, 3] == labels[None, :, 3]))
+        rates = np.zeros((len(a),) + temperatures.shape)
+        for spin in np.unique(labels[a, 3]):
+            sel = labels[a, 3] == spin
+            rates[sel] = self.atom.getTransitionRates(
+                labels[a[sel], 0, None], labels[a[sel], 1, None],
+                labels[a[sel], 2, None],
+                labels[b[sel], 0, None], labels[b[sel], 1, None],
+                labels[b[sel], 2, None],
+                temperature=temperatures.ravel(),
+                s=spin).reshape((-1,) + temperatures.shape)
+
+        rates = rates.reshape(len(a), -1)
+        matrices = []
+        for t in xrange(rates.shape[1]):
+            matrix = csr_matrix((rates[:, t], (a, b)),
+                                shape=(nLevels, nLevels))
+            decay = -np.asarray(matrix.sum(axis=1)).ravel()
+            matrix = matrix + csr_matrix((decay, (np.arange(nLevels),
+                                                  np.arange(nLevels))),
+                                         shape=(nLevels, nLevels))
+            matrices.append(matrix)
 
-            transitionVector[i] = decay
             if printDecays:
-                print("Decay time of ")
-                printState(state1[0], state1[1], state1[2])
-                if decay < -1e-20:
-                    print("\t is\t", -1.e9 / decay, " ns")
-            self.transitionMatrix.append(transitionVector)
-
-        np.array(self.transitionMatrix)
-
-        self.transitionMatrix = np.transpose(self.transitionMatrix)
+                if temperatures.ndim > 0:
+                    print("Temperature %.1f K" % temperatures.ravel()[t])
+                for i in xrange(nLevels):
+                    print("Decay time of ")
+                    print(printStateString(int(labels[i, 0]),
+                                           int(labels[i, 1]), labels[i, 2]))
+                    if decay[i] < -1e-20:
+                        print("\t is\t", -1.e9 / decay[i], " ns")
+
+        if temperatures.ndim == 0:
+            self.transitionMatrix = matrices[0]
+        else:
+            self.transitionMatrix = matrices
 
     def drawSpectra(self):
         self.fig, self.ax = plt.subplots(1, 1, figsize=(16, 5))
@@ -2127,17 +2425,23 @@ class OpticalLattice1D:
                 one full wavelength is the 2\pi.
 
         Retruns:
-            float:
+            complex value, or array of values of the same shape as `x` if
+            `x` is an array of positions
         """
+        stateVector = self._alignBlochPhase(np.asarray(stateVector))
+        l = np.arange(-self.lLimit, self.lLimit + 1, 1)
+        planeWaves = np.exp(1.j * np.multiply.outer(
+            np.asarray(x, dtype=np.float64), 2. * k * l + q))
+        return planeWaves.dot(stateVector)
 
-        index = len(stateVector) // 2 + 2  # Align Bloch functions in phase
-        angle = np.angle(stateVector[index])
-        sign = np.exp(-1j*angle)
-        temp = 0 + 0j
-        for l in np.arange(-self.lLimit, self.lLimit + 1, 1):
-            temp += sign * stateVector[l + self.lLimit] \
-                * np.exp(1.j * (2. * k * l + q) * x)
-        return temp
+    def _alignBlochPhase(self, stateVectors):
+        """
+            Multiplies eigen vectors (last axis of `stateVectors`) by a global
+            phase, so that Bloch functions are aligned in phase
+        """
+        index = stateVectors.shape[-1] // 2 + 2
+        angle = np.angle(stateVectors[..., index])
+        return stateVectors * np.exp(-1j * angle)[..., np.newaxis]
 
     def BlochWavefunction(self,
                           trapPotentialDepth,
@@ -2236,8 +2540,29 @@ class OpticalLattice1D:
                                   shape=(dimension, dimension))
         return hamiltonianQ
 
+    def _getLatticeHamiltonianDiagonals(self, quasimomentumList, Vlat):
+        """
+        Diagonal and off-diagonal elements of the (tridiagonal) lattice
+        Hamiltonian, with the same elements as
+        :obj:`_getLatticeHamiltonian`, for many quasimomenta at once
+
+        Args:
+            quasimomentumList (array):
+            Vlat (float):
+
+        Returns:
+            array of diagonal elements for each quasimomentum, and array of
+            off-diagonal elements (that don't depend on quasimomentum)
+        """
+        l = np.arange(- self.lLimit, self.lLimit + 1, 1)
+        q = np.asarray(quasimomentumList, dtype=np.float64).reshape(-1, 1)
+        # with global energy offset (- Vlat / 2.) factored out
+        diagonal = (2. * l + q)**2 + Vlat / 2.
+        offDiagonal = np.full(2 * self.lLimit, - Vlat / 4.)
+        return diagonal, offDiagonal
+
     def diagonalise(self, trapPotentialDepth, quasimomentumList,
-                    saveBandIndex=None):
+                    saveBandIndex=None, numberOfBands=None):
         r"""
             Calculates energy levels (Bloch bands) for given `quasimomentumList`
 
@@ -2265,22 +2590,180 @@ class OpticalLattice1D:
                     specifies for which Bloch band should the eignevectors be
                     also saved. `saveBlochBand=0` corresponds to lowest energy
                     band.
+                numberOfBands (int): optional, default None. If provided,
+                    only energies of the `numberOfBands` lowest Bloch bands
+                    are calculated and saved. By default all
+                    `2 * lLimit + 1` energies are saved.
         """
 
-        self.energy = []
+        energy, savedBlochBand = self._getBlochBands(trapPotentialDepth,
+                                                     quasimomentumList,
+                                                     numberOfBands,
+                                                     saveBandIndex)
+        self.energy = list(energy)
         self.quasimomentum = quasimomentumList
         self.savedBlochBand = []
+        if saveBandIndex is not None:
+            self.savedBlochBand = list(savedBlochBand)
         self.trapPotentialDepth = trapPotentialDepth
-        for q in quasimomentumList:
-            hamiltonianQ = self._getLatticeHamiltonian(q, trapPotentialDepth)
-            ev, egvector = np.linalg.eig(hamiltonianQ.todense())
-            egvector = np.transpose(np.array(egvector))
-            orderInEnergy = np.argsort(ev)
-            ev = ev[orderInEnergy]
-            egvector = egvector[orderInEnergy]
-            self.energy.append(ev)
-            if saveBandIndex is not None:
-                self.savedBlochBand.append(egvector[saveBandIndex])
+
+    def _getBlochBands(self, trapPotentialDepth, quasimomentumList,
+                       numberOfBands=None, saveBandIndex=None):
+        """
+            Energies of the lowest `numberOfBands` Bloch bands (all by
+            default), as array with shape (quasimomenta, bands), and
+            eigenvectors of band `saveBandIndex` (or None) as array with
+            shape (quasimomenta, basis size). See :obj:`diagonalise`.
+        """
+        dimension = 2 * self.lLimit + 1
+        if numberOfBands is None:
+            numberOfBands = dimension
+        numberOfBands = min(numberOfBands, dimension)
+        lastBand = numberOfBands - 1
+        if saveBandIndex is not None:
+            lastBand = max(lastBand, saveBandIndex)
+
+        # Hamiltonian is real, symmetric and tridiagonal
+        diagonal, offDiagonal = self._getLatticeHamiltonianDiagonals(
+            quasimomentumList, trapPotentialDepth)
+        if lastBand < dimension - 1:
+            # find only the lowest bands
+            select = {"select": "i", "select_range": (0, lastBand)}
+        else:
+            select = {"select": "a"}
+        energy = np.zeros((len(diagonal), numberOfBands))
+        savedBlochBand = None
+        if saveBandIndex is not None:
+            savedBlochBand = np.zeros((len(diagonal), dimension))
+        for i in xrange(len(diagonal)):
+            if saveBandIndex is None:
+                ev = eigh_tridiagonal(diagonal[i], offDiagonal,
+                                      eigvals_only=True, **select)
+            else:
+                ev, egvector = eigh_tridiagonal(diagonal[i], offDiagonal,
+                                                **select)
+                savedBlochBand[i] = egvector[:, saveBandIndex]
+            energy[i] = ev[:numberOfBands]
+        return energy, savedBlochBand
+
+    def getDepthSweep(self, trapPotentialDepthList, quasimomentumList=None,
+                      numberOfBands=3, wannierBandIndex=0,
+                      processes=1):
+        r"""
+            Bloch bands, tunnelling, band gaps and Wannier function widths
+            for a range of lattice depths.
+
+            For each lattice depth, Bloch bands are calculated for all
+            quasimomenta in `quasimomentumList` (as in :obj:`diagonalise`,
+            which needs basis defined with :obj:`defineBasis`). Tunnelling
+            :math:`J_b` of band :math:`b` is obtained from the first Fourier
+            component of the band energy, assuming
+            :math:`E_b(q) \approx E_b^{(0)} - 2 J_b \cos (\pi q)` (with
+            quasimomentum :math:`q` in units of :math:`\hbar k`), i.e.
+            :math:`J_b = -\langle E_b(q)\cos(\pi q) \rangle_q`. For this,
+            and for Wannier functions, quasimomenta should uniformly cover
+            the Brillouin zone, without repeating the equivalent points
+            :math:`q=-1` and :math:`q=+1`.
+
+            Example:
+                Tunnelling in the lowest band and the first band gap::
+
+                    lattice = OpticalLattice1D(Strontium88(), 1064e-9)
+                    lattice.defineBasis(lLimit=35)
+                    sweep = lattice.getDepthSweep(np.linspace(1, 50, 200))
+                    plt.semilogy(sweep["depth"], sweep["tunnelling"][:, 0])
+                    plt.plot(sweep["depth"], sweep["bandGap"][:, 0])
+
+            Args:
+                trapPotentialDepthList (array): lattice depths (in units of
+                    recoil energy :obj:`getRecoilEnergy`)
+                quasimomentumList (array): optional, quasimomenta (in units
+                    of :math:`\hbar \cdot k`, full range is from -1 to +1).
+                    By default `np.linspace(-1, 1, 100, endpoint=False)`.
+                numberOfBands (int): optional, number of the lowest Bloch
+                    bands calculated. Default 3.
+                wannierBandIndex (int): optional, index of the Bloch band
+                    for which width of Wannier function is calculated.
+                    Default 0 (the lowest band).
+                processes (int): optional, number of processes calculating
+                    different lattice depths in parallel. Default 1.
+
+            Returns:
+                dictionary with:
+
+                    - "depth", lattice depths (in units of recoil energy);
+                    - "quasimomentum", quasimomenta (in units of
+                      :math:`\hbar k`);
+                    - "energy", band energies, as array with shape
+                      (depths, quasimomenta, bands) (in units of recoil
+                      energy, same as in :obj:`diagonalise`);
+                    - "bandWidth", difference between maximal and minimal
+                      energy of each band, with shape (depths, bands);
+                    - "bandGap", difference between minimal energy of band
+                      :math:`b+1` and maximal energy of band :math:`b`, with
+                      shape (depths, bands - 1);
+                    - "tunnelling", tunnelling :math:`J_b`, with shape
+                      (depths, bands) (in units of recoil energy);
+                    - "wannierWidth", standard deviation of position for
+                      Wannier function of band `wannierBandIndex` localised
+                      at `latticeIndex=0`, with shape (depths,) (in units of
+                      lattice constant, calculated within 5 lattice
+                      constants from the lattice site).
+        """
+        depth = np.atleast_1d(np.asarray(trapPotentialDepthList,
+                                         dtype=np.float64))
+        if quasimomentumList is None:
+            quasimomentumList = np.linspace(-1, 1, 100, endpoint=False)
+        q = np.asarray(quasimomentumList, dtype=np.float64)
+        numberOfBands = min(numberOfBands, 2 * self.lLimit + 1)
+
+        points = [(V, q, numberOfBands, wannierBandIndex) for V in depth]
+        if processes > 1:
+            # database connection can't be passed to other processes,
+            # and it's not needed for lattice calculations
+            atomDatabaseConn = self.atom.conn
+            self.atom.conn = False
+            try:
+                pool = Pool(processes)
+                results = pool.map(self._getDepthSweepPoint, points)
+                pool.close()
+                pool.join()
+            finally:
+                self.atom.conn = atomDatabaseConn
+        else:
+            results = [self._getDepthSweepPoint(point) for point in points]
+
+        energy = np.array([result[0] for result in results]).reshape(
+            len(depth), len(q), numberOfBands)
+        wannierWidth = np.array([result[1] for result in results])
+
+        # first Fourier component of the band energies
+        tunnelling = - np.mean(energy * np.cos(pi * q)[:, None], axis=1)
+
+        return {"depth": depth,
+                "quasimomentum": q,
+                "energy": energy,
+                "bandWidth": energy.max(axis=1) - energy.min(axis=1),
+                "bandGap": energy[:, :, 1:].min(axis=1)
+                - energy[:, :, :-1].max(axis=1),
+                "tunnelling": tunnelling,
+                "wannierWidth": wannierWidth}
+
+    def _getDepthSweepPoint(self, point):
+        """
+            Band energies and Wannier function width for single lattice
+            depth of :obj:`getDepthSweep`.
+        """
+        trapPotentialDepth, q, numberOfBands, wannierBandIndex = point
+        energy, savedBlochBand = self._getBlochBands(trapPotentialDepth, q,
+                                                     numberOfBands,
+                                                     wannierBandIndex)
+        # lattice constant is pi in units of 1/k
+        x = np.linspace(- 5 * pi, 5 * pi, 501)
+        density = np.abs(self._wannierFunction(x, q, savedBlochBand))**2
+        mean = np.sum(x * density) / np.sum(density)
+        width = np.sqrt(np.sum((x - mean)**2 * density) / np.sum(density))
+        return energy, width / pi
 
     def plotLevelDiagram(self):
         """
@@ -2319,18 +2802,38 @@ class OpticalLattice1D:
                 k (float): optional; laser driving wavevector, defines unit
                     of length. Default value is 1, making one trapping laser
                     wavelenth equal to :math:`2\pi`
+
+            Returns:
+                complex value, or array of values of the same shape as `x`
+                if `x` is an array of positions
+        """
+        return self._wannierFunction(x, self.quasimomentum,
+                                     self.savedBlochBand,
+                                     latticeIndex=latticeIndex, k=k)
+
+    def _wannierFunction(self, x, quasimomentumList, savedBlochBand,
+                         latticeIndex=0, k=1):
+        """
+            Wannier function at positions `x` obtained from eigenvectors
+            `savedBlochBand` of a Bloch band calculated for quasimomenta
+            `quasimomentumList`. See :obj:`getWannierFunction`.
         """
-        value = 0
         localizedAt = 2. * pi / k * latticeIndex / 2.
         # last division by 2 is because lattice period is
         # 2 x smaleler then wavelenth of the driving laser
-        for i in range(len(self.quasimomentum)):
-            q = self.quasimomentum[i]
-            value += np.exp(-1j * q * localizedAt) \
-                * self._BlochFunction(x,
-                                      self.savedBlochBand[i],
-                                      q, k=k)
-        return value
+        x = np.asarray(x, dtype=np.float64)
+        q = np.asarray(quasimomentumList, dtype=np.float64)
+        states = self._alignBlochPhase(np.array(savedBlochBand))
+        l = np.arange(-self.lLimit, self.lLimit + 1, 1)
+
+        # periodic parts of Bloch functions for all positions and all
+        # quasimomenta are given by single matrix product
+        planeWaves = np.exp(2.j * k * np.multiply.outer(x, l))
+        periodicPart = planeWaves.dot(states.T)
+        return np.sum(periodicPart
+                      * np.exp(1j * (np.multiply.outer(x, q)
+                                     - q * localizedAt)),
+                      axis=-1)
 
 
 class DynamicPolarizability:
@@ -2371,6 +2874,7 @@ class DynamicPolarizability:
 
         self.basis = []
         self.lifetimes = []
+        self.__poles = None
 
         for n1 in np.arange(self.nMin, self.nMax + 1):
             lmin = self.l - 1
@@ -2445,8 +2949,13 @@ class DynamicPolarizability:
            .. _`arXiv:2007.12016`:
                https://arxiv.org/abs/2007.12016
 
+           Transition energies and matrix elements for the basis are
+           calculated only once (on the first call after
+           :obj:`defineBasis`), so `driveWavelength` can also be an array of
+           wavelengths, for which polarizabilities are then evaluated at once.
+
             Args:
-                driveWavelength (float): wavelength of driving field
+                driveWavelength (float or array): wavelength of driving field
                     (in units of m)
                 units (string): optional, 'SI' or 'a.u.' (equivalently 'au'),
                     switches between SI units for returned result
@@ -2455,23 +2964,179 @@ class DynamicPolarizability:
                 accountForStateLifetime (bool): optional, should we account
                     for finite transition linewidths caused by finite state
                     lifetimes. By default False.
+                mj (float): optional, `mj` projection of the total angular
+                    momentum. If specified, only basis states with
+                    :math:`j' \geq |m_j|` are included.
             Returns:
                 scalar, vector, tensor, pondermotive polarisability of state,
                 core polarisability and atomic state whose resonance is closest
                 in energy. Returned units depend on `units` parameter
-                (default SI).
+                (default SI). If `driveWavelength` is an array,
+                polarisabilities are arrays of the same shape (with `np.nan`
+                for wavelengths in exact resonance with a transition) and the
+                last returned value is a list of closest states for
+                (flattened) wavelengths.
         """
 
-        if (accountForStateLifetime and len(self.lifetimes) == 0):
-            for state in self.basis:
-                self.lifetimes.append(self.atom.getStateLifetime(state[0],
-                                                                 state[1],
-                                                                 state[2],
-                                                                 s=self.s))
+        driveWavelength = np.asarray(driveWavelength, dtype=np.float64)
+        alpha0, alpha1, alpha2, closest, resonant = \
+            self.__getPolarizabilities(driveWavelength.ravel(),
+                                       accountForStateLifetime, mj)
 
-        driveEnergy = C_c / driveWavelength * C_h
-        initialLevelEnergy = self.atom.getEnergy(self.n, self.l, self.j,
-                                                 s=self.s) * C_e
+        # core polarizability -> assumes static polarisability
+        alphaC = self.atom.alphaC * 2.48832e-8  # convert to Hz m^2 / V^2
+
+        # podermotive shift
+        driveOmega = 2 * np.pi / driveWavelength * C_c
+        alphaP = C_e**2 / (2 * C_m_e * driveOmega**2 * C_h)
+
+        if (units == "SI"):
+            conversion = 1.  # in Hz m^2 / V^2
+        elif (units == "a.u." or units == "au"):
+            conversion = 1. / 2.48832e-8
+        else:
+            raise ValueError("Only 'SI' and 'a.u' (atomic units) are recognised"
+                             " as 'units' parameter. Entered value '%s' is"
+                             " not recognised." % units)
+
+        closestState = [self.basis[i] if i >= 0 else [] for i in closest]
+
+        if driveWavelength.ndim == 0:
+            if resonant[0]:
+                # print("For given frequency we are in exact resonance with state %s" % printStateString(n1,l1,j1,s=s))
+                return None, None, None, None, None, closestState[0]
+            return alpha0[0] * conversion, alpha1[0] * conversion, \
+                alpha2[0] * conversion, alphaC * conversion, \
+                alphaP * conversion, closestState[0]
+
+        shape = driveWavelength.shape
+        for alpha in (alpha0, alpha1, alpha2):
+            alpha[resonant] = np.nan
+        return (alpha0.reshape(shape) * conversion,
+                alpha1.reshape(shape) * conversion,
+                alpha2.reshape(shape) * conversion,
+                alphaC * conversion, alphaP * conversion,
+                closestState)
+
+    def __getPoles(self, accountForStateLifetime):
+        """
+            Transition energies, squared reduced matrix elements and other
+            factors of all dipole transitions from the selected state to the
+            basis states, that don't depend on the driving field. They are
+            calculated once for the given basis.
+        """
+        if self.__poles is None:
+            initialLevelEnergy = self.atom.getEnergy(self.n, self.l, self.j,
+                                                     s=self.s) * C_e
+            coupled = []
+            transitionEnergy = []
+            d2 = []
+            tensorFactor = []
+            for state in self.basis:
+                n1, l1, j1 = state[0], state[1], state[2]
+                coupled.append(abs(j1 - self.j) < 1.1
+                               and (abs(l1 - self.l) > 0.5
+                                    and abs(l1 - self.l) < 1.1))
+                if not coupled[-1]:
+                    transitionEnergy.append(0.)
+                    d2.append(0.)
+                    tensorFactor.append(0.)
+                    continue
+                transitionEnergy.append(
+                    self.atom.getEnergy(n1, l1, j1, s=self.s) * C_e
+                    - initialLevelEnergy)
+                d2.append(self.atom.getReducedMatrixElementJ(
+                    self.n, self.l, self.j, n1, l1, j1, s=self.s)**2
+                    * (C_e * physical_constants["Bohr radius"][0])**2)
+                # tensor polarizability vanishes for j=1/2 and j=0 states
+                # because Wigner6j is then zero
+                if self.j > 0.6:
+                    tensorFactor.append((- 1)**(self.j + j1 + 1)
+                                        * Wigner6j(self.j, 1, j1,
+                                                   1, self.j, 2))
+                else:
+                    tensorFactor.append(0.)
+            j1 = np.array([state[2] for state in self.basis],
+                          dtype=np.float64)
+            self.__poles = {
+                "coupled": np.array(coupled, dtype=bool),
+                "j1": j1,
+                "transitionEnergy": np.array(transitionEnergy),
+                "d2": np.array(d2),
+                "vectorFactor": -(self.j * (self.j + 1) + 2 - j1 * (j1 + 1)),
+                "tensorFactor": np.array(tensorFactor),
+                "linewidth": None}
+
+        poles = self.__poles
+        if accountForStateLifetime and poles["linewidth"] is None:
+            if len(self.lifetimes) == 0:
+                for state in self.basis:
+                    self.lifetimes.append(self.atom.getStateLifetime(
+                        state[0], state[1], state[2], s=self.s))
+            targetStateLifetime = self.atom.getStateLifetime(
+                self.n, self.l, self.j, s=self.s)
+            poles["linewidth"] = (1 / np.array(self.lifetimes)
+                                  + 1 / targetStateLifetime) * C_h
+        return poles
+
+    def __getPolarizabilities(self, driveWavelength, accountForStateLifetime,
+                              mj, blockSize=4096):
+        """
+            Scalar, vector and tensor polarizabilities (in SI units) for an
+            array of wavelengths, index of the closest resonant basis state,
+            and mask of wavelengths in exact resonance with basis states.
+        """
+        poles = self.__getPoles(accountForStateLifetime)
+        included = np.copy(poles["coupled"])
+        if mj is not None:
+            included &= np.abs(mj) < poles["j1"] + 0.1
+        transitionEnergy = poles["transitionEnergy"][included]
+        d2 = poles["d2"][included]
+        vectorFactor = poles["vectorFactor"][included]
+        tensorFactor = poles["tensorFactor"][included]
+        if accountForStateLifetime:
+            transitionLinewidth = poles["linewidth"][included]
+        else:
+            transitionLinewidth = np.zeros(len(transitionEnergy))
+        basisIndex = np.nonzero(included)[0]
+
+        nW = len(driveWavelength)
+        alpha0 = np.zeros(nW)
+        alpha1 = np.zeros(nW)
+        alpha2 = np.zeros(nW)
+        closest = np.full(nW, -1, dtype=int)
+        resonant = np.zeros(nW, dtype=bool)
+        if len(transitionEnergy) == 0:
+            return alpha0, alpha1, alpha2, closest, resonant
+
+        # evaluated in blocks of wavelengths, to limit memory use
+        for start in xrange(0, nW, blockSize):
+            block = slice(start, start + blockSize)
+            driveEnergy = (C_c / driveWavelength[block] * C_h)[:, None]
+
+            diffEnergy = np.abs(transitionEnergy**2 - driveEnergy**2)
+            closest[block] = basisIndex[np.argmin(diffEnergy, axis=1)]
+            exact = diffEnergy < 1e-65
+            resonant[block] = np.any(exact, axis=1)
+            # for exact resonance, state is the first one in resonance
+            closest[block] = np.where(
+                resonant[block], basisIndex[np.argmax(exact, axis=1)],
+                closest[block])
+
+            detuning = transitionEnergy**2 - driveEnergy**2
+            denominator = (detuning + transitionLinewidth**2 / 4)**2 \
+                + transitionLinewidth**2 * driveEnergy**2
+            with np.errstate(divide="ignore", invalid="ignore"):
+                alpha0[block] = np.sum(
+                    d2 * transitionEnergy
+                    * (detuning + transitionLinewidth**2 / 4) / denominator,
+                    axis=1)
+                alpha1[block] = np.sum(
+                    vectorFactor * d2 * driveEnergy
+                    * (detuning - transitionLinewidth**2 / 4) / denominator,
+                    axis=1)
+                alpha2[block] = np.sum(
+                    tensorFactor * d2 * transitionEnergy / detuning, axis=1)
 
         # prefactor for vector polarisability
         prefactor1 = 1. / ((self.j + 1) * (2 * self.j + 1))
@@ -2483,94 +3148,6 @@ class DynamicPolarizability:
                          * (2 * self.j + 3))
                       )**0.5
 
-        alpha0 = 0.
-        alpha1 = 0.
-        alpha2 = 0.
-        closestState = []
-        closestEnergy = -1
-
-        targetStateLifetime = self.atom.getStateLifetime(self.n, self.l,
-                                                         self.j, s=self.s)
-
-        for i, state in enumerate(self.basis):
-            n1 = state[0]
-            l1 = state[1]
-            j1 = state[2]
-
-            if ((mj is None) or (abs(mj) < j1 + 0.1)):
-
-                if abs(j1 - self.j) < 1.1 and (abs(l1 - self.l) > 0.5
-                                               and abs(l1 - self.l) < 1.1):
-                    coupledLevelEnergy = self.atom.getEnergy(n1, l1, j1,
-                                                             s=self.s) * C_e
-
-                    diffEnergy = abs((coupledLevelEnergy
-                                      - initialLevelEnergy)**2 - driveEnergy**2)
-                    if ((diffEnergy < closestEnergy) or (closestEnergy < 0)
-                        ):
-                        closestEnergy = diffEnergy
-                        closestState = state
-
-                    if diffEnergy < 1e-65:
-                        # print("For given frequency we are in exact resonance with state %s" % printStateString(n1,l1,j1,s=s))
-                        return None, None, None, None, None, state
-
-                    # common factors
-                    if accountForStateLifetime:
-                        transitionLinewidth = (1 / self.lifetimes[i]
-                                               + 1 / targetStateLifetime) * C_h
-                    else:
-                        transitionLinewidth = 0.
-
-                    # transitionEnergy
-                    transitionEnergy = (coupledLevelEnergy
-                                        - initialLevelEnergy)
-
-
-                    d = self.atom.getReducedMatrixElementJ(self.n, self.l, self.j,
-                                                               n1, l1, j1,
-                                                               s=self.s)**2 \
-                            * (C_e * physical_constants["Bohr radius"][0])**2\
-                            * transitionEnergy \
-                            * (transitionEnergy**2 - driveEnergy**2
-                               + transitionLinewidth**2 / 4) \
-                            / ((transitionEnergy**2 - driveEnergy**2
-                                + transitionLinewidth**2 / 4)**2
-                               + transitionLinewidth**2 * driveEnergy**2)
-
-                    alpha0 += d
-
-                    # vector polarsizavility
-                    alpha1 += (-1) * (self.j * (self.j+1) + 2 - j1 * (j1 + 1)) \
-                        * self.atom.getReducedMatrixElementJ(self.n,
-                                                             self.l,
-                                                             self.j,
-                                                             n1, l1, j1,
-                                                             s=self.s)**2\
-                        * (C_e * physical_constants["Bohr radius"][0])**2\
-                        * driveEnergy \
-                        * (transitionEnergy**2 - driveEnergy**2
-                           - transitionLinewidth**2 / 4) \
-                         / ((transitionEnergy**2 - driveEnergy**2
-                             + transitionLinewidth**2 / 4)**2
-                            + transitionLinewidth**2 * driveEnergy**2)
-
-                    # tensor polarizability vanishes for j=1/2 and j=0 states
-                    # because Wigner6j is then zero
-                    if self.j > 0.6:
-                        alpha2 += \
-                            (- 1)**(self.j + j1 + 1) \
-                            * self.atom.getReducedMatrixElementJ(self.n,
-                                                                 self.l,
-                                                                 self.j,
-                                                                 n1, l1, j1,
-                                                                 s=self.s)**2 \
-                            * (C_e * physical_constants["Bohr radius"][0])**2\
-                            * Wigner6j(self.j, 1, j1, 1, self.j, 2) \
-                            * (coupledLevelEnergy - initialLevelEnergy) \
-                            / ((coupledLevelEnergy - initialLevelEnergy)**2
-                               - driveEnergy**2)
-
         alpha0 = 2. * alpha0/(3. * (2. * self.j + 1.))
         alpha0 = alpha0 / C_h  # Hz m^2 / V^2
 
@@ -2578,22 +3155,187 @@ class DynamicPolarizability:
 
         alpha2 = - 4 * prefactor2 * alpha2 / C_h
 
-        # core polarizability -> assumes static polarisability
-        alphaC = self.atom.alphaC * 2.48832e-8  # convert to Hz m^2 / V^2
+        return alpha0, alpha1, alpha2, closest, resonant
 
-        # podermotive shift
-        driveOmega = 2 * np.pi / driveWavelength * C_c
-        alphaP = C_e**2 / (2 * C_m_e * driveOmega**2 * C_h)
+    def getTuneOutWavelengths(self, wavelengthMin, wavelengthMax,
+                              mj=None,
+                              addCorePolarisability=True,
+                              addPondermotivePolarisability=False,
+                              accountForStateLifetime=False,
+                              samplesPerInterval=50):
+        """
+            Finds tune-out wavelengths, where total polarisability of the
+            state is zero, in a given range of wavelengths.
 
-        if (units == "SI"):
-            return alpha0, alpha1, alpha2, alphaC, alphaP, closestState   # in Hz m^2 / V^2
-        elif (units == "a.u." or units == "au"):
-            return alpha0 / 2.48832e-8, alpha1 / 2.48832e-8, alpha2 / 2.48832e-8, \
-                alphaC / 2.48832e-8, alphaP / 2.48832e-8, closestState
+            Between each pair of consecutive transition resonances,
+            polarisability is sampled on `samplesPerInterval` points, and
+            each sign change found is refined using Brent's method.
+
+            Args:
+                wavelengthMin (float): lower bound of the searched
+                    wavelength range (in units of m)
+                wavelengthMax (float): upper bound of the searched
+                    wavelength range (in units of m)
+                mj (float): optional, `mj` projection of the total angular
+                    momenutum for the state. By default it's `+j`.
+                addCorePolarisability (bool): optional, should ionic core
+                    polarisability be taken into account. By default True.
+                addPondermotivePolarisability (bool): optional, should
+                    pondermotive polarisability be added to the total
+                    polarisability. Default is False.
+                accountForStateLifetime (bool): optional, should we account
+                    for finite transition linewidths caused by finite state
+                    lifetimes. By default False.
+                samplesPerInterval (int): optional, number of points
+                    sampled between consecutive resonances when bracketing
+                    roots. Default 50.
+            Returns:
+                array of tune-out wavelengths (in units of m), in increasing
+                order.
+        """
+        return self.__findRoots([(self, mj, 1.)],
+                                wavelengthMin, wavelengthMax,
+                                addCorePolarisability,
+                                addPondermotivePolarisability,
+                                accountForStateLifetime,
+                                samplesPerInterval)
+
+    def getMagicWavelengths(self, otherState, wavelengthMin, wavelengthMax,
+                            mj=None,
+                            otherMj=None,
+                            addCorePolarisability=True,
+                            addPondermotivePolarisability=False,
+                            accountForStateLifetime=False,
+                            samplesPerInterval=50):
+        """
+            Finds magic wavelengths, where total polarisabilities of this
+            and some other state are equal, in a given range of wavelengths.
+
+            Between each pair of consecutive transition resonances of the two
+            states, difference of polarisabilities is sampled on
+            `samplesPerInterval` points, and each sign change found is
+            refined using Brent's method.
+
+            Args:
+                otherState (DynamicPolarizability): polarisability
+                    calculation, with already defined basis, for the other
+                    state
+                wavelengthMin (float): lower bound of the searched
+                    wavelength range (in units of m)
+                wavelengthMax (float): upper bound of the searched
+                    wavelength range (in units of m)
+                mj (float): optional, `mj` projection of the total angular
+                    momenutum for this state. By default it's `+j`.
+                otherMj (float): optional, `mj` projection of the total
+                    angular momenutum for the other state. By default it's
+                    `+j`.
+                addCorePolarisability (bool): optional, should ionic core
+                    polarisability be taken into account. By default True.
+                addPondermotivePolarisability (bool): optional, should
+                    pondermotive polarisability be added to the total
+                    polarisability. Default is False.
+                accountForStateLifetime (bool): optional, should we account
+                    for finite transition linewidths caused by finite state
+                    lifetimes. By default False.
+                samplesPerInterval (int): optional, number of points
+                    sampled between consecutive resonances when bracketing
+                    roots. Default 50.
+            Returns:
+                array of magic wavelengths (in units of m), in increasing
+                order.
+        """
+        return self.__findRoots([(self, mj, 1.), (otherState, otherMj, -1.)],
+                                wavelengthMin, wavelengthMax,
+                                addCorePolarisability,
+                                addPondermotivePolarisability,
+                                accountForStateLifetime,
+                                samplesPerInterval)
+
+    def __getTotalPolarizability(self, driveWavelength, mj,
+                                 addCorePolarisability,
+                                 addPondermotivePolarisability,
+                                 accountForStateLifetime):
+        """
+            Total polarizability (in SI units) for an array of wavelengths,
+            as plotted by :obj:`plotPolarizability`.
+        """
+        if (mj is None):
+            mj = self.j
+
+        if (self.j > 0.5 + 0.1):
+            tensorPrefactor = (3 * mj**2 - self.j * (self.j + 1)) / \
+                (self.j * (2 * self.j - 1))
         else:
-            raise ValueError("Only 'SI' and 'a.u' (atomic units) are recognised"
-                             " as 'units' parameter. Entered value '%s' is"
-                             " not recognised." % units)
+            tensorPrefactor = 0
+
+        alpha0, alpha1, alpha2, closest, resonant = \
+            self.__getPolarizabilities(driveWavelength,
+                                       accountForStateLifetime, mj)
+        totalP = alpha0 + tensorPrefactor * alpha2
+        if addCorePolarisability:
+            totalP += self.atom.alphaC * 2.48832e-8
+        if addPondermotivePolarisability:
+            driveOmega = 2 * np.pi / driveWavelength * C_c
+            totalP += C_e**2 / (2 * C_m_e * driveOmega**2 * C_h)
+        return totalP
+
+    def __getResonanceFrequencies(self, mj):
+        """
+            Frequencies (in Hz) of transitions included in polarizability.
+        """
+        if (mj is None):
+            mj = self.j
+        poles = self.__getPoles(False)
+        included = poles["coupled"] & (np.abs(mj) < poles["j1"] + 0.1)
+        return np.abs(poles["transitionEnergy"][included]) / C_h
+
+    def __findRoots(self, terms, wavelengthMin, wavelengthMax,
+                    addCorePolarisability,
+                    addPondermotivePolarisability,
+                    accountForStateLifetime,
+                    samplesPerInterval):
+        """
+            Wavelengths at which sum of total polarizabilities, multiplied
+            by given weights, is zero. `terms` is list of
+            (DynamicPolarizability, mj, weight) tuples.
+        """
+        if wavelengthMin <= 0 or wavelengthMin >= wavelengthMax:
+            raise ValueError("Wavelength range should satisfy "
+                             "0 < wavelengthMin < wavelengthMax.")
+
+        def f(frequency):
+            frequency = np.atleast_1d(frequency)
+            total = np.zeros(len(frequency))
+            for state, mj, weight in terms:
+                total += weight * state.__getTotalPolarizability(
+                    C_c / frequency, mj,
+                    addCorePolarisability,
+                    addPondermotivePolarisability,
+                    accountForStateLifetime)
+            return total
+
+        frequencyMin = C_c / wavelengthMax
+        frequencyMax = C_c / wavelengthMin
+        resonances = np.concatenate([state.__getResonanceFrequencies(mj)
+                                     for state, mj, weight in terms])
+        resonances = np.unique(resonances[(resonances > frequencyMin)
+                                          & (resonances < frequencyMax)])
+        edges = np.concatenate(([frequencyMin], resonances, [frequencyMax]))
+
+        roots = []
+        for i in xrange(len(edges) - 1):
+            # stay away from poles at resonances
+            margin = (edges[i + 1] - edges[i]) * 1e-9
+            start = edges[i] + (margin if i > 0 else 0.)
+            stop = edges[i + 1] - (margin if i < len(edges) - 2 else 0.)
+            frequency = np.linspace(start, stop, samplesPerInterval)
+            value = f(frequency)
+            roots.extend(frequency[value == 0])
+            for k in np.nonzero(value[:-1] * value[1:] < 0)[0]:
+                roots.append(brentq(lambda x: f(x)[0],
+                                    frequency[k], frequency[k + 1]))
+
+        return np.sort(C_c / np.array(roots, dtype=np.float64))
 
     def plotPolarizability(self, wavelengthList,
                            mj=None,
@@ -2659,19 +3401,24 @@ class DynamicPolarizability:
         else:
             tensorPrefactor = 0
 
-        for wavelength in wavelengthList:
-            scalarP, vectorP, tensorP, coreP, pondermotiveP, state = self.getPolarizability(
-                wavelength,
+        wavelengthList = np.asarray(wavelengthList, dtype=np.float64).ravel()
+        scalarP, vectorP, tensorP, coreP, pondermotiveP, closestStates = \
+            self.getPolarizability(
+                wavelengthList,
                 accountForStateLifetime=accountForStateLifetime,
                 units=units,
                 mj=mj)
-            if (scalarP is not None):
+        totalPolarizability = scalarP + tensorPrefactor * tensorP
+        if addCorePolarisability:
+            totalPolarizability += coreP
+        if addPondermotivePolarisability:
+            totalPolarizability += pondermotiveP
+
+        for wavelength, totalP, state in zip(wavelengthList,
+                                             totalPolarizability,
+                                             closestStates):
+            if not np.isnan(totalP):
                 # we are not hitting directly the resonance
-                totalP = scalarP + tensorPrefactor * tensorP
-                if addCorePolarisability:
-                    totalP += coreP
-                if addPondermotivePolarisability:
-                    totalP += pondermotiveP
                 if ((len(p) > 0) and p[-1] * totalP < 0
                     and (len(p) > 2 and (p[-2] - p[-1]) * totalP > 0)
                         ):
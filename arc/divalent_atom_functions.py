@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import division, print_function, absolute_import
 from .alkali_atom_functions import *
+from .alkali_atom_functions import _broadcastQuantumNumbers
 
 import os
 import numpy as np
@@ -99,6 +100,9 @@ class DivalentAtom(AlkaliAtom):
         self.cpp_numerov = cpp_numerov
         self.preferQuantumDefects = preferQuantumDefects
 
+        # state lifetimes that are already calculated (see getStateLifetime)
+        self._stateLifetimes = {}
+
         self._databaseInit()
         c = self.conn.cursor()
 
@@ -298,6 +302,74 @@ class DivalentAtom(AlkaliAtom):
         else:
             return 0      # there is no saved energy level measurement
 
+    def getEnergies(self, n, l, j, s=None):
+        if s is None:
+            raise ValueError("Spin state for DivalentAtom has to be "
+                             "explicitly defined as a keyword argument "
+                             "s=0 or s=1")
+        energy, extrapolated = self._getEnergies(n, l, j, s=s)
+        if np.any(extrapolated):
+            self.energyLevelsExtrapolated = True
+        return energy
+
+    def _getEnergies(self, n, l, j, s=0):
+        n, l, j, s = _broadcastQuantumNumbers(n, l, j, s)
+        if np.any(l >= n):
+            i = np.argmax(l >= n)
+            raise ValueError(
+                "Requested energy for state l=%d >= n=%d !" % (l[i], n[i]))
+
+        # quantum defect fitting range for each of the requested series
+        minQuantumDefectN = np.full(n.shape, 100000)
+        maxQuantumDefectN = np.zeros(n.shape, dtype=int)
+        series = np.stack((l.ravel(), np.rint(2 * j).ravel(),
+                           np.rint(2 * s).ravel()))
+        for ls, js, ss in np.unique(series, axis=1).T:
+            stateLabel = "%d%s%d" % (int(ss + 1), printStateLetter(int(ls)),
+                                     js / 2)
+            if stateLabel in self.defectFittingRange.keys():
+                sel = ((l == ls) & (np.rint(2 * j) == js)
+                       & (np.rint(2 * s) == ss))
+                minQuantumDefectN[sel] = self.defectFittingRange[stateLabel][0]
+                maxQuantumDefectN[sel] = self.defectFittingRange[stateLabel][1]
+
+        # use NIST data ?
+        if self.preferQuantumDefects:
+            tryNIST = n < minQuantumDefectN
+        else:
+            tryNIST = np.ones(n.shape, dtype=bool)
+        energy = np.zeros(n.shape)
+        energy[tryNIST] = self._getSavedEnergies(n[tryNIST], l[tryNIST],
+                                                 j[tryNIST], s=s[tryNIST])
+        useNIST = tryNIST & (np.abs(energy) > 1e-8)
+        extrapolated = tryNIST & ~useNIST \
+            & ((n < minQuantumDefectN) | (n > maxQuantumDefectN))
+
+        # else, use quantum defects
+        qd = ~useNIST
+        defect = self.getQuantumDefects(n[qd], l[qd], j[qd], s=s[qd])
+        energy[qd] = -self.scaledRydbergConstant / ((n[qd] - defect)**2)
+        return energy, extrapolated
+
+    def _getSavedEnergies(self, n, l, j, s=0):
+        # dense copy of the energyLevel table, indexed as [n, l, j, s]
+        if getattr(self, "_savedEnergyTable", None) is None:
+            c = self.conn.cursor()
+            c.execute('''SELECT n, l, j, s, energy FROM energyLevel''')
+            levels = np.array(c.fetchall(), dtype=np.float64).reshape(-1, 5)
+            index = np.rint(levels[:, :4]).astype(int)
+            self._savedEnergyTable = np.zeros(
+                tuple(np.max(index, axis=0, initial=0) + 1))
+            self._savedEnergyTable[tuple(index.T)] = levels[:, 4]
+        table = self._savedEnergyTable
+        index = (n, l, np.rint(j).astype(int), np.rint(s).astype(int))
+        inTable = np.ones(n.shape, dtype=bool)
+        for i, size in zip(index, table.shape):
+            inTable &= (i >= 0) & (i < size)
+        savedEnergy = np.zeros(n.shape)
+        savedEnergy[inTable] = table[tuple(i[inTable] for i in index)]
+        return savedEnergy
+
     def getRadialMatrixElement(self,
                                n1, l1, j1,
                                n2, l2, j2,
@@ -712,3 +784,17 @@ class DivalentAtom(AlkaliAtom):
             temperature=temperature,
             includeLevelsUpTo=includeLevelsUpTo,
             s=s)
+
+    def getStateLifetimes(self, nList, lList, jList=None, temperatures=0.,
+                          includeLevelsAbove=0, s=0):
+        print("WARNING:  For AlkalineEarths, lifetimes are observed to be "
+              "significantly modified by inter-electron correlations that are "
+              "not included in this code (see Vaillant et al., J. Phys B 47 "
+              "155001 (2015) for examples).  Use with caution.")
+        # after warning user, call method from the parent class
+        # (parent of DivalentAtom is AlkaliAtom)
+        return super(DivalentAtom, self).getStateLifetimes(
+            nList, lList, jList=jList,
+            temperatures=temperatures,
+            includeLevelsAbove=includeLevelsAbove,
+            s=s)